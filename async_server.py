@@ -0,0 +1,181 @@
+import asyncio
+import concurrent.futures
+import json
+import logging
+from http import HTTPStatus
+from body_parser import StreamingBodyParser, BodyError, content_length
+from server import RecognitionService, config, start_services, stop_services
+import metrics
+
+
+MAX_HEADERS = 100
+
+
+class AsyncRecognitionServer:
+    '''
+        asyncio HTTP/1.1 front end of RecognitionService.
+        Bodies are read and base64 decoded in the event loop, so slow uploads do not take
+        threads or recognition pool slots. Complete requests are handled in the executor.
+        Connections are kept alive until idle_timeout seconds pass without a request.
+    '''
+
+    def __init__(self, service: RecognitionService, max_body_size: int, idle_timeout=60, chunk_size=65536, threads=32):
+        self.service = service
+        self.max_body_size = max_body_size
+        self.idle_timeout = idle_timeout
+        self.chunk_size = chunk_size
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=threads, thread_name_prefix='Request')
+
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle_connection, host, int(port))
+        logging.info(f'Async server started on {host}:{port}')
+        async with server:
+            await server.serve_forever()
+
+
+    async def handle_connection(self, reader, writer):
+        buffer = bytearray()
+        try:
+            while True:
+                request = await self.read_head(reader)
+                if request is None:
+                    break
+                method, path, version, headers = request
+                keep_alive = self.keep_alive(version, headers)
+
+                if method == 'GET' and path == '/metrics':
+                    await self.respond(writer, HTTPStatus.OK, metrics.render(), keep_alive, metrics.CONTENT_TYPE)
+                elif method == 'GET':
+                    await self.respond(writer, HTTPStatus.OK, b'Hello!', keep_alive)
+                elif method == 'POST':
+                    keep_alive = await self.handle_post(reader, writer, path, headers, buffer) and keep_alive
+                else:
+                    keep_alive = False
+                    await self.respond_msg(writer, HTTPStatus.NOT_IMPLEMENTED, 501, 'Unsupported method.', keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ValueError) as e:
+            logging.info(f'Connection closed: {e!r}')
+        finally:
+            writer.close()
+
+
+    async def read_head(self, reader):
+        '''
+            return (method, path, version, headers), None when the client closed an idle connection
+        '''
+        try:
+            line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+        except asyncio.TimeoutError:
+            return None
+        if not line.strip():
+            return None
+        method, path, version = line.decode('latin-1').split()
+
+        headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+            if line in (b'\r\n', b'\n', b''):
+                break
+            if len(headers) >= MAX_HEADERS:
+                raise ValueError('Too many headers')
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        return method, path, version, headers
+
+
+    @staticmethod
+    def keep_alive(version, headers) -> bool:
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            return connection != 'close'
+        return connection == 'keep-alive'
+
+
+    async def handle_post(self, reader, writer, path, headers, buffer) -> bool:
+        '''
+            return False when the connection can not be reused
+        '''
+        if 'content-length' not in headers or 'transfer-encoding' in headers:
+            await self.respond_msg(writer, HTTPStatus.LENGTH_REQUIRED, 411, 'Content-Length is required.', False)
+            return False
+        try:
+            length = content_length(headers['content-length'])
+        except BodyError as e:
+            await self.respond_msg(writer, HTTPStatus.BAD_REQUEST, 400, str(e), False)
+            return False
+        if length > self.max_body_size:
+            await self.respond_msg(writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE, 413, 'Request body is too large.', False)
+            return False
+        if headers.get('expect', '').lower() == '100-continue':
+            writer.write(b'HTTP/1.1 100 Continue\r\n\r\n')
+
+        parser = StreamingBodyParser(buffer)
+        error = None
+        remaining = length
+        while remaining:
+            chunk = await asyncio.wait_for(reader.read(min(self.chunk_size, remaining)), self.idle_timeout)
+            if not chunk:
+                raise asyncio.IncompleteReadError(b'', remaining)
+            remaining -= len(chunk)
+            if error is None:
+                try:
+                    parser.feed(chunk)
+                except BodyError as e:
+                    # the rest of the body is read to keep the connection usable
+                    error = e
+        try:
+            body = parser.finish() if error is None else None
+        except BodyError as e:
+            error = e
+        if error is not None:
+            self.service.log_writer.write(0, path, 2, None, str(error))
+            await self.respond_json(writer, HTTPStatus.OK, self.service.make_result(400, str(error)), True)
+            return True
+
+        loop = asyncio.get_running_loop()
+        http_status, result = await loop.run_in_executor(self.executor, self.service.process_post, path, body)
+        if result is None:
+            http_status, result = HTTPStatus.NOT_FOUND, self.service.make_result(404, 'The request path structure is incorrect.')
+        await self.respond_json(writer, http_status, result, True)
+        return True
+
+
+    async def respond_msg(self, writer, http_status, status_code, msg, keep_alive):
+        await self.respond_json(writer, http_status, self.service.make_result(status_code, msg), keep_alive)
+
+
+    async def respond_json(self, writer, http_status, result, keep_alive):
+        await self.respond(writer, http_status, json.dumps(result).encode('utf-8'), keep_alive)
+
+
+    async def respond(self, writer, http_status, payload: bytes, keep_alive, content_type='application/json'):
+        writer.write((
+            f'HTTP/1.1 {http_status.value} {http_status.phrase}\r\n'
+            f'Content-Type: {content_type}\r\n'
+            'Access-Control-Allow-Origin: *\r\n'
+            f'Content-Length: {len(payload)}\r\n'
+            f'Connection: {"keep-alive" if keep_alive else "close"}\r\n'
+            '\r\n'
+        ).encode('latin-1') + payload)
+        await writer.drain()
+
+
+def start_async_server(host, port):
+    start_services()
+    server = AsyncRecognitionServer(RecognitionService(), RecognitionService.max_body_size,
+                                    idle_timeout=config.getint('SERVER', 'keepalive_timeout', fallback=60),
+                                    threads=config.getint('SERVER', 'threads', fallback=32))
+    try:
+        asyncio.run(server.serve(host, port))
+    finally:
+        server.executor.shutdown()
+        stop_services()
+
+
+
+
+if __name__ == '__main__':
+    server_config = config['SERVER']
+    start_async_server(server_config['host'], server_config['port'])
@@ -0,0 +1,484 @@
+import argparse
+import base64
+import contextlib
+import datetime
+import http.client
+import io
+import json
+import os
+import platform
+import re
+import socket
+import sqlite3
+import tempfile
+import threading
+import time
+import numpy as np
+from PIL import Image
+from benchmark_ann import synthetic_encodings
+from db_requests import DataBaseRequests
+from encoding_format import pack_encoding
+from gallery import FaceGallery, ENCODING_SIZE, PRECISIONS
+from snapshot_store import SnapshotStore
+import metrics
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak memory is not reported there
+    resource = None
+
+
+SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS vface_user (f_merid INTEGER, f_groupid INTEGER, f_uid TEXT, f_encode BLOB, '
+    'f_userinfo TEXT, f_ctime TEXT, f_etime TEXT, PRIMARY KEY (f_merid, f_groupid, f_uid))',
+    'CREATE TABLE IF NOT EXISTS vface_api_merchant (id INTEGER PRIMARY KEY, f_username TEXT, f_key TEXT)',
+    'CREATE TABLE IF NOT EXISTS vface_log (f_merid INTEGER, f_api TEXT, f_status INTEGER, f_requestdata TEXT, '
+    'f_responsedata TEXT, f_time TEXT)',
+]
+BENCH_MERID = 1
+BENCH_CLIENT = ('bench', 'bench')
+RESOLUTIONS = [(320, 240), (640, 480), (1280, 720), (1920, 1080), (3840, 2160)]
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.webp')
+
+
+class SQLiteCursor:
+    '''
+        sqlite3 cursor which takes the MySQL statements of db_requests
+    '''
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *exc):
+        self.cursor.close()
+
+
+    @staticmethod
+    def translate(sql: str) -> str:
+        sql = sql.replace('%s', '?')
+        if 'ON DUPLICATE KEY UPDATE' in sql:
+            sql = sql.replace('ON DUPLICATE KEY UPDATE', 'ON CONFLICT (f_merid, f_groupid, f_uid) DO UPDATE SET')
+            sql = re.sub(r'VALUES\((\w+)\)', r'excluded.\1', sql)
+        return sql
+
+
+    def execute(self, sql, args=None):
+        self.cursor.execute(self.translate(sql), tuple(args or ()))
+
+
+    def executemany(self, sql, args):
+        self.cursor.executemany(self.translate(sql), [tuple(row) for row in args])
+
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+
+    def fetchmany(self, size):
+        return self.cursor.fetchmany(size)
+
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+
+class SQLiteConnection:
+
+    def __init__(self, connection):
+        self.connection = connection
+
+
+    def cursor(self, cursor_class=None):
+        # sqlite cursors always stream rows, cursor_class (SSCursor) is not needed
+        return SQLiteCursor(self.connection.cursor())
+
+
+    def ping(self, reconnect=True):
+        pass
+
+
+    def commit(self):
+        self.connection.commit()
+
+
+    def rollback(self):
+        self.connection.rollback()
+
+
+class SQLitePool:
+    '''
+        Local stand-in for db_requests.ConnectionPool, every thread has its own sqlite3 connection.
+        DataBaseRequests runs its own statements through it, so the benchmark measures the real loading code.
+    '''
+
+    def __init__(self, path: str):
+        self.path = path
+        self.local = threading.local()
+        with self.connection() as connection:
+            with connection.cursor() as cursor:
+                for statement in SCHEMA:
+                    cursor.execute(statement)
+                cursor.execute('INSERT OR REPLACE INTO vface_api_merchant VALUES (%s, %s, %s)', (BENCH_MERID, *BENCH_CLIENT))
+            connection.commit()
+
+
+    @contextlib.contextmanager
+    def connection(self):
+        if getattr(self.local, 'connection', None) is None:
+            self.local.connection = SQLiteConnection(sqlite3.connect(self.path, timeout=30, check_same_thread=False))
+        try:
+            yield self.local.connection
+        except Exception:
+            self.local.connection.rollback()
+            raise
+
+
+    def close(self):
+        pass
+
+
+def sqlite_requests(path: str) -> DataBaseRequests:
+    database = DataBaseRequests(pool_size=1)
+    database.pool = SQLitePool(path)
+    return database
+
+
+def fill_group(database: DataBaseRequests, gid: int, encodings: np.ndarray, chunk_size=10000) -> None:
+    '''
+        Put the synthetic group into the database, an already filled group of the same size is reused
+    '''
+    rows = database.execute('SELECT COUNT(*) FROM vface_user WHERE f_merid = %s AND f_groupid = %s', (BENCH_MERID, gid))
+    if rows[0][0] == len(encodings):
+        return
+    database.execute('DELETE FROM vface_user WHERE f_merid = %s AND f_groupid = %s', (BENCH_MERID, gid))
+    now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    for start in range(0, len(encodings), chunk_size):
+        database.execute('INSERT INTO vface_user VALUES (%s, %s, %s, %s, %s, %s, %s)',
+                         [(BENCH_MERID, gid, f'u{row}', pack_encoding(encoding, database.encoding_dtype), f'user {row}', now, now)
+                          for row, encoding in enumerate(encodings[start:start + chunk_size], start)], many=True)
+
+
+def peak_rss_mb():
+    '''
+        Peak resident memory of the process so far, it never goes down between stages
+    '''
+    if resource is None:
+        return None
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def summary(latencies, elapsed=None) -> dict:
+    '''
+        latencies in seconds, elapsed - wall time of all calls when they ran concurrently
+    '''
+    latencies = np.asarray(latencies, dtype=np.float64)
+    if not len(latencies):
+        return {'count': 0}
+    elapsed = elapsed if elapsed is not None else float(latencies.sum())
+    return {
+        'count': int(len(latencies)),
+        'p50_ms': round(float(np.percentile(latencies, 50)) * 1000, 3),
+        'p99_ms': round(float(np.percentile(latencies, 99)) * 1000, 3),
+        'mean_ms': round(float(latencies.mean()) * 1000, 3),
+        'per_s': round(len(latencies) / elapsed, 2) if elapsed > 0 else None,
+    }
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+
+def bench_precisions(gallery, probes, precisions) -> dict:
+    '''
+        Exact search with every scan precision as the server runs it: a reduced precision gallery
+        reads its float32 matrix memory-mapped from a snapshot.
+        nbytes - memory of the gallery counted by the gallery cache,
+        top1_agreement, max_distance_error - the best match and its distance against the float32 search,
+        scan_top1 - agreement of the scan alone, before candidates are checked in float32
+    '''
+    reference = [gallery.search(probe, exact=True) for probe in probes]
+    results = {}
+    with tempfile.TemporaryDirectory(ignore_cleanup_errors=True) as directory:
+        store = SnapshotStore(directory)
+        store.save('bench', gallery, None)
+        for precision in precisions:
+            tested = gallery if precision == 'float32' else store.load('bench')[0]
+            tested.set_precision(precision)
+            found = []
+            seconds = []
+            for probe in probes:
+                result, elapsed = timed(tested.search, probe, 1, None, True)
+                found.append(result)
+                seconds.append(elapsed)
+            scan_top1 = 1.0
+            if tested.quantized is not None:
+                scan_top1 = np.mean([int(np.argmin(tested.quantized.sq_distances(probe))) == ref[0][0, 0]
+                                     for probe, ref in zip(probes, reference)])
+            results[precision] = {
+                'nbytes': tested.nbytes,
+                'exact_search': summary(seconds),
+                'top1_agreement': float(np.mean([res[0][0, 0] == ref[0][0, 0] for res, ref in zip(found, reference)])),
+                'scan_top1': float(scan_top1),
+                'max_distance_error': float(max(abs(res[1][0, 0] - ref[1][0, 0]) for res, ref in zip(found, reference)))
+            }
+            del tested
+    return results
+
+
+def bench_gallery(database, sizes, queries, ann_threshold, nprobe, rng, precisions=('float32',)) -> list:
+    '''
+        get_users_info, gallery build and search for every synthetic group size
+    '''
+    results = []
+    for size in sizes:
+        encodings = synthetic_encodings(size, rng)
+        fill_group(database, size, encodings)
+        del encodings
+
+        loads = []
+        for _ in range(3):
+            loaded, seconds = timed(database.get_users_info, size, BENCH_MERID)
+            loads.append(seconds)
+        face_ids, face_info, matrix = loaded
+
+        gallery, build_time = timed(FaceGallery, face_ids, face_info, matrix)
+        rows = rng.choice(size, min(queries, size), replace=False)
+        probes = matrix[rows] + rng.normal(0, 0.015, size=(len(rows), ENCODING_SIZE)).astype(np.float32)
+
+        result = {'stage': 'gallery', 'size': size, 'get_users_info': summary(loads),
+                  'gallery_build_s': round(build_time, 3), 'nbytes': gallery.nbytes,
+                  'exact_search': summary([timed(gallery.search, probe)[1] for probe in probes])}
+        if len(precisions) > 1 or precisions[0] != 'float32':
+            result['precision'] = bench_precisions(gallery, probes, precisions)
+        if size >= ann_threshold:
+            _, index_time = timed(gallery.build_index, None, nprobe)
+            result['index_build_s'] = round(index_time, 3)
+            result['ann_search'] = summary([timed(gallery.search, probe)[1] for probe in probes])
+        result['peak_rss_mb'] = peak_rss_mb()
+        results.append(result)
+        print(json.dumps(result))
+    return results
+
+
+def synthetic_images(resolutions, rng) -> list:
+    '''
+        JPEG images of smooth noise, they cost as much to decode as photos of the same size.
+        They have no faces, pass --images with real photos to measure detection and encoding of faces.
+    '''
+    images = []
+    for width, height in resolutions:
+        small = rng.integers(0, 256, size=(max(1, height // 16), max(1, width // 16), 3), dtype=np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(small).resize((width, height), Image.BILINEAR).save(buffer, 'JPEG', quality=90)
+        images.append((f'{width}x{height}', buffer.getvalue()))
+    return images
+
+
+def read_images(directory: str) -> list:
+    images = []
+    for name in sorted(os.listdir(directory)):
+        if name.lower().endswith(IMAGE_EXTENSIONS):
+            with open(os.path.join(directory, name), 'rb') as f:
+                data = f.read()
+            with Image.open(io.BytesIO(data)) as img:
+                images.append((f'{name} {img.width}x{img.height}', data))
+    return images
+
+
+def bench_images(images, gallery, repeats, decode_max_size, detection) -> list:
+    '''
+        Stages of FaceRecognition for every image: decode, detection, encoding,
+        and whole encoding_face_img and face_recognizer calls
+    '''
+    from face_recognition_code import FaceRecognition, detection_options
+    fr = FaceRecognition(decode_max_size=decode_max_size)
+    options = detection_options(detection)
+
+    results = []
+    for label, data in images:
+        image = base64.b64encode(data).decode('ascii')
+        stages = {}
+        faces = 0
+        for _ in range(repeats):
+            (locations, _), timings = metrics.collect(fr.detect_and_encode, image, 'BASE64', options)
+            faces = len(locations)
+            for name, seconds in timings:
+                stages.setdefault(name, []).append(seconds)
+
+        result = {'stage': 'image', 'image': label, 'bytes': len(data), 'faces': faces}
+        result.update({name: summary(latencies) for name, latencies in stages.items()})
+        result['encoding_face_img'] = summary([timed(fr.encoding_face_img, image)[1] for _ in range(repeats)])
+        result['face_recognizer'] = summary([timed(fr.face_recognizer, gallery, image, 'BASE64', 0.5, 1, None, options)[1]
+                                             for _ in range(repeats)])
+        result['peak_rss_mb'] = peak_rss_mb()
+        results.append(result)
+        print(json.dumps(result))
+    return results
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_front_end(front_end: str, port: int):
+    '''
+        Serve the recognition server in a background thread
+    '''
+    import server
+    if front_end == 'async':
+        import asyncio
+        from async_server import AsyncRecognitionServer
+        front = AsyncRecognitionServer(server.RecognitionService(), server.RecognitionService.max_body_size)
+        target = lambda: asyncio.run(front.serve('127.0.0.1', port))
+    else:
+        class QuietHandler(server.HTTPRecognitionServer):
+            def log_message(self, format, *args):
+                pass
+        front = server.ThreadingHTTPServer(('127.0.0.1', port), QuietHandler)
+        target = front.serve_forever
+    threading.Thread(target=target, daemon=True).start()
+    for _ in range(100):
+        with contextlib.suppress(OSError), socket.create_connection(('127.0.0.1', port)):
+            return
+        time.sleep(0.05)
+
+
+def bench_http(database, gid, images, requests, concurrency, processes, front_end, probe_cache=False) -> list:
+    '''
+        POST /recognition end to end: concurrency clients send every image requests times.
+        The same image is sent again and again, so the probe cache is off unless probe_cache is set,
+        otherwise the requests after the first one would skip detection and encoding.
+        probe_cache_hits - requests of the image answered from the probe cache
+    '''
+    import server
+    from workers import RecognitionPool
+    service = server.RecognitionService
+    service.db = service.log_writer.db = database
+    # the first request loads the group from the stand-in database, not from a snapshot
+    service.snapshots = None
+    service.probe_cache.clear()
+    if not probe_cache:
+        service.probe_cache.max_entries = 0
+    service.pool = RecognitionPool(processes, queue_depth=concurrency, decode_max_size=service.fr.decode_max_size)
+    service.pool.start()
+    service.log_writer.start()
+    port = free_port()
+    start_front_end(front_end, port)
+
+    def post(body):
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=600)
+        try:
+            start = time.perf_counter()
+            connection.request('POST', '/recognition', body, {'Content-Type': 'application/json', 'Accept': '*/*'})
+            response = connection.getresponse()
+            status = json.loads(response.read()).get('status_code')
+            return time.perf_counter() - start, status
+        finally:
+            connection.close()
+
+    results = []
+    try:
+        for label, data in images:
+            body = json.dumps({'api': {'client': BENCH_CLIENT[0], 'key': BENCH_CLIENT[1]},
+                               'data': {'gid': gid, 'threshold': 0.5, 'img': base64.b64encode(data).decode('ascii')}})
+            service.data_cache.pop(f'{BENCH_MERID}_{gid}')
+            service.probe_cache.clear()
+            hits = service.probe_cache.hits
+            cold, _ = post(body)
+
+            latencies, statuses = [], {}
+            lock = threading.Lock()
+
+            def client():
+                for _ in range(requests):
+                    seconds, status = post(body)
+                    with lock:
+                        latencies.append(seconds)
+                        statuses[str(status)] = statuses.get(str(status), 0) + 1
+
+            start = time.perf_counter()
+            clients = [threading.Thread(target=client) for _ in range(concurrency)]
+            for thread in clients:
+                thread.start()
+            for thread in clients:
+                thread.join()
+            elapsed = time.perf_counter() - start
+
+            result = {'stage': 'http', 'front_end': front_end, 'image': label, 'group_size': gid,
+                      'concurrency': concurrency, 'processes': processes, 'cold_ms': round(cold * 1000, 3),
+                      'request': summary(latencies, elapsed), 'status_codes': statuses,
+                      'probe_cache_hits': service.probe_cache.hits - hits, 'peak_rss_mb': peak_rss_mb()}
+            results.append(result)
+            print(json.dumps(result))
+    finally:
+        service.pool.shutdown()
+        service.log_writer.close()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Throughput, p50/p99 latency and peak memory of the recognition pipeline')
+    parser.add_argument('--stages', nargs='+', choices=['gallery', 'image', 'http'], default=['gallery', 'image', 'http'])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='synthetic group sizes, add 1000000 for the biggest groups')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--ann-threshold', type=int, default=50000)
+    parser.add_argument('--nprobe', type=int, default=8)
+    parser.add_argument('--precisions', nargs='+', choices=PRECISIONS, default=list(PRECISIONS),
+                        help='scan precisions of the exact search compared by the gallery stage')
+    parser.add_argument('--images', default=None, help='directory with images to replay, synthetic images when not set')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--decode-max-size', type=int, default=None)
+    parser.add_argument('--detect-size', type=int, default=0)
+    parser.add_argument('--http-size', type=int, default=10000, help='group size used by the http stage')
+    parser.add_argument('--http-requests', type=int, default=20, help='requests of every client for every image')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--processes', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--front-end', choices=['threaded', 'async'], default='threaded')
+    parser.add_argument('--probe-cache', action='store_true',
+                        help='keep the probe cache on in the http stage, repeated images then skip detection and encoding')
+    parser.add_argument('--db', default=None, help='sqlite file of the stand-in database, kept between runs')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    db_path = args.db or os.path.join(tempfile.mkdtemp(prefix='face_bench_'), 'bench.sqlite')
+    database = sqlite_requests(db_path)
+    images = read_images(args.images) if args.images else synthetic_images(RESOLUTIONS, rng)
+
+    results = []
+    if 'gallery' in args.stages:
+        results += bench_gallery(database, args.sizes, args.queries, args.ann_threshold, args.nprobe, rng, args.precisions)
+    if 'image' in args.stages or 'http' in args.stages:
+        fill_group(database, args.http_size, synthetic_encodings(args.http_size, rng))
+    if 'image' in args.stages:
+        face_ids, face_info, matrix = database.get_users_info(args.http_size, BENCH_MERID)
+        results += bench_images(images, FaceGallery(face_ids, face_info, matrix), args.repeats, args.decode_max_size,
+                                {'detect_size': args.detect_size})
+    if 'http' in args.stages:
+        results += bench_http(database, args.http_size, images, args.http_requests, args.concurrency,
+                              args.processes, args.front_end, args.probe_cache)
+
+    report = {
+        'time': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'cpu_count': os.cpu_count(),
+        'args': vars(args),
+        'results': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+    print(f'Results written to {args.output}')
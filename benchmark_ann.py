@@ -0,0 +1,66 @@
+import argparse
+import json
+import time
+import numpy as np
+from gallery import FaceGallery, ENCODING_SIZE
+
+
+def synthetic_encodings(size, rng, components=64):
+    '''
+        Random 128-d encodings grouped around a few components,
+        real face encodings are not uniformly spread either
+    '''
+    centers = rng.normal(0, 0.09, size=(components, ENCODING_SIZE))
+    labels = rng.integers(0, components, size=size)
+    return (centers[labels] + rng.normal(0, 0.05, size=(size, ENCODING_SIZE))).astype(np.float32)
+
+
+def run(size, queries, nprobes, nlist=None, seed=0):
+    '''
+        Compare ANN search with the exact search on the same gallery.
+        return list of results, one for every nprobe value
+    '''
+    rng = np.random.default_rng(seed)
+    encodings = synthetic_encodings(size, rng)
+    gallery = FaceGallery(list(range(size)), [''] * size, encodings)
+
+    # probes are other photos of enrolled people
+    rows = rng.choice(size, queries, replace=False)
+    probes = encodings[rows] + rng.normal(0, 0.015, size=(queries, ENCODING_SIZE))
+
+    start = time.perf_counter()
+    exact = np.concatenate([gallery.search(probe, k=1)[0] for probe in probes])
+    exact_time = (time.perf_counter() - start) / queries
+
+    start = time.perf_counter()
+    gallery.build_index(nlist=nlist)
+    build_time = time.perf_counter() - start
+
+    results = []
+    for nprobe in nprobes:
+        start = time.perf_counter()
+        approx = np.concatenate([gallery.search(probe, k=1, nprobe=nprobe)[0] for probe in probes])
+        ann_time = (time.perf_counter() - start) / queries
+        results.append({
+            'size': size,
+            'nlist': gallery.index.nlist,
+            'nprobe': nprobe,
+            'recall@1': float(np.mean(approx[:, 0] == exact[:, 0])),
+            'exact_ms': round(exact_time * 1000, 3),
+            'ann_ms': round(ann_time * 1000, 3),
+            'build_s': round(build_time, 3),
+        })
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Recall@1 and latency of the ANN index against the exact search')
+    parser.add_argument('--size', type=int, nargs='+', default=[10000, 100000])
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 8, 16, 32])
+    parser.add_argument('--nlist', type=int, default=None)
+    args = parser.parse_args()
+
+    for size in args.size:
+        for result in run(size, args.queries, args.nprobe, args.nlist):
+            print(json.dumps(result))
@@ -0,0 +1,179 @@
+import binascii
+import json
+import re
+
+
+# bytes which are not base64 characters, they are dropped like base64.b64decode does
+NOT_BASE64 = bytes(set(range(256)) - set(b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/='))
+# body of a json string up to the closing quote or a split escape
+STRING_BODY = re.compile(rb'(?:[^"\\]|\\.)*', re.DOTALL)
+IMAGE_KEYS = (b'"img"', b'"imgs"')
+# bytes which may stand between an image key and its string value
+IMAGE_SEPARATORS = b' \t\r\n:'
+CONTENT_LENGTH = re.compile(r'[0-9]+')
+
+
+class BodyError(Exception):
+    pass
+
+
+def content_length(value) -> int:
+    '''
+        Body size from the Content-Length header, only plain digits are accepted:
+        int() would let a negative length through and the body would be read up to EOF
+    '''
+    if value is None or not CONTENT_LENGTH.fullmatch(value.strip()):
+        raise BodyError('Content-Length is not valid.')
+    return int(value)
+
+
+class StreamingBodyParser:
+    '''
+        Incremental parser of a json request body.
+        Strings of "img" and "imgs" keys are base64 decoded while the body is received,
+        so only the decoded image bytes are kept. The rest of the json is parsed by finish().
+        buffer - decode buffer of the connection, it is reused by all its requests
+    '''
+
+    def __init__(self, buffer: bytearray):
+        self.buffer = buffer
+        self.text = bytearray()
+        self.images = []
+        self.pending = b''
+        self.state = 'text'
+        # the last string was an image key, its value is not finished yet
+        self.image_value = False
+        self.image_list = False
+        self.token = bytearray()
+        self.carry = b''
+        self.length = 0
+
+
+    def feed(self, chunk: bytes) -> None:
+        data = self.pending + chunk if self.pending else chunk
+        self.pending = b''
+        pos = 0
+        while pos < len(data):
+            if self.state == 'text':
+                pos = self._feed_text(data, pos)
+            elif self.state == 'string':
+                pos = self._feed_string(data, pos)
+            else:
+                pos = self._feed_image(data, pos)
+
+
+    def finish(self) -> dict:
+        if self.state != 'text' or self.pending:
+            raise BodyError('Only accept json request format.')
+        try:
+            body = json.loads(bytes(self.text))
+        except ValueError:
+            raise BodyError('Only accept json request format.')
+        return self._put_images(body)
+
+
+    def _feed_text(self, data, pos) -> int:
+        quote = data.find(b'"', pos)
+        end = len(data) if quote < 0 else quote
+        if self.image_value:
+            self._check_separators(data[pos:end])
+        self.text += data[pos:end]
+        if quote < 0:
+            return end
+
+        if self.image_value:
+            self.state = 'image'
+            self.carry = b''
+            self.length = 0
+        else:
+            self.state = 'string'
+            self.token = bytearray(b'"')
+            self.text += b'"'
+        return quote + 1
+
+
+    def _check_separators(self, region) -> None:
+        for byte in region:
+            if byte in IMAGE_SEPARATORS or (self.image_list and byte == ord(',')):
+                continue
+            if byte == ord('[') and not self.image_list:
+                self.image_list = True
+                continue
+            # the end of the image list or a value which is not an image
+            self.image_value = self.image_list = False
+            return
+
+
+    def _feed_string(self, data, pos) -> int:
+        end = STRING_BODY.match(data, pos).end()
+        self.text += data[pos:end]
+        if len(self.token) <= len(IMAGE_KEYS[-1]):
+            self.token += data[pos:min(end, pos + 8)]
+        if end == len(data):
+            return end
+        if data[end:end + 1] == b'\\':
+            # escape split between chunks
+            self.pending = data[end:]
+            return len(data)
+
+        self.text += b'"'
+        self.token += b'"'
+        self.image_value = bytes(self.token) in IMAGE_KEYS
+        self.image_list = False
+        self.state = 'text'
+        return end + 1
+
+
+    def _feed_image(self, data, pos) -> int:
+        quote = data.find(b'"', pos)
+        end = len(data) if quote < 0 else quote
+        region = data[pos:end]
+        if quote < 0 and region.endswith(b'\\'):
+            self.pending = b'\\'
+            region = region[:-1]
+        # line breaks escaped by the client, '\/' is left as '/' by dropping the backslash
+        region = region.replace(b'\\n', b'').replace(b'\\r', b'').replace(b'\\t', b'')
+        self._decode(self.carry + region.translate(None, NOT_BASE64))
+        if quote < 0:
+            return len(data)
+
+        self._decode(self.carry, final=True)
+        with memoryview(self.buffer) as view:
+            self.images.append(bytes(view[:self.length]))
+        self.text += b'"\\u0000%d"' % (len(self.images) - 1)
+        self.state = 'text'
+        return quote + 1
+
+
+    def _decode(self, chars: bytes, final=False) -> None:
+        size = len(chars) if final else len(chars) // 4 * 4
+        self.carry = chars[size:]
+        if not size:
+            return
+        try:
+            decoded = binascii.a2b_base64(chars[:size])
+        except binascii.Error:
+            raise BodyError('Image is not valid base64.')
+        self.buffer[self.length:self.length + len(decoded)] = decoded
+        self.length += len(decoded)
+
+
+    def _put_images(self, value):
+        if isinstance(value, dict):
+            for key, item in value.items():
+                if key in ('img', 'imgs'):
+                    value[key] = self._image(item)
+                else:
+                    self._put_images(item)
+        elif isinstance(value, list):
+            for item in value:
+                self._put_images(item)
+        return value
+
+
+    def _image(self, value):
+        if isinstance(value, list):
+            return [self._image(item) for item in value]
+        if isinstance(value, str) and value.startswith('\x00') and value[1:].isdigit():
+            return self.images[int(value[1:])]
+        return value
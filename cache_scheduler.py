@@ -0,0 +1,194 @@
+import collections
+import datetime
+import heapq
+import itertools
+import json
+import logging
+import os
+import threading
+import metrics
+
+
+def parse_groups(text: str) -> list:
+    '''
+        '1:5, 1:7' -> [(1, 5), (1, 7)], merchant id and group id of every group
+    '''
+    groups = []
+    for item in text.replace(';', ',').split(','):
+        merid, _, gid = item.strip().partition(':')
+        if merid and gid:
+            groups.append((int(merid), int(gid) if gid.isdigit() else gid))
+    return groups
+
+
+class CacheScheduler:
+    '''
+        Background upkeep of the gallery cache.
+        At start the thread loads warm_groups and the groups which were hot when the server stopped,
+        one group at a time between due refreshes, so requests do not wait for the whole warm-up.
+        Every cached group is checked for changed users before its refresh_interval passes,
+        so requests find it fresh. A request which still finds a stale gallery uses it at once
+        and its refresh is moved to the front of the queue.
+        Refreshes are kept in a heap by due time, expired cache entries are removed here,
+        not in the request path.
+    '''
+    # part of refresh_interval after which a cached group is refreshed
+    REFRESH_AHEAD = 0.8
+
+    def __init__(self, service, warm_groups=(), hot_path='HotGroups.json', hot_groups=20, tick=1.0):
+        self.service = service
+        self.warm_groups = list(warm_groups)
+        self.hot_path = hot_path
+        # groups saved to hot_path at stop, the most recently used first
+        self.hot_groups = hot_groups
+        self.tick = tick
+        # (due time, sequence, merid, gid), the sequence keeps the order of groups due at the same time
+        self.heap = []
+        self.sequence = itertools.count()
+        # '{merid}_{gid}' -> due time of its latest heap item, older items are skipped
+        self.due = {}
+        self.groups = {}
+        # (merid, gid) of groups not warmed yet
+        self.warming = collections.deque()
+        self.condition = threading.Condition()
+        self.thread = None
+        self.stopped = threading.Event()
+
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='CacheScheduler', daemon=True)
+        self.thread.start()
+
+
+    def close(self):
+        self.stopped.set()
+        with self.condition:
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+        self.save_hot()
+
+
+    def track(self, merid, gid) -> None:
+        '''
+            Refresh the group which was just cached before it becomes stale
+        '''
+        interval = self.service.refresh_interval * self.REFRESH_AHEAD
+        self.schedule(merid, gid, datetime.datetime.now() + interval)
+
+
+    def refresh_soon(self, merid, gid) -> None:
+        self.schedule(merid, gid, datetime.datetime.now())
+
+
+    def schedule(self, merid, gid, due) -> None:
+        key = f'{merid}_{gid}'
+        with self.condition:
+            self.groups[key] = (merid, gid)
+            if key in self.due and self.due[key] <= due:
+                return
+            self.due[key] = due
+            heapq.heappush(self.heap, (due, next(self.sequence), merid, gid))
+            self.condition.notify()
+
+
+    def _run(self):
+        self.warming.extend(dict.fromkeys(self.warm_groups + self.load_hot()))
+        warmed = len(self.warming)
+        while not self.stopped.is_set():
+            self.run_due()
+            self.expire()
+            if self.warming:
+                self.warm(*self.warming.popleft())
+                if not self.warming:
+                    logging.info(f'{warmed} groups warmed, cache size {self.service.data_cache.nbytes} bytes')
+                continue
+            with self.condition:
+                timeout = self.tick
+                if self.heap:
+                    timeout = min(timeout, max(0.0, (self.heap[0][0] - datetime.datetime.now()).total_seconds()))
+                if not self.stopped.is_set():
+                    self.condition.wait(timeout)
+
+
+    def warm(self, merid, gid) -> None:
+        '''
+            Load a configured or hot group which is not cached yet
+        '''
+        if f'{merid}_{gid}' in self.service.data_cache:
+            return
+        try:
+            with metrics.stage('gallery_warm'):
+                self.service.load_gallery(merid, gid)
+        except Exception as e:
+            logging.error(f'Group #{gid} of merchant {merid} was not warmed: {e}')
+
+
+    def run_due(self) -> None:
+        now = datetime.datetime.now()
+        while not self.stopped.is_set():
+            with self.condition:
+                if not self.heap or self.heap[0][0] > now:
+                    return
+                due, _, merid, gid = heapq.heappop(self.heap)
+                key = f'{merid}_{gid}'
+                if self.due.get(key) != due:
+                    continue
+                del self.due[key]
+            self.refresh(merid, gid)
+
+
+    def refresh(self, merid, gid) -> None:
+        key = f'{merid}_{gid}'
+        entry = self.service.data_cache.peek(key)
+        if entry is None:
+            # expired or cleared, the group is tracked again when it is loaded
+            with self.condition:
+                self.groups.pop(key, None)
+            return
+        try:
+            with metrics.stage('gallery_refresh'):
+                self.service.refresh_gallery(merid, gid, entry)
+        except Exception as e:
+            logging.error(f'Group #{gid} of merchant {merid} was not refreshed: {e}')
+        self.track(merid, gid)
+
+
+    def expire(self) -> None:
+        service = self.service
+        service.data_cache.evict()
+        service.check_cache(service.access_cache, service.pwd_time_delta)
+        service.check_cache(service.merchant_groups, service.refresh_interval)
+        service.check_cache(service.streams, service.stream_time_delta)
+
+
+    def load_hot(self) -> list:
+        if not self.hot_path or not os.path.exists(self.hot_path):
+            return []
+        try:
+            with open(self.hot_path, encoding='utf-8') as f:
+                return [tuple(group) for group in json.load(f)]
+        except (OSError, ValueError, TypeError) as e:
+            logging.warning(f'Hot groups were not read from {self.hot_path}: {e}')
+            return []
+
+
+    def save_hot(self) -> None:
+        '''
+            Write the most recently used cached groups, they are warmed on the next start
+        '''
+        if not self.hot_path:
+            return
+        with self.condition:
+            groups = list(self.groups.items())
+        used = []
+        for key, group in groups:
+            entry = self.service.data_cache.peek(key)
+            if entry is not None:
+                used.append((entry['ex_time'], group))
+        used.sort(key=lambda item: item[0], reverse=True)
+        try:
+            with open(self.hot_path, 'w', encoding='utf-8') as f:
+                json.dump([list(group) for _, group in used[:self.hot_groups]], f)
+        except OSError as e:
+            logging.warning(f'Hot groups were not saved to {self.hot_path}: {e}')
@@ -1,8 +1,19 @@
-import pickle
 import datetime
 import logging
 import os
-from db import db
+import threading
+import queue
+import contextlib
+import pymysql
+import numpy as np
+from encoding_format import pack_encoding, unpack_encodings, is_packed
+from gallery import ENCODING_SIZE
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, peak memory is not logged there
+    resource = None
 
 
 logging.basicConfig(filename='LogFile',
@@ -12,12 +23,150 @@ logging.basicConfig(filename='LogFile',
                         level=logging.DEBUG)
 
 
+# Statements are constants, values are always passed as parameters
+SQL_CLIENT_VALIDATION = 'SELECT id FROM vface_api_merchant WHERE f_username = %s AND f_key = %s LIMIT 1'
+SQL_INSERT_LOG = ('INSERT INTO vface_log (f_merid, f_api, f_status, f_requestdata, f_responsedata, f_time) '
+                  'VALUES (%s, %s, %s, %s, %s, %s)')
+SQL_USERS_INFO = ('SELECT f_uid, f_userinfo, f_encode FROM vface_user '
+                  'WHERE f_groupid = %s AND f_merid = %s AND f_encode IS NOT NULL AND LENGTH(f_encode) > 0')
+SQL_USERS_INFO_SINCE = SQL_USERS_INFO + ' AND f_etime >= %s'
+SQL_USERS_COUNT = ('SELECT COUNT(*) FROM vface_user '
+                   'WHERE f_groupid = %s AND f_merid = %s AND f_encode IS NOT NULL AND LENGTH(f_encode) > 0')
+SQL_USERS_COUNT_SINCE = SQL_USERS_COUNT + ' AND f_etime >= %s'
+SQL_GROUP_VERSION = ('SELECT MAX(f_etime), SUM(f_encode IS NOT NULL AND LENGTH(f_encode) > 0) FROM vface_user '
+                     'WHERE f_groupid = %s AND f_merid = %s')
+SQL_GROUP_IDS = ('SELECT DISTINCT f_groupid FROM vface_user '
+                 'WHERE f_merid = %s AND f_encode IS NOT NULL AND LENGTH(f_encode) > 0')
+SQL_USER_EXISTS = 'SELECT 1 FROM vface_user WHERE f_merid = %s AND f_groupid = %s AND f_uid = %s LIMIT 1'
+SQL_UPDATE_USER = ('UPDATE vface_user SET f_encode = %s, f_userinfo = %s, f_etime = %s '
+                   'WHERE f_merid = %s AND f_groupid = %s AND f_uid = %s')
+SQL_INSERT_USER = ('INSERT INTO vface_user (f_merid, f_groupid, f_uid, f_encode, f_userinfo, f_ctime, f_etime) '
+                   'VALUES (%s, %s, %s, %s, %s, %s, %s)')
+SQL_UPSERT_USER = SQL_INSERT_USER + (' ON DUPLICATE KEY UPDATE f_encode = VALUES(f_encode), f_userinfo = VALUES(f_userinfo), '
+                                     'f_etime = VALUES(f_etime)')
+
+# Errors after which the connection is dropped and the request may be retried on a new one
+CONNECTION_ERRORS = (pymysql.err.OperationalError, pymysql.err.InterfaceError)
+
+
+class ConnectionPool:
+    '''
+        Pool of database connections.
+        Every request checks out its own connection, so server threads do not wait for each other.
+        A connection is pinged before use and replaced when it is broken.
+    '''
+
+    def __init__(self, size=8, timeout=10, **params):
+        self.size = size
+        self.timeout = timeout
+        self.params = params
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+
+    @contextlib.contextmanager
+    def connection(self):
+        connection = self._checkout()
+        try:
+            yield connection
+        except CONNECTION_ERRORS:
+            self._discard(connection)
+            raise
+        except Exception:
+            try:
+                connection.rollback()
+            except CONNECTION_ERRORS:
+                self._discard(connection)
+                raise
+            self.idle.put(connection)
+            raise
+        else:
+            self.idle.put(connection)
+
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+    def _checkout(self):
+        try:
+            connection = self.idle.get_nowait()
+        except queue.Empty:
+            with self.lock:
+                can_create = self.created < self.size
+                if can_create:
+                    self.created += 1
+            if can_create:
+                try:
+                    return self._connect()
+                except Exception:
+                    with self.lock:
+                        self.created -= 1
+                    raise
+            try:
+                connection = self.idle.get(timeout=self.timeout)
+            except queue.Empty:
+                raise pymysql.err.OperationalError('No free database connection in the pool')
+
+        try:
+            # health check, reconnects a connection closed by the server
+            connection.ping(reconnect=True)
+        except CONNECTION_ERRORS:
+            logging.warning('Database connection is broken')
+            self._discard(connection)
+            raise
+        return connection
+
+
+    def _discard(self, connection):
+        try:
+            connection.close()
+        except Exception:
+            pass
+        with self.lock:
+            self.created -= 1
+
+
+    def _connect(self):
+        return pymysql.connect(**self.params, charset='utf8mb4')
+
+
 class DataBaseRequests:
 
-    def __init__(self):
-        self.user_table = db('vface_user')
-        self.log_table = db('vface_log')
-        self.mer_table = db('vface_api_merchant')
+    def __init__(self, host=None, user=None, pwd=None, database=None, encoding_dtype='float32', pool_size=8):
+        self.pool = ConnectionPool(size=pool_size, host=host, user=user, password=pwd, database=database)
+        # Precision of stored encodings: float32 or float16
+        self.encoding_dtype = encoding_dtype
+
+
+    def execute(self, sql: str, args=None, many=False, retry=True) -> list:
+        '''
+            Run one statement on a pooled connection and commit.
+            return fetched rows
+            retry - run the statement once more on a new connection when the connection failed,
+                    only for statements which are safe to repeat
+        '''
+        for attempt in range(2 if retry else 1):
+            try:
+                with self.pool.connection() as connection:
+                    with connection.cursor() as cursor:
+                        if many:
+                            cursor.executemany(sql, args)
+                        else:
+                            cursor.execute(sql, args)
+                        rows = cursor.fetchall()
+                    # commit also ends the read transaction, so the next read sees new rows
+                    connection.commit()
+                    return rows
+            except CONNECTION_ERRORS as e:
+                if attempt or not retry:
+                    raise
+                logging.warning(f'Database connection failed {str(e)}, retrying')
 
 
     def client_validation(self, clientname: str, key: str):
@@ -26,11 +175,11 @@ class DataBaseRequests:
             When verification passes, return merid
         '''
         logging.info(f'Validation of {clientname} ...')
-        merid_dict = self.mer_table.field('id').where(f'f_username = {clientname} and f_key = {key}').limit(1).find()
+        merid_rows = self.execute(SQL_CLIENT_VALIDATION, (clientname, key))
 
-        if len(merid_dict) == 1:
+        if len(merid_rows) == 1:
             logging.info('Validation successed')
-            return merid_dict[0]['id']
+            return merid_rows[0][0]
         else:
             logging.error('Validation failed')
 
@@ -38,33 +187,96 @@ class DataBaseRequests:
 
     def insert_log(self, merid: str, api: str, status: int, requestdata, responsedata):
         try:
-            self.log_table.add({'f_merid': merid, 'f_api': api, 'f_status': status, 'f_requestdata': requestdata,
-                            'f_responsedata': responsedata, 'f_time': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")})
+            self.execute(SQL_INSERT_LOG, (merid, api, status, requestdata, responsedata,
+                                          datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")), retry=False)
         except Exception as e:
             logging.error(f'Insert log {str(e)}')
 
 
-    def get_users_info(self, group_id: str, merid: str):
-        face_encodings = []
-        face_ids = []
-        face_info = []
-
-        rows = self.user_table.where(f'f_groupid = {group_id} and f_merid = {merid}').find()
-        if rows:
-            for row in rows:
-                if row['f_encode']:
-                    face_encode = pickle.loads(row['f_encode'])
-                    face_encodings.append(face_encode)
-                    face_info.append(row['f_userinfo'])
-                    face_ids.append(row['f_uid'])
-                    
-            print(f'{len(face_encodings)} faces in group #{group_id}')
-            print(f'Ids: {face_ids}')
-            logging.info(f'{len(face_encodings)} faces in group #{group_id}')
-            return face_ids, face_info, face_encodings
-        return False
+    def insert_logs(self, rows: list):
+        '''
+            Insert many log rows with one multi-row INSERT
+            rows - list of (merid, api, status, requestdata, responsedata, time)
+        '''
+        self.execute(SQL_INSERT_LOG, rows, many=True, retry=False)
+
+
+    def get_users_info(self, group_id: str, merid: str, since=None, chunk_size=5000):
+        '''
+            Users of the group streamed from a server-side cursor chunk by chunk,
+            encodings are written straight into a preallocated float32 matrix.
+            since - load only users changed at or after this f_etime
+            return (face_ids, face_info, face_encodings matrix N x 128), False when the group is empty
+        '''
+        if since is None:
+            count_sql, rows_sql, args = SQL_USERS_COUNT, SQL_USERS_INFO, (group_id, merid)
+        else:
+            count_sql, rows_sql, args = SQL_USERS_COUNT_SINCE, SQL_USERS_INFO_SINCE, (group_id, merid, since)
+
+        with self.pool.connection() as connection:
+            with connection.cursor() as cursor:
+                cursor.execute(count_sql, args)
+                expected = cursor.fetchone()[0]
+            face_encodings = np.empty((expected, ENCODING_SIZE), dtype=np.float32)
+            face_ids = []
+            face_info = []
+
+            with connection.cursor(pymysql.cursors.SSCursor) as cursor:
+                cursor.execute(rows_sql, args)
+                while True:
+                    rows = cursor.fetchmany(chunk_size)
+                    if not rows:
+                        break
+                    loaded = len(face_ids)
+                    if loaded + len(rows) > len(face_encodings):
+                        # users were added after the count
+                        face_encodings = np.concatenate([face_encodings[:loaded],
+                                                         np.empty((len(rows), ENCODING_SIZE), dtype=np.float32)])
+                    face_encodings[loaded:loaded + len(rows)] = unpack_encodings([row[2] for row in rows])
+                    face_ids.extend(row[0] for row in rows)
+                    face_info.extend(row[1] for row in rows)
+                    logging.debug(f'Group #{group_id}: {len(face_ids)} of {expected} faces loaded')
+            connection.commit()
+
+        if not face_ids:
+            return False
+        face_encodings = face_encodings[:len(face_ids)]
+        if resource is not None:
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            logging.info(f'{len(face_ids)} faces in group #{group_id}, peak memory {peak} KB')
+        else:
+            logging.info(f'{len(face_ids)} faces in group #{group_id}')
+        return face_ids, face_info, face_encodings
     
 
+    def get_group_version(self, group_id: str, merid: str):
+        '''
+            Cheap freshness check of the group
+            return (version, count): max f_etime as string and number of faces with encodings,
+                   None when the database request failed
+        '''
+        try:
+            version, count = self.execute(SQL_GROUP_VERSION, (group_id, merid))[0]
+        except Exception as e:
+            logging.error(f'Group version request failed {str(e)}')
+            return None
+
+        if isinstance(version, datetime.datetime):
+            version = version.strftime("%Y-%m-%d %H:%M:%S")
+        return version, int(count or 0)
+
+
+    def get_group_ids(self, merid: str):
+        '''
+            return list of groups of the merchant which have faces, None when the database request failed
+        '''
+        try:
+            return [row[0] for row in self.execute(SQL_GROUP_IDS, (merid,))]
+        except Exception as e:
+            logging.error(f'Group ids request failed {str(e)}')
+            return None
+
+
     def update_user(self, merid: str, groupid: str, uid: str, encode, userinfo: str) -> str:
         '''
             return status
@@ -73,22 +285,20 @@ class DataBaseRequests:
                 - 'Failed'
         '''
         if type(encode) != bytes:
-            encode = pickle.dumps(encode)
+            encode = pack_encoding(encode, self.encoding_dtype)
         
-        print('Updating...')
+        logging.info(f'Saving {uid} of group #{groupid}...')
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         try:
-            rows = self.user_table.where(f'f_merid = {merid} and f_groupid = {groupid} and f_uid = {uid}').limit(1).find()
+            rows = self.execute(SQL_USER_EXISTS, (merid, groupid, uid))
             if len(rows) == 1:
                 logging.info(f'Updating {uid}...')
-                self.user_table.where(f'f_merid = {merid} and f_groupid = {groupid} and f_uid = {uid}').save({'f_encode': encode, 'f_userinfo': userinfo,
-                                                                                                              'f_etime': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")})
+                self.execute(SQL_UPDATE_USER, (encode, userinfo, now, merid, groupid, uid))
                 logging.info(f'{uid} user was updated')
                 status = 'Updated'
-            elif len(rows) == 0:
+            else:
                 logging.info(f'Creating {uid}...')
-                self.user_table.add({'f_merid': merid, 'f_groupid': groupid, 'f_uid': uid, 'f_encode': encode, 'f_userinfo': userinfo, 
-                                     'f_ctime': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), 
-                                     'f_etime': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")})
+                self.execute(SQL_INSERT_USER, (merid, groupid, uid, encode, userinfo, now, now), retry=False)
                 logging.info(f'{uid} user was created.')
                 status = 'Created'
                 
@@ -98,6 +308,74 @@ class DataBaseRequests:
         return status
 
 
+    def bulk_update_users(self, merid: str, groupid: str, users: list, chunk_size=500) -> dict:
+        '''
+            Create or update many users of the group.
+            users - list of (uid, encode, userinfo)
+            Every chunk is written with one multi-row INSERT ... ON DUPLICATE KEY UPDATE,
+            it needs the unique key on (f_merid, f_groupid, f_uid).
+            return {uid: status}, status is 'Updated', 'Created' or 'Failed'
+        '''
+        statuses = {}
+        now = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+        for start in range(0, len(users), chunk_size):
+            chunk = users[start:start + chunk_size]
+            uids = [uid for uid, _, _ in chunk]
+            rows = [(merid, groupid, uid, encode if type(encode) == bytes else pack_encoding(encode, self.encoding_dtype), userinfo, now, now)
+                    for uid, encode, userinfo in chunk]
+            try:
+                with self.pool.connection() as connection:
+                    with connection.cursor() as cursor:
+                        cursor.execute(f'SELECT f_uid FROM vface_user WHERE f_merid = %s AND f_groupid = %s '
+                                       f'AND f_uid IN ({", ".join(["%s"] * len(uids))})', [merid, groupid, *uids])
+                        existing = {str(row[0]) for row in cursor.fetchall()}
+                        cursor.executemany(SQL_UPSERT_USER, rows)
+                    connection.commit()
+                for uid in uids:
+                    statuses[uid] = 'Updated' if str(uid) in existing else 'Created'
+                logging.info(f'{len(chunk)} users of group #{groupid} were saved')
+
+            except Exception as e:
+                logging.error(f'Bulk update failed {str(e)}')
+                for uid in uids:
+                    statuses[uid] = 'Failed'
+        return statuses
+
+
+    def migrate_encodings(self, chunk_size=1000) -> int:
+        '''
+            Convert pickled encodings of all users to the binary format, chunk by chunk.
+            f_etime is kept, the encodings do not change.
+            return number of converted users
+        '''
+        converted = 0
+        last_key = ('', '', '')
+        while True:
+            with self.pool.connection() as connection:
+                with connection.cursor() as cursor:
+                    cursor.execute('SELECT f_merid, f_groupid, f_uid, f_encode FROM vface_user '
+                                   'WHERE (f_merid, f_groupid, f_uid) > (%s, %s, %s) AND f_encode IS NOT NULL '
+                                   'ORDER BY f_merid, f_groupid, f_uid LIMIT %s', (*last_key, chunk_size))
+                    rows = cursor.fetchall()
+                    if not rows:
+                        connection.commit()
+                        break
+                    last_key = rows[-1][:3]
+
+                    pickled = [row for row in rows if row[3] and not is_packed(row[3])]
+                    if pickled:
+                        encodings = unpack_encodings([row[3] for row in pickled])
+                        cursor.executemany('UPDATE vface_user SET f_encode = %s, f_etime = f_etime '
+                                           'WHERE f_merid = %s AND f_groupid = %s AND f_uid = %s',
+                                           [(pack_encoding(encoding, self.encoding_dtype), *row[:3])
+                                            for row, encoding in zip(pickled, encodings)])
+                connection.commit()
+            converted += len(pickled)
+            logging.info(f'{converted} encodings converted')
+        return converted
+
+
 if __name__ == '__main__':
     from face_recognition_code import FaceRecognition
     fr = FaceRecognition()
@@ -0,0 +1,96 @@
+import argparse
+import configparser
+import json
+import time
+from db_requests import DataBaseRequests
+from gallery import FaceGallery
+
+
+# nearest gallery faces checked for an enrolled face
+DEDUPE_K = 5
+
+
+class DuplicateFace(Exception):
+    '''
+        The enrolled face is as close as the dedupe threshold to faces of other users of the group
+    '''
+
+    def __init__(self, msg, duplicates):
+        super().__init__(msg)
+        self.duplicates = duplicates
+
+
+def enrolled_duplicates(gallery: FaceGallery, encoding, threshold, uid=None, k=DEDUPE_K, nprobe=None) -> list:
+    '''
+        Users of the gallery not farther than threshold from the encoding, the nearest first:
+        [{'id', 'info', 'distance'}, ...]. The enrolled user uid itself is skipped.
+    '''
+    indices, distances = gallery.search(encoding, k=k + 1, nprobe=nprobe)
+    result = []
+    for index, distance in zip(indices[0], distances[0]):
+        # distances are sorted, rows the index could not fill are at the end with inf
+        if distance > threshold:
+            break
+        if str(gallery.ids[index]) == str(uid):
+            continue
+        result.append({'id': gallery.ids[index], 'info': gallery.infos[index], 'distance': round(float(distance), 4)})
+    return result[:k]
+
+
+def duplicate_clusters(gallery: FaceGallery, threshold, nprobe=None) -> list:
+    '''
+        Groups of users which are likely one person: faces linked by pairs not farther than threshold.
+        Pairs come from FaceGallery.near_pairs, they are merged with union-find.
+        return list of clusters, every cluster is a list of user ids, the biggest clusters first
+    '''
+    pairs, _ = gallery.near_pairs(threshold, nprobe)
+    parent = {}
+
+    def find(row):
+        parent.setdefault(row, row)
+        while parent[row] != row:
+            parent[row] = parent[parent[row]]
+            row = parent[row]
+        return row
+
+    for first, second in pairs.tolist():
+        first, second = find(first), find(second)
+        if first != second:
+            parent[max(first, second)] = min(first, second)
+
+    clusters = {}
+    for row in sorted(parent):
+        clusters.setdefault(find(row), []).append(gallery.ids[row])
+    return sorted(clusters.values(), key=len, reverse=True)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Find users of a group which are likely enrolled more than once')
+    parser.add_argument('--merid', type=int, required=True)
+    parser.add_argument('--gid', required=True)
+    parser.add_argument('--threshold', type=float, default=0.4, help='face distance of one person')
+    parser.add_argument('--nprobe', type=int, default=8, help='closest index lists every list is compared with')
+    parser.add_argument('--output', default=None, help='json file of the clusters, printed when not set')
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read("config.ini", encoding='utf-8')
+    bd_config = config['MYSQL']
+    database = DataBaseRequests(host=bd_config['host'], user=bd_config['user'], pwd=bd_config['pwd'], database=bd_config['database'],
+                                encoding_dtype=bd_config.get('encoding_dtype', 'float32'))
+
+    t_data = database.get_users_info(group_id=args.gid, merid=args.merid)
+    if t_data is False:
+        raise SystemExit('Unable to connect to the database when obtaining face information.')
+    group = FaceGallery(*t_data)
+
+    start = time.perf_counter()
+    found = duplicate_clusters(group, args.threshold, args.nprobe)
+    report = {'merid': args.merid, 'gid': args.gid, 'faces': len(group), 'threshold': args.threshold,
+              'seconds': round(time.perf_counter() - start, 3), 'clusters': found}
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f'{len(found)} clusters of duplicate users written to {args.output}')
+    else:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
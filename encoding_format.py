@@ -0,0 +1,81 @@
+import io
+import pickle
+import struct
+import numpy as np
+from gallery import ENCODING_SIZE
+
+
+# Binary encoding: 4 bytes header (magic, format version, dtype code) and 128 little-endian floats
+MAGIC = b'FE'
+FORMAT_VERSION = 1
+HEADER = struct.Struct('<2sBB')
+DTYPE_CODES = {'float32': 1, 'float16': 2}
+CODE_DTYPES = {1: np.dtype('<f4'), 2: np.dtype('<f2')}
+
+
+class EncodingFormatError(Exception):
+    pass
+
+
+class SafeUnpickler(pickle.Unpickler):
+    '''
+        Unpickler of old encodings, it restores numpy arrays only
+    '''
+    ALLOWED = {
+        ('numpy.core.multiarray', '_reconstruct'),
+        ('numpy._core.multiarray', '_reconstruct'),
+        ('numpy', 'ndarray'),
+        ('numpy', 'dtype'),
+    }
+
+    def find_class(self, module, name):
+        if (module, name) not in self.ALLOWED:
+            raise EncodingFormatError(f'Forbidden object in pickled encoding: {module}.{name}')
+        return super().find_class(module, name)
+
+
+def pack_encoding(encoding, dtype='float32') -> bytes:
+    '''
+        Encoding as bytes for f_encode column, 516 bytes for float32 and 260 bytes for float16
+    '''
+    if dtype not in DTYPE_CODES:
+        raise EncodingFormatError(f'Unknown encoding dtype {dtype}')
+    array = np.asarray(encoding, dtype=CODE_DTYPES[DTYPE_CODES[dtype]]).reshape(ENCODING_SIZE)
+    return HEADER.pack(MAGIC, FORMAT_VERSION, DTYPE_CODES[dtype]) + array.tobytes()
+
+
+def is_packed(blob: bytes) -> bool:
+    return blob[:len(MAGIC)] == MAGIC
+
+
+def unpack_encoding(blob: bytes) -> np.ndarray:
+    return unpack_encodings([blob])[0]
+
+
+def unpack_encodings(blobs: list) -> np.ndarray:
+    '''
+        Encodings of f_encode values as float32 matrix N x 128.
+        Values of one binary format are converted with one np.frombuffer,
+        old pickled values are still read one by one.
+    '''
+    matrix = np.empty((len(blobs), ENCODING_SIZE), dtype=np.float32)
+    formats = {}
+    for row, blob in enumerate(blobs):
+        if is_packed(blob):
+            formats.setdefault(bytes(blob[:HEADER.size]), []).append(row)
+        else:
+            matrix[row] = SafeUnpickler(io.BytesIO(blob)).load()
+
+    for header, rows in formats.items():
+        _, version, code = HEADER.unpack(header)
+        if version != FORMAT_VERSION or code not in CODE_DTYPES:
+            raise EncodingFormatError(f'Unknown encoding format version {version} dtype {code}')
+        dtype = CODE_DTYPES[code]
+        width = HEADER.size + ENCODING_SIZE * dtype.itemsize
+
+        data = b''.join([blobs[row] for row in rows])
+        if len(data) != width * len(rows):
+            raise EncodingFormatError('Encoding has wrong length')
+        values = np.frombuffer(data, dtype=np.uint8).reshape(len(rows), width)[:, HEADER.size:]
+        matrix[rows] = np.ascontiguousarray(values).view(dtype)
+    return matrix
@@ -1,11 +1,15 @@
 import face_recognition
-import os, io
+import io
 import numpy as np
-import pickle
 import math
 import base64
-from PIL import Image
+from PIL import Image, ImageOps
 import logging
+from gallery import FaceGallery, MATCH_TOLERANCE
+from encoding_format import unpack_encodings
+from face_tracking import StreamRecognizer, view_frame
+from probe_cache import probe_key
+import metrics
 
 
 logging.basicConfig(filename='LogFile',
@@ -27,8 +31,116 @@ def face_confidence(face_distance, face_match_threshold=0.6):
         return round(value, 3)
 
 
+def decode_image(source, max_size=None) -> np.ndarray:
+    '''
+        Decode image file or buffer straight to RGB array, without temporary files.
+        The image is rotated according to its EXIF orientation.
+        max_size - let the JPEG decoder downscale the image (by 1/2, 1/4 or 1/8)
+                   while both its sides stay at least max_size
+    '''
+    with Image.open(source) as img:
+        if max_size and img.format == 'JPEG':
+            img.draft('RGB', (max_size, max_size))
+        img = ImageOps.exif_transpose(img)
+        return np.asarray(img.convert('RGB'))
+
+
+# Face detection settings
+#   detect_size - detect faces on a copy downscaled to this longest side, 0 - on the full image
+#   upsample    - number_of_times_to_upsample of face_recognition.face_locations
+#   model       - 'hog' or 'cnn'
+#   max_faces   - keep only the biggest faces, 0 - keep all
+#   face_crop   - the image is already a face crop, the detection is skipped
+DETECTION_DEFAULTS = {'detect_size': 0, 'upsample': 1, 'model': 'hog', 'max_faces': 0, 'face_crop': False}
+# Bounds of the settings a request may ask for, only config.ini sections may change them
+#   max_upsample    - upsample of a request is lowered to it
+#   max_detect_size - detect_size of a request is lowered to it, 0 (the full image) too
+#   allow_cnn       - a request may choose the 'cnn' model
+DETECTION_LIMITS = {'max_upsample': 2, 'max_detect_size': 2048, 'allow_cnn': False}
+
+
+def as_bool(value) -> bool:
+    if isinstance(value, str):
+        return value.lower() in ('1', 'true', 'yes')
+    return bool(value)
+
+
+def detection_options(*overrides, request=None) -> dict:
+    '''
+        Detection settings: defaults updated by every dict of overrides in turn (config.ini sections),
+        then by the settings of the request, which are kept within DETECTION_LIMITS
+    '''
+    options = dict(DETECTION_DEFAULTS)
+    limits = dict(DETECTION_LIMITS)
+    for override in overrides:
+        for key, value in (override or {}).items():
+            if key in DETECTION_LIMITS:
+                limits[key] = value
+            elif key in DETECTION_DEFAULTS:
+                options[key] = value
+            else:
+                raise ValueError(f'Unknown detection option {key}')
+
+    request = request or {}
+    if not isinstance(request, dict):
+        raise ValueError('Detection options must be a dict')
+    for key, value in request.items():
+        if key not in DETECTION_DEFAULTS:
+            raise ValueError(f'Unknown detection option {key}')
+        options[key] = value
+
+    try:
+        options['detect_size'] = int(options['detect_size'])
+        options['upsample'] = int(options['upsample'])
+        options['max_faces'] = int(options['max_faces'])
+        max_upsample = int(limits['max_upsample'])
+        max_detect_size = int(limits['max_detect_size'])
+    except (TypeError, ValueError):
+        raise ValueError('Detection options detect_size, upsample and max_faces must be integers')
+    options['face_crop'] = as_bool(options['face_crop'])
+    if options['model'] not in ('hog', 'cnn') or min(options['detect_size'], options['upsample'], options['max_faces']) < 0:
+        raise ValueError('Incorrect detection options')
+
+    if request.get('model') == 'cnn' and not as_bool(limits['allow_cnn']):
+        raise ValueError('Detection model cnn is not allowed')
+    if 'upsample' in request:
+        options['upsample'] = min(options['upsample'], max_upsample)
+    if 'detect_size' in request and max_detect_size:
+        options['detect_size'] = min(options['detect_size'] or max_detect_size, max_detect_size)
+    return options
+
+
+def detect_faces(face_image: np.ndarray, options: dict = None) -> list:
+    '''
+        Face locations (top, right, bottom, left) on the full resolution image
+    '''
+    options = options or DETECTION_DEFAULTS
+    height, width = face_image.shape[:2]
+
+    if options['face_crop']:
+        return [(0, width, height, 0)]
+
+    scale = 1.0
+    detect_image = face_image
+    if options['detect_size'] and max(height, width) > options['detect_size']:
+        scale = options['detect_size'] / max(height, width)
+        size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        detect_image = np.asarray(Image.fromarray(face_image).resize(size, Image.BILINEAR))
+
+    face_locations = face_recognition.face_locations(detect_image, number_of_times_to_upsample=options['upsample'],
+                                                     model=options['model'])
+    if scale != 1.0:
+        face_locations = [(max(0, int(top / scale)), min(width, int(math.ceil(right / scale))),
+                           min(height, int(math.ceil(bottom / scale))), max(0, int(left / scale)))
+                          for top, right, bottom, left in face_locations]
+
+    if options['max_faces'] and len(face_locations) > options['max_faces']:
+        face_locations = sorted(face_locations, key=lambda loc: (loc[2] - loc[0]) * (loc[1] - loc[3]), reverse=True)
+        face_locations = face_locations[:options['max_faces']]
+    return face_locations
+
+
 class FaceRecognition:
-    FACE_PATH = r'.\faces'
     face_locations = []
     face_encodings = []
     face_names = []
@@ -37,19 +149,15 @@ class FaceRecognition:
     known_face_ids = []
     process_current_frame = True
 
-    def __init__(self):
-        self.__create_foldes()
+    def __init__(self, decode_max_size=None, probe_cache=None):
+        # JPEG images bigger than decode_max_size are downscaled while decoding
+        self.decode_max_size = decode_max_size
+        # ProbeCache for repeated images, the server keeps its own cache in front of the worker pool
+        self.probe_cache = probe_cache
 
 
-    def __create_foldes(self):
-        if not os.path.exists(self.FACE_PATH):
-            os.makedirs(self.FACE_PATH)
-
     def transform_encoding_to_array(encodings : list) -> list:
-        array_encodings = []
-        for encoding in encodings:
-            array_encodings.append(pickle.loads(encoding))
-        return array_encodings
+        return list(unpack_encodings(encodings))
 
 
     def encoding_face_img(self, face_img, img_type='BASE64'):
@@ -57,115 +165,201 @@ class FaceRecognition:
         """
             The function accepts two types of images: BASE64 and PATH
         """
-        if img_type == 'BASE64':
-            img = base64.b64decode(face_img)
-            img = Image.open(io.BytesIO(img))
-            try:
-                img_path = os.path.join(self.FACE_PATH, 'img.jpg')
-                img.save(img_path)
-            except:
-                img_path = os.path.join(self.FACE_PATH, 'img.png')
-                img.save(img_path)
-
-        elif img_type == 'PATH':
-            img_path = face_img
-
-        else:
-            # when the type is not BASE64 and PATH
+        key = self.cache_key(face_img, img_type, 'encode_image')
+        cached = self.probe_cache.get(key) if key else None
+        if cached is not None:
+            return cached[0]
+
+        face_image = self.get_image(face_img, img_type)
+        if face_image is False:
+            # when the type is not BASE64, BYTES and PATH
             return False
-        
-        face_image = face_recognition.load_image_file(img_path)
 
         try:
-            face_encoding = face_recognition.face_encodings(face_image)[0]
+            with metrics.stage('encoding'):
+                face_encoding = face_recognition.face_encodings(face_image)[0]
         except IndexError:
-            print('Encoding is failed. No face on the image')
             logging.error('Encoding is failed. No face on the image.')
             face_encoding = None
 
-        if img_type != 'PATH':
-            os.remove(img_path)
         logging.info('Image encoded')
+        if key:
+            self.probe_cache.put(key, (face_encoding,))
         return face_encoding
+
+
+    def cache_key(self, img, img_type, *options):
+        '''
+            Key of the image in probe_cache, None when there is no cache or the image is a path
+        '''
+        if self.probe_cache is None or img_type not in ('BASE64', 'BYTES'):
+            return None
+        return probe_key(base64.b64decode(img) if img_type == 'BASE64' else bytes(img), list(options))
     
 
 
     def get_image(self, face_img, img_type='BASE64'):
         """
-            The function accepts two types of images: BASE64 and PATH
+            The function accepts three types of images: BASE64, BYTES (already decoded file bytes) and PATH
         """
         if img_type == 'BASE64':
-            img = base64.b64decode(face_img)
-            img = Image.open(io.BytesIO(img))
-            try:
-                img_path = os.path.join(self.FACE_PATH, 'img.jpg')
-                img.save(img_path)
-            except:
-                img_path = os.path.join(self.FACE_PATH, 'img.png')
-                img.save(img_path)
+            source = io.BytesIO(base64.b64decode(face_img))
+
+        elif img_type == 'BYTES':
+            source = io.BytesIO(face_img)
 
         elif img_type == 'PATH':
-            img_path = face_img
+            source = face_img
 
         else:
             # when the type is not BASE64 and PATH
             return False
-        face_image = face_recognition.load_image_file(img_path)
+        with metrics.stage('decode'):
+            return decode_image(source, self.decode_max_size)
 
-        if img_type != 'PATH':
-            os.remove(img_path)
-        return face_image
 
-
-    def face_recognizer(self, encodings:list, user_ids:list, user_infos:list, img, img_type='BASE64', threshold=0.9):
+    def face_recognizer(self, gallery: FaceGallery, img, img_type='BASE64', threshold=0.9, top_k=1, nprobe=None, detection=None):
         '''
             return (flag, msg)
+            With top_k = 1 msg is a list with one best match per face,
+            with top_k > 1 msg is a list with up to top_k matches per face.
+            nprobe - number of index clusters to scan when the gallery has an ANN index.
+            detection - detection settings, see detection_options
         '''
-        face_image = self.get_image(img, img_type)
-
-        face_locations = face_recognition.face_locations(face_image)
-        face_encodings = face_recognition.face_encodings(face_image=face_image, known_face_locations=face_locations)
-        recognition_res = []
-
-        for face_encoding in face_encodings:
-            data_confidence = {}
-
-            # Calculate the shortest distance to face
-            face_distances = face_recognition.face_distance(encodings, face_encoding)
-            matches = face_recognition.compare_faces(encodings, face_encoding)
-            best_match_index = np.argmin(face_distances)
-
-            # for i in range(0, 5):
-            #     data = {}
-            #     best_match_index = np.argmin(face_distances)
-            #     if matches[best_match_index]: 
-            #         data['id'] = user_ids[best_match_index]
-            #         data['conf'] = face_confidence(face_distances[best_match_index])
-            #         data['info'] = user_infos[best_match_index]
-            #         face_distances[best_match_index] = 1
-            #         data_confidence.append(data)
-            # recognition_res.append(data_confidence)
-            
-            confidenve = face_confidence(face_distances[best_match_index])
-
-            if matches[best_match_index] and confidenve > (threshold*100):
-                data_confidence['id'] = user_ids[best_match_index]
-                data_confidence['conf'] = confidenve
-                data_confidence['info'] = user_infos[best_match_index]
-                recognition_res.append(data_confidence)
+        face_locations, face_encodings = self.detect_and_encode(img, img_type, detection)
+        recognition_res = self.match_faces(gallery, face_encodings, threshold, top_k, nprobe)
 
         if recognition_res:
-            # print('------RESULT------')
-            # print(f'Ok. {recognition_res}')
-            # print('------END------')
             logging.info(f'Face recognition result = {recognition_res}')
             return True, recognition_res
         else:
-            # print(f'Face recognition is failed. No matched faces.')
             logging.warning('Face recognition is failed. No matched faces.')
             return False, 'Face recognition is failed. No matched faces.'
 
 
+    def detect_and_encode(self, img, img_type='BASE64', detection=None):
+        '''
+            return (face_locations, face_encodings) of all faces on the image
+            detection - detection settings, see detection_options
+        '''
+        key = self.cache_key(img, img_type, 'detect_faces', detection)
+        cached = self.probe_cache.get(key) if key else None
+        if cached is not None:
+            return cached[0]
+
+        face_locations, face_encodings = self.detect_image(self.get_image(img, img_type), detection)
+        if key:
+            self.probe_cache.put(key, ((face_locations, face_encodings),))
+        return face_locations, face_encodings
+
+
+    def detect_image(self, face_image, detection=None):
+        '''
+            (face_locations, face_encodings) of all faces on the decoded image
+        '''
+        with metrics.stage('detection'):
+            face_locations = detect_faces(face_image, detection)
+        with metrics.stage('encoding'):
+            face_encodings = face_recognition.face_encodings(face_image=face_image, known_face_locations=face_locations)
+        return face_locations, face_encodings
+
+
+    def read_stream_frame(self, frame, img_type, previous, force, scene_threshold, detection=None):
+        '''
+            view_frame of a stream frame: the frame is decoded once for the keyframe test,
+            the detection and the tracking copy
+        '''
+        face_image = frame if isinstance(frame, np.ndarray) else self.get_image(frame, img_type)
+        return view_frame(face_image, previous, force, scene_threshold, lambda image: self.detect_image(image, detection))
+
+
+    def recognize_stream(self, gallery: FaceGallery, frames, img_type='BASE64', threshold=0.9, top_k=1, nprobe=None,
+                         detection=None, keyframe_interval=5, scene_threshold=12.0):
+        '''
+            Generator of results for a sequence of frames of one camera, see StreamRecognizer.
+            Frames are RGB arrays or images of img_type.
+        '''
+        def read(frame, previous, force, scene_threshold):
+            return self.read_stream_frame(frame, img_type, previous, force, scene_threshold, detection)
+
+        def match(face_encodings):
+            return self.match_each_face(gallery, face_encodings, threshold, top_k, nprobe)
+
+        stream = StreamRecognizer(read, match, keyframe_interval=keyframe_interval, scene_threshold=scene_threshold)
+        return stream.recognize(frames)
+
+
+    def match_faces(self, gallery: FaceGallery, face_encodings, threshold=0.9, top_k=1, nprobe=None) -> list:
+        '''
+            Match all probe encodings against the gallery in one pass,
+            return results of matched faces only
+        '''
+        return [res for res in self.match_each_face(gallery, face_encodings, threshold, top_k, nprobe) if res]
+
+
+    def match_each_face(self, gallery: FaceGallery, face_encodings, threshold=0.9, top_k=1, nprobe=None) -> list:
+        '''
+            Match all probe encodings against the gallery in one pass,
+            return result for every probe encoding, None when the face is not matched
+        '''
+        recognition_res = []
+        if len(face_encodings) == 0:
+            return recognition_res
+
+        # Calculate the shortest distances to faces
+        best_indices, best_distances = gallery.search(face_encodings, k=top_k, nprobe=nprobe)
+
+        for face_indices, face_distances in zip(best_indices, best_distances):
+            data_confidence = self.confident_matches(gallery, face_indices, face_distances, threshold)
+
+            if not data_confidence:
+                recognition_res.append(None)
+            else:
+                recognition_res.append(data_confidence[0] if top_k == 1 else data_confidence)
+        return recognition_res
+
+
+    def match_groups(self, galleries: dict, face_encodings, threshold=0.9, top_k=1, nprobe=None, combined=None) -> list:
+        '''
+            Match all probe encodings against every gallery of {gid: gallery}.
+            combined - CombinedGallery with all the galleries, then their rows are scanned in one pass
+            return list of matches {'face': probe number, 'gid', 'id', 'conf', 'info'},
+                   up to top_k matches of every group for every face
+        '''
+        if len(face_encodings) == 0:
+            return []
+
+        if combined is not None:
+            found = zip(galleries, galleries.values(), combined.search_groups(list(galleries), face_encodings, k=top_k))
+        else:
+            found = ((gid, gallery, gallery.search(face_encodings, k=top_k, nprobe=nprobe)) for gid, gallery in galleries.items())
+
+        recognition_res = []
+        for gid, gallery, (best_indices, best_distances) in found:
+            for face, (face_indices, face_distances) in enumerate(zip(best_indices, best_distances)):
+                for match in self.confident_matches(gallery, face_indices, face_distances, threshold):
+                    recognition_res.append({'face': face, 'gid': gid, **match})
+        recognition_res.sort(key=lambda match: (match['face'], -match['conf']))
+        return recognition_res
+
+
+    @staticmethod
+    def confident_matches(gallery: FaceGallery, face_indices, face_distances, threshold) -> list:
+        '''
+            Matches of one probe with confidence above threshold, in the order of distances
+        '''
+        data_confidence = []
+        for index, distance in zip(face_indices, face_distances):
+            if index < 0 or distance > MATCH_TOLERANCE:
+                continue
+            confidence = face_confidence(float(distance))
+            if confidence > (threshold*100):
+                data_confidence.append({'id': gallery.ids[index],
+                                        'conf': confidence,
+                                        'info': gallery.infos[index]})
+        return data_confidence
+
+
 if __name__ == '__main__':
     fr = FaceRecognition()
     print(fr.encoding_face_img(face_img='829619c2-09b0-11ee-a87c-2811a80d8c79.jpg', img_type='PATH'))
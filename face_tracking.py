@@ -0,0 +1,224 @@
+import contextlib
+import itertools
+import numpy as np
+from PIL import Image
+
+try:
+    import dlib
+except ImportError:
+    # without dlib faces keep their keyframe location until the next keyframe
+    dlib = None
+
+
+THUMBNAIL_SIZE = (32, 32)
+# longest side of the frame copy the correlation trackers follow faces on
+TRACK_SIZE = 480
+
+
+def iou(a, b) -> float:
+    '''
+        Intersection over union of two (top, right, bottom, left) boxes
+    '''
+    top, right = max(a[0], b[0]), min(a[1], b[1])
+    bottom, left = min(a[2], b[2]), max(a[3], b[3])
+    intersection = max(0, right - left) * max(0, bottom - top)
+    union = (a[1] - a[3]) * (a[2] - a[0]) + (b[1] - b[3]) * (b[2] - b[0]) - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+def thumbnail(image: np.ndarray) -> np.ndarray:
+    '''
+        Small grayscale copy of the frame for scene change detection
+    '''
+    return np.asarray(Image.fromarray(image).convert('L').resize(THUMBNAIL_SIZE, Image.BILINEAR), dtype=np.float32)
+
+
+def scene_changed(previous, current, scene_threshold) -> bool:
+    if previous is None or previous.shape != current.shape:
+        return True
+    return float(np.abs(current - previous).mean()) > scene_threshold
+
+
+def tracking_image(image: np.ndarray, track_size=TRACK_SIZE):
+    '''
+        Copy of the frame for the correlation trackers, its longest side is at most track_size.
+        return (image, scale of the copy to the frame)
+    '''
+    height, width = image.shape[:2]
+    scale = min(1.0, track_size / max(height, width))
+    if scale == 1.0:
+        return image, scale
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return np.asarray(Image.fromarray(image).resize(size, Image.BILINEAR)), scale
+
+
+def view_frame(image: np.ndarray, previous, force, scene_threshold, analyze, track_size=TRACK_SIZE):
+    '''
+        All a stream needs from a decoded frame, so the frame is decoded once and
+        only small arrays leave the process which decoded it.
+        previous - thumbnail of the previous frame, force - the keyframe interval has passed
+        analyze(image) - (face_locations, face_encodings), it runs on keyframes only
+        return (thumbnail, detections, tracking image, scale): detections are None when the frame
+        is not a keyframe, the tracking image is None without dlib
+    '''
+    current = thumbnail(image)
+    detections = analyze(image) if force or scene_changed(previous, current, scene_threshold) else None
+    if dlib is None:
+        return current, detections, None, 1.0
+    small, scale = tracking_image(image, track_size)
+    return current, detections, small, scale
+
+
+class Track:
+    '''
+        One face followed between frames, its match is reused until the track is lost
+    '''
+    ids = itertools.count(1)
+
+    def __init__(self, location):
+        self.id = next(self.ids)
+        self.location = location
+        self.match = None
+        self.identified = False
+        # keyframes in a row without a detection of the face
+        self.lost = 0
+        self.correlation = None
+
+
+    def start_correlation(self, image, scale=1.0):
+        '''
+            image - the frame scaled by scale, locations stay in frame coordinates
+        '''
+        if dlib is not None and image is not None:
+            top, right, bottom, left = (value * scale for value in self.location)
+            self.correlation = dlib.correlation_tracker()
+            self.correlation.start_track(image, dlib.rectangle(int(left), int(top), int(right), int(bottom)))
+
+
+    def follow(self, image, scale, min_psr) -> bool:
+        '''
+            Move the track to the face position on the next frame.
+            return False when the correlation tracker lost the face
+        '''
+        if self.correlation is None or image is None:
+            return True
+        if self.correlation.update(image) < min_psr:
+            return False
+        position = self.correlation.get_position()
+        height, width = (size / scale for size in image.shape[:2])
+        self.location = (max(0, int(position.top() / scale)), min(int(width), int(position.right() / scale)),
+                         min(int(height), int(position.bottom() / scale)), max(0, int(position.left() / scale)))
+        return True
+
+
+class StreamRecognizer:
+    '''
+        Recognition of a sequence of frames from one camera.
+        Faces are detected and encoded only on keyframes: every keyframe_interval frames
+        or when the scene changes. Between keyframes faces are followed by correlation trackers
+        (dlib) or keep their location. Detected faces are matched to tracks by IoU,
+        only new and not yet identified tracks are matched against the gallery.
+
+        read(frame, previous, force, scene_threshold) - view_frame of the decoded frame,
+            it may run in another process
+        match(encodings) - result for every encoding, None when the face is not matched
+        guard() - context of the tracker work done in the calling thread, e.g. a pool slot
+    '''
+
+    def __init__(self, read, match, keyframe_interval=5, scene_threshold=12.0,
+                 iou_threshold=0.3, max_lost=1, min_psr=7.0, guard=contextlib.nullcontext):
+        self.read = read
+        self.match = match
+        self.guard = guard
+        self.keyframe_interval = keyframe_interval
+        # mean absolute difference of grayscale thumbnails (0-255) which starts a keyframe
+        self.scene_threshold = scene_threshold
+        self.iou_threshold = iou_threshold
+        self.max_lost = max_lost
+        self.min_psr = min_psr
+        self.tracks = []
+        self.frame_index = -1
+        self.last_keyframe = None
+        self.last_thumbnail = None
+
+
+    def process(self, frame) -> dict:
+        '''
+            return {'frame': index, 'keyframe': bool, 'data': [{'track', 'location', 'match'}, ...]}
+        '''
+        self.frame_index += 1
+        force = self.last_keyframe is None or self.frame_index - self.last_keyframe >= self.keyframe_interval
+        current, detections, image, scale = self.read(frame, self.last_thumbnail, force, self.scene_threshold)
+
+        keyframe = detections is not None
+        if keyframe:
+            self.last_keyframe = self.frame_index
+            self.keyframe(detections, image, scale)
+        elif image is not None:
+            with self.guard():
+                self.tracks = [track for track in self.tracks if track.follow(image, scale, self.min_psr)]
+        self.last_thumbnail = current
+
+        return {
+            'frame': self.frame_index,
+            'keyframe': keyframe,
+            'data': [{'track': track.id, 'location': [int(value) for value in track.location], 'match': track.match}
+                     for track in self.tracks if track.lost == 0]
+        }
+
+
+    def recognize(self, frames):
+        '''
+            Generator of process() results for every frame
+        '''
+        for frame in frames:
+            yield self.process(frame)
+
+
+    def keyframe(self, detections, image, scale) -> None:
+        locations, encodings = detections
+        tracks = self.associate(locations)
+
+        to_match = [i for i, track in enumerate(tracks) if not track.identified]
+        if to_match:
+            matches = self.match([encodings[i] for i in to_match])
+            for i, match in zip(to_match, matches):
+                tracks[i].match = match
+                tracks[i].identified = match is not None
+
+        if image is not None:
+            with self.guard():
+                for track in tracks:
+                    track.start_correlation(image, scale)
+
+
+    def associate(self, locations) -> list:
+        '''
+            Tracks of the detected faces in the order of locations, greedy by the best IoU.
+            Tracks without a detection are dropped after max_lost keyframes.
+        '''
+        pairs = sorted(((iou(track.location, location), t, l) for t, track in enumerate(self.tracks)
+                        for l, location in enumerate(locations)), reverse=True)
+        assigned = [None] * len(locations)
+        used = set()
+        for overlap, t, l in pairs:
+            if overlap < self.iou_threshold:
+                break
+            if t in used or assigned[l] is not None:
+                continue
+            used.add(t)
+            assigned[l] = self.tracks[t]
+
+        for t, track in enumerate(self.tracks):
+            if t not in used:
+                track.lost += 1
+
+        for l, location in enumerate(locations):
+            if assigned[l] is None:
+                assigned[l] = Track(location)
+            else:
+                assigned[l].location = location
+                assigned[l].lost = 0
+        kept = [track for t, track in enumerate(self.tracks) if t not in used and track.lost <= self.max_lost]
+        self.tracks = assigned + kept
+        return assigned
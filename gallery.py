@@ -0,0 +1,601 @@
+import mmap
+import threading
+import numpy as np
+
+
+ENCODING_SIZE = 128
+# Same tolerance as face_recognition.compare_faces uses by default
+MATCH_TOLERANCE = 0.6
+# Precision of the matrix scanned by the exact search, candidates are always checked in full precision
+PRECISIONS = ('float32', 'int8')
+
+
+def is_mapped(array) -> bool:
+    '''
+        The array is a view of a memory-mapped file
+    '''
+    while array is not None:
+        if isinstance(array, (np.memmap, mmap.mmap)):
+            return True
+        array = getattr(array, 'base', None)
+    return False
+
+
+class FaceGallery:
+    '''
+        Face encodings of one group.
+        Encodings are kept in one contiguous float32 matrix (N x 128),
+        user ids and infos are kept in lists aligned with the matrix rows.
+    '''
+
+    # candidates per requested match taken from a reduced precision scan to the full precision check
+    QUANTIZED_RERANK = 8
+
+    def __init__(self, ids=None, infos=None, encodings=None, precision='float32'):
+        self.ids = list(ids) if ids is not None else []
+        self.infos = list(infos) if infos is not None else []
+
+        if encodings is None or len(encodings) == 0:
+            matrix = np.empty((0, ENCODING_SIZE), dtype=np.float32)
+        else:
+            matrix = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        # matrix is a view of the first N rows of the buffer, upsert appends rows into the spare capacity
+        self.buffer = np.ascontiguousarray(matrix)
+        self.matrix = self.buffer[:len(self.buffer)]
+
+        if not (len(self.ids) == len(self.infos) == len(self.matrix)):
+            raise ValueError('Gallery ids, infos and encodings must have the same length.')
+        self.sq_norms = np.einsum('ij,ij->i', self.matrix, self.matrix)
+        self.index = None
+        self.positions = {uid: row for row, uid in enumerate(self.ids)}
+        # number of upserts, copies of the gallery compare it to see they are outdated
+        self.revision = 0
+        # search and upsert of the same gallery may run in different server threads
+        self.lock = threading.RLock()
+        self.quantized = None
+        self.set_precision(precision)
+
+
+    def __len__(self):
+        return len(self.ids)
+
+
+    @property
+    def nbytes(self) -> int:
+        '''
+            Memory taken by the gallery, a memory-mapped matrix is not counted
+        '''
+        nbytes = self.sq_norms.nbytes
+        if not is_mapped(self.buffer):
+            nbytes += self.buffer.nbytes
+        if self.index is not None:
+            nbytes += self.index.nbytes
+        if self.quantized is not None:
+            nbytes += self.quantized.nbytes
+        return nbytes
+
+
+    def set_precision(self, precision: str) -> None:
+        '''
+            Scan the gallery in float32 or int8.
+            The int8 copy is scanned first, the best candidates are checked
+            on the full precision matrix, so returned distances do not change.
+            It saves memory when the full precision matrix is memory-mapped (see map_matrix).
+        '''
+        if precision not in PRECISIONS:
+            raise ValueError(f'Unknown gallery precision {precision}')
+        with self.lock:
+            self.precision = precision
+            self.quantized = QuantizedMatrix(self.matrix, precision) if precision != 'float32' else None
+
+
+    def map_matrix(self, matrix, revision) -> bool:
+        '''
+            Use the memory-mapped snapshot of the matrix instead of the buffer in memory.
+            revision - gallery revision the snapshot was taken at, an outdated snapshot is not used
+            return True when the snapshot is used
+        '''
+        with self.lock:
+            if revision != self.revision or matrix.shape != self.matrix.shape:
+                return False
+            self.buffer = matrix
+            self.matrix = self.buffer[:len(self.buffer)]
+        return True
+
+
+    def build_index(self, nlist=None, nprobe=8):
+        '''
+            Build approximate nearest neighbour index.
+            After that search scans only nprobe clusters of the gallery.
+        '''
+        with self.lock:
+            self.index = IVFIndex(self.matrix, nlist=nlist, nprobe=nprobe)
+        return self.index
+
+
+    def upsert(self, ids, infos, encodings) -> int:
+        '''
+            Replace encodings and infos of known ids, append unknown ids.
+            return number of appended faces
+        '''
+        encodings = np.asarray(encodings, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        with self.lock:
+            replaced_rows, replaced = [], []
+            new_ids, new_infos, new_rows = [], [], []
+            for uid, info, encoding in zip(ids, infos, encodings):
+                row = self.positions.get(uid)
+                if row is None:
+                    self.positions[uid] = len(self.ids) + len(new_ids)
+                    new_ids.append(uid)
+                    new_infos.append(info)
+                    new_rows.append(encoding)
+                elif row >= len(self.ids):
+                    # the same uid twice in one upsert, the last one wins
+                    new_infos[row - len(self.ids)] = info
+                    new_rows[row - len(self.ids)] = encoding
+                else:
+                    self.infos[row] = info
+                    replaced_rows.append(row)
+                    replaced.append(encoding)
+
+            if replaced_rows:
+                self._replace_rows(np.array(replaced_rows), np.array(replaced))
+            if new_ids:
+                self._append_rows(new_ids, new_infos, np.array(new_rows))
+            self.revision += 1
+        return len(new_ids)
+
+
+    def _replace_rows(self, rows, encodings):
+        if not self.buffer.flags.writeable:
+            self.buffer = self.buffer.copy()
+            self.matrix = self.buffer[:len(self.matrix)]
+        self.matrix[rows] = encodings
+        self.sq_norms[rows] = np.einsum('ij,ij->i', encodings, encodings)
+        if self.index is not None:
+            self.index.reassign(rows, encodings)
+        if self.quantized is not None:
+            self.quantized.replace(rows, encodings)
+
+
+    def _append_rows(self, ids, infos, encodings):
+        size = len(self.matrix)
+        if size + len(encodings) > len(self.buffer) or not self.buffer.flags.writeable:
+            # grow the buffer twice, so appending faces one by one is still cheap
+            buffer = np.empty((max(2 * len(self.buffer), size + len(encodings)), ENCODING_SIZE), dtype=np.float32)
+            buffer[:size] = self.matrix
+            self.buffer = buffer
+        self.buffer[size:size + len(encodings)] = encodings
+        self.matrix = self.buffer[:size + len(encodings)]
+        self.sq_norms = np.concatenate([self.sq_norms, np.einsum('ij,ij->i', encodings, encodings)])
+        self.ids.extend(ids)
+        self.infos.extend(infos)
+        if self.index is not None:
+            self.index.add(encodings)
+        if self.quantized is not None:
+            self.quantized.append(encodings)
+
+
+    def distances(self, probes) -> np.ndarray:
+        '''
+            Euclidean distances between every probe and every gallery face.
+            return array P x N
+        '''
+        probes = np.asarray(probes, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        probe_norms = np.einsum('ij,ij->i', probes, probes)
+        sq_dist = probe_norms[:, None] + self.sq_norms[None, :] - 2.0 * (probes @ self.matrix.T)
+        np.maximum(sq_dist, 0, out=sq_dist)
+        return np.sqrt(sq_dist, out=sq_dist)
+
+
+    def search(self, probes, k=1, nprobe=None, exact=False):
+        '''
+            Find k nearest gallery faces for every probe encoding.
+            return (indices, distances), both arrays P x k sorted by distance.
+            Distances of the returned candidates are recomputed in float64,
+            so they are the same as face_recognition.face_distance gives.
+            When the gallery has an index and exact is False, the search is approximate
+            and rows the index could not fill are returned with index -1 and distance inf.
+        '''
+        probes = np.asarray(probes, dtype=np.float64).reshape(-1, ENCODING_SIZE)
+        if len(self) == 0 or len(probes) == 0:
+            empty = np.empty((len(probes), 0))
+            return empty.astype(np.intp), empty
+
+        with self.lock:
+            k = min(k, len(self))
+            if self.index is not None and not exact:
+                return self._search_index(probes, k, nprobe)
+
+            if self.quantized is not None:
+                keep = min(len(self), k * self.QUANTIZED_RERANK)
+                sq_dist = self.quantized.sq_distances(probes)
+                if keep < len(self):
+                    candidates = np.argpartition(sq_dist, keep - 1, axis=1)[:, :keep]
+                else:
+                    candidates = np.broadcast_to(np.arange(len(self)), sq_dist.shape)
+                indices, distances = self.rerank(probes, candidates)
+                return indices[:, :k], distances[:, :k]
+
+            dist = self.distances(probes)
+            if k < len(self):
+                candidates = np.argpartition(dist, k - 1, axis=1)[:, :k]
+            else:
+                candidates = np.broadcast_to(np.arange(len(self)), dist.shape)
+            return self.rerank(probes, candidates)
+
+
+    def rerank(self, probes, candidates):
+        '''
+            Exact float64 distances for candidate rows, sorted by distance.
+            candidates - array P x k of gallery row indices
+        '''
+        probes = np.asarray(probes, dtype=np.float64).reshape(-1, ENCODING_SIZE)
+        candidates = np.asarray(candidates, dtype=np.intp)
+        diff = self.matrix[candidates].astype(np.float64) - probes[:, None, :]
+        exact = np.linalg.norm(diff, axis=2)
+        order = np.argsort(exact, axis=1, kind='stable')
+        return np.take_along_axis(candidates, order, axis=1), np.take_along_axis(exact, order, axis=1)
+
+
+    def near_pairs(self, threshold, nprobe=None):
+        '''
+            Pairs of gallery rows not farther than threshold from each other.
+            return (pairs, distances): array M x 2 of rows (first < second) and their float64 distances.
+            Rows are joined list by list of the IVF index, a temporary one when the gallery has none:
+            rows of every list are compared with rows of its nprobe closest lists,
+            so the cost grows as N * nprobe * list size instead of N^2.
+        '''
+        with self.lock:
+            if len(self) < 2:
+                return np.empty((0, 2), dtype=np.intp), np.empty(0)
+            index = self.index if self.index is not None else IVFIndex(self.matrix)
+            # float32 distances are only a filter, the margin keeps pairs at the threshold for the exact check
+            limit = float(threshold) ** 2 + 1e-4
+            pairs = []
+            distances = []
+            for rows, candidates in index.list_joins(nprobe):
+                sq_dist = self.sq_norms[rows][:, None] + self.sq_norms[candidates][None, :] \
+                    - 2.0 * (self.matrix[rows] @ self.matrix[candidates].T)
+                first, second = np.nonzero((sq_dist <= limit) & (rows[:, None] < candidates[None, :]))
+                if len(first) == 0:
+                    continue
+                first, second = rows[first], candidates[second]
+                exact = np.linalg.norm(self.matrix[first].astype(np.float64) - self.matrix[second], axis=1)
+                close = exact <= threshold
+                pairs.append(np.stack([first[close], second[close]], axis=1))
+                distances.append(exact[close])
+
+        if not pairs:
+            return np.empty((0, 2), dtype=np.intp), np.empty(0)
+        # a pair of rows from two lists is found from both of them
+        pairs, unique = np.unique(np.concatenate(pairs), axis=0, return_index=True)
+        return pairs, np.concatenate(distances)[unique]
+
+
+    def _search_index(self, probes, k, nprobe=None):
+        indices = np.full((len(probes), k), -1, dtype=np.intp)
+        distances = np.full((len(probes), k), np.inf)
+
+        for i, candidates in enumerate(self.index.candidates(probes, nprobe)):
+            if len(candidates) == 0:
+                continue
+            probe = probes[i:i + 1].astype(np.float32)
+            diff = self.matrix[candidates] - probe
+            sq_dist = np.einsum('ij,ij->i', diff, diff)
+            # take a few more candidates than needed, the exact rerank sorts them out
+            keep = min(len(candidates), k * self.index.rerank)
+            if keep < len(candidates):
+                sq_dist_order = np.argpartition(sq_dist, keep - 1)[:keep]
+                candidates = candidates[sq_dist_order]
+            best, best_dist = self.rerank(probes[i:i + 1], candidates[None, :])
+            found = min(k, best.shape[1])
+            indices[i, :found] = best[0, :found]
+            distances[i, :found] = best_dist[0, :found]
+        return indices, distances
+
+
+class QuantizedMatrix:
+    '''
+        int8 copy of gallery encodings for the first scan of the exact search,
+        codes with per-dimension scale: value = code * scale[dimension].
+        Rows are converted to float32 by chunks of SCAN_CHUNK which stay in the CPU cache,
+        so the scan reads 4 times less memory than the float32 matrix.
+    '''
+    SCAN_CHUNK = 1024
+
+    def __init__(self, matrix, precision='int8'):
+        if precision != 'int8':
+            raise ValueError(f'Unknown quantized precision {precision}')
+        matrix = np.asarray(matrix, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        self.precision = precision
+        peak = np.abs(matrix).max(axis=0) if len(matrix) else np.ones(ENCODING_SIZE, dtype=np.float32)
+        # values of later added encodings beyond the range are clipped, the full precision check corrects them
+        self.scale = (np.maximum(peak, 1e-6) / 127).astype(np.float32)
+        # codes is a view of the first N rows of the buffer, like the gallery matrix
+        self.buffer = self._encode(matrix)
+        self.codes = self.buffer[:len(matrix)]
+        self.sq_norms = self._sq_norms(self.codes)
+
+
+    @property
+    def nbytes(self) -> int:
+        return self.buffer.nbytes + self.sq_norms.nbytes
+
+
+    def _encode(self, matrix) -> np.ndarray:
+        return np.clip(np.rint(matrix / self.scale), -127, 127).astype(np.int8)
+
+
+    def _decode(self, codes) -> np.ndarray:
+        return codes.astype(np.float32) * self.scale
+
+
+    def _sq_norms(self, codes) -> np.ndarray:
+        sq_norms = np.empty(len(codes), dtype=np.float32)
+        for start in range(0, len(codes), self.SCAN_CHUNK):
+            values = self._decode(codes[start:start + self.SCAN_CHUNK])
+            sq_norms[start:start + len(values)] = np.einsum('ij,ij->i', values, values)
+        return sq_norms
+
+
+    def replace(self, rows, matrix) -> None:
+        codes = self._encode(np.asarray(matrix, dtype=np.float32))
+        self.codes[rows] = codes
+        self.sq_norms[rows] = self._sq_norms(codes)
+
+
+    def append(self, matrix) -> None:
+        codes = self._encode(np.asarray(matrix, dtype=np.float32))
+        size = len(self.codes)
+        if size + len(codes) > len(self.buffer):
+            buffer = np.empty((max(2 * len(self.buffer), size + len(codes)), ENCODING_SIZE), dtype=self.buffer.dtype)
+            buffer[:size] = self.codes
+            self.buffer = buffer
+        self.buffer[size:size + len(codes)] = codes
+        self.codes = self.buffer[:size + len(codes)]
+        self.sq_norms = np.concatenate([self.sq_norms, self._sq_norms(codes)])
+
+
+    def sq_distances(self, probes, start=0, end=None) -> np.ndarray:
+        '''
+            Approximate squared distances between every probe and rows start:end (all rows by default),
+            without the probe norms, array P x (end - start)
+        '''
+        probes = np.asarray(probes, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        # probe . (code * scale) == (probe * scale) . code, codes are only cast
+        probes = probes * self.scale
+        end = len(self.codes) if end is None else end
+        sq_dist = np.empty((len(probes), end - start), dtype=np.float32)
+        chunk = np.empty((self.SCAN_CHUNK, ENCODING_SIZE), dtype=np.float32)
+        for row in range(start, end, self.SCAN_CHUNK):
+            codes = self.codes[row:min(row + self.SCAN_CHUNK, end)]
+            values = chunk[:len(codes)]
+            values[...] = codes
+            sq_dist[:, row - start:row - start + len(codes)] = self.sq_norms[row:row + len(codes)] - 2.0 * (probes @ values.T)
+        return sq_dist
+
+
+class CombinedGallery:
+    '''
+        Encodings of the cached groups of one merchant copied group after group into one matrix,
+        so probes are matched against several groups with one matrix product for every run of adjacent groups.
+        Rows of group gids[g] are offsets[g]:offsets[g + 1], only rows of the requested groups are scanned.
+        With the int8 precision only int8 codes are combined, candidates are checked on the group galleries.
+    '''
+
+    def __init__(self, galleries: dict, precision='float32'):
+        self.gids = list(galleries)
+        self.groups = {gid: g for g, gid in enumerate(self.gids)}
+        self.sources = []
+        parts = []
+        for gallery in galleries.values():
+            with gallery.lock:
+                self.sources.append((gallery, gallery.revision))
+                parts.append(np.array(gallery.matrix, dtype=np.float32))
+        matrix = np.concatenate(parts) if parts else np.empty((0, ENCODING_SIZE), dtype=np.float32)
+        self.offsets = np.cumsum([0] + [len(part) for part in parts])
+
+        if precision == 'float32':
+            self.matrix = matrix
+            self.sq_norms = np.einsum('ij,ij->i', matrix, matrix)
+            self.quantized = None
+        else:
+            self.matrix = self.sq_norms = None
+            self.quantized = QuantizedMatrix(matrix, precision)
+
+
+    def __len__(self):
+        return int(self.offsets[-1])
+
+
+    @property
+    def nbytes(self) -> int:
+        if self.quantized is not None:
+            return self.quantized.nbytes
+        return self.matrix.nbytes + self.sq_norms.nbytes
+
+
+    def is_current(self, galleries: dict) -> bool:
+        '''
+            True when all the galleries are combined here and none of them changed since
+        '''
+        for gid, gallery in galleries.items():
+            if gid not in self.groups:
+                return False
+            source, revision = self.sources[self.groups[gid]]
+            if gallery is not source or gallery.revision != revision:
+                return False
+        return True
+
+
+    def search_groups(self, gids, probes, k=1) -> list:
+        '''
+            Find k nearest faces of every group of gids for every probe encoding.
+            return list of (indices, distances) for every group, arrays P x k sorted by distance,
+            indices are rows of the group gallery
+        '''
+        probes = np.asarray(probes, dtype=np.float64).reshape(-1, ENCODING_SIZE)
+        positions = [self.groups[gid] for gid in gids]
+
+        # adjacent groups are scanned together: run of groups -> squared distances of its rows
+        scans = {}
+        runs = []
+        for g in sorted(set(positions)):
+            if runs and runs[-1][1] == g:
+                runs[-1][1] = g + 1
+            else:
+                runs.append([g, g + 1])
+        for first, last in runs:
+            sq_dist = self.sq_distances(probes, self.offsets[first], self.offsets[last])
+            for g in range(first, last):
+                scans[g] = (sq_dist, self.offsets[first])
+
+        results = []
+        for g in positions:
+            gallery = self.sources[g][0]
+            start, end = self.offsets[g], self.offsets[g + 1]
+            size = end - start
+            if size == 0 or len(probes) == 0:
+                empty = np.empty((len(probes), 0))
+                results.append((empty.astype(np.intp), empty))
+                continue
+            sq_dist, base = scans[g]
+            group_dist = sq_dist[:, start - base:end - base]
+            keep = min(size, k * FaceGallery.QUANTIZED_RERANK if self.quantized is not None else k)
+            if keep < size:
+                candidates = np.argpartition(group_dist, keep - 1, axis=1)[:, :keep]
+            else:
+                candidates = np.broadcast_to(np.arange(size), (len(probes), size))
+            with gallery.lock:
+                indices, distances = gallery.rerank(probes, candidates)
+            results.append((indices[:, :k], distances[:, :k]))
+        return results
+
+
+    def sq_distances(self, probes, start, end) -> np.ndarray:
+        '''
+            Squared distances without the probe norms between every probe and rows start:end, array P x (end - start)
+        '''
+        if self.quantized is not None:
+            return self.quantized.sq_distances(probes, start, end)
+        probes = np.asarray(probes, dtype=np.float32)
+        return self.sq_norms[start:end] - 2.0 * (probes @ self.matrix[start:end].T)
+
+
+class IVFIndex:
+    '''
+        Inverted file index.
+        Gallery rows are split by k-means into nlist clusters,
+        a query scans only rows of the nprobe closest clusters.
+        nprobe is the recall/latency knob: more clusters - better recall, slower search.
+    '''
+    # k-means is trained on at most nlist * TRAIN_PER_LIST rows
+    TRAIN_PER_LIST = 64
+    ASSIGN_CHUNK = 16384
+
+    def __init__(self, matrix, nlist=None, nprobe=8, rerank=4, iterations=10, seed=0):
+        matrix = np.asarray(matrix, dtype=np.float32)
+        if nlist is None:
+            nlist = int(np.sqrt(len(matrix)))
+        self.nlist = max(1, min(nlist, len(matrix)))
+        self.nprobe = nprobe
+        self.rerank = rerank
+
+        self.centroids = self._train(matrix, iterations, np.random.default_rng(seed))
+        self.assignments = self._assign(matrix)
+        self._build_lists()
+
+
+    @property
+    def nbytes(self) -> int:
+        return self.centroids.nbytes + self.assignments.nbytes + self.order.nbytes + self.offsets.nbytes
+
+
+    def candidates(self, probes, nprobe=None) -> list:
+        '''
+            Row indices of the gallery to scan for every probe
+        '''
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        dist = self._centroid_distances(np.asarray(probes, dtype=np.float32))
+        if nprobe < self.nlist:
+            closest = np.argpartition(dist, nprobe - 1, axis=1)[:, :nprobe]
+        else:
+            closest = np.broadcast_to(np.arange(self.nlist), dist.shape)
+
+        result = []
+        for lists in closest:
+            result.append(np.concatenate([self.list_rows(c) for c in lists]))
+        return result
+
+
+    def list_rows(self, c) -> np.ndarray:
+        return self.order[self.offsets[c]:self.offsets[c + 1]]
+
+
+    def list_joins(self, nprobe=None):
+        '''
+            Generator of (rows of a list, rows of its nprobe closest lists) for every non-empty list
+        '''
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        dist = self._centroid_distances(self.centroids)
+        if nprobe < self.nlist:
+            closest = np.argpartition(dist, nprobe - 1, axis=1)[:, :nprobe]
+        else:
+            closest = np.broadcast_to(np.arange(self.nlist), dist.shape)
+        for c in range(self.nlist):
+            rows = self.list_rows(c)
+            if len(rows):
+                yield rows, np.concatenate([self.list_rows(n) for n in closest[c]])
+
+
+    def add(self, matrix):
+        '''
+            Append new gallery rows to the index, centroids are not retrained
+        '''
+        self.assignments = np.concatenate([self.assignments, self._assign(matrix)])
+        self._build_lists()
+
+
+    def reassign(self, rows, matrix):
+        '''
+            Update clusters of gallery rows which encodings were replaced
+        '''
+        self.assignments[rows] = self._assign(matrix)
+        self._build_lists()
+
+
+    def _build_lists(self):
+        self.order = np.argsort(self.assignments, kind='stable')
+        counts = np.bincount(self.assignments, minlength=self.nlist)
+        self.offsets = np.concatenate([[0], np.cumsum(counts)])
+
+
+    def _centroid_distances(self, vectors):
+        c_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+        return c_norms[None, :] - 2.0 * (vectors @ self.centroids.T)
+
+
+    def _assign(self, matrix):
+        matrix = np.asarray(matrix, dtype=np.float32).reshape(-1, ENCODING_SIZE)
+        assignments = np.empty(len(matrix), dtype=np.intp)
+        for start in range(0, len(matrix), self.ASSIGN_CHUNK):
+            chunk = matrix[start:start + self.ASSIGN_CHUNK]
+            assignments[start:start + len(chunk)] = np.argmin(self._centroid_distances(chunk), axis=1)
+        return assignments
+
+
+    def _train(self, matrix, iterations, rng):
+        sample_size = min(len(matrix), self.nlist * self.TRAIN_PER_LIST)
+        sample = matrix[np.sort(rng.choice(len(matrix), sample_size, replace=False))]
+        self.centroids = sample[rng.choice(sample_size, self.nlist, replace=False)].copy()
+
+        for _ in range(iterations):
+            labels = self._assign(sample)
+            counts = np.bincount(labels, minlength=self.nlist)
+            sums = np.stack([np.bincount(labels, weights=sample[:, d], minlength=self.nlist)
+                             for d in range(ENCODING_SIZE)], axis=1).astype(np.float32)
+            filled = counts > 0
+            # empty clusters keep their old centroid
+            self.centroids[filled] = sums[filled] / counts[filled, None]
+        return self.centroids
@@ -0,0 +1,123 @@
+import collections
+import datetime
+import heapq
+import itertools
+import logging
+import threading
+
+
+class GalleryCache:
+    '''
+        Cached group galleries by '{merid}_{gid}' key.
+        A gallery not used for time_delta is evicted,
+        least recently used galleries are evicted while all of them take more than max_bytes.
+        Entry: {'data': gallery, 'ex_time': last use, 'lenght': faces,
+                'version': max f_etime of the loaded rows, 'checked_time': last freshness check,
+                'loaded_time': when the whole group was read from database}
+        Expiry times are kept in a heap, so evict() only looks at the entries which may have expired.
+    '''
+
+    def __init__(self, max_bytes: int, time_delta: datetime.timedelta):
+        self.max_bytes = max_bytes
+        self.time_delta = time_delta
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        # (expiry time, sequence, key), an entry used after its item was pushed gets a new item when it comes up
+        self.expiry = []
+        self.sequence = itertools.count()
+        # key -> sequence of its current heap item
+        self.expiry_items = {}
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    def __contains__(self, key):
+        return key in self.entries
+
+
+    @property
+    def nbytes(self) -> int:
+        with self.lock:
+            return sum(entry['data'].nbytes for entry in self.entries.values())
+
+
+    def get(self, key):
+        now = datetime.datetime.now()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry['ex_time'] + self.time_delta < now:
+                self._remove(key)
+                logging.info(f'Gallery {key} expired')
+                entry = None
+            if entry is not None:
+                entry['ex_time'] = now
+                self.entries.move_to_end(key)
+            return entry
+
+
+    def peek(self, key):
+        '''
+            Entry without marking it as used
+        '''
+        with self.lock:
+            return self.entries.get(key)
+
+
+    def put(self, key, gallery, version, loaded_time=None):
+        now = datetime.datetime.now()
+        with self.lock:
+            self.entries[key] = {
+                'data': gallery,
+                'ex_time': now,
+                'lenght': len(gallery),
+                'version': version,
+                'checked_time': now,
+                'loaded_time': loaded_time or now
+            }
+            self.entries.move_to_end(key)
+            self._push_expiry(key, now + self.time_delta)
+        self.evict()
+
+
+    def pop(self, key):
+        with self.lock:
+            return self._remove(key)
+
+
+    def _remove(self, key):
+        self.expiry_items.pop(key, None)
+        return self.entries.pop(key, None)
+
+
+    def _push_expiry(self, key, expiry_time) -> None:
+        sequence = next(self.sequence)
+        self.expiry_items[key] = sequence
+        heapq.heappush(self.expiry, (expiry_time, sequence, key))
+
+
+    def evict(self) -> None:
+        '''
+            Remove expired galleries, then the least recently used ones while the cache is too big
+        '''
+        now = datetime.datetime.now()
+        with self.lock:
+            while self.expiry and self.expiry[0][0] < now:
+                _, sequence, key = heapq.heappop(self.expiry)
+                if self.expiry_items.get(key) != sequence:
+                    continue
+                expiry_time = self.entries[key]['ex_time'] + self.time_delta
+                if expiry_time < now:
+                    self._remove(key)
+                    logging.info(f'Gallery {key} expired')
+                else:
+                    self._push_expiry(key, expiry_time)
+
+            total = sum(entry['data'].nbytes for entry in self.entries.values())
+            # the most recently used gallery stays even if it alone is bigger than max_bytes
+            while total > self.max_bytes and len(self.entries) > 1:
+                key, entry = self.entries.popitem(last=False)
+                self.expiry_items.pop(key, None)
+                total -= entry['data'].nbytes
+                logging.info(f'Gallery {key} evicted, cache size {total} bytes')
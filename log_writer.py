@@ -0,0 +1,154 @@
+import base64
+import datetime
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+import metrics
+
+
+IMAGE_KEYS = ('img', 'imgs')
+
+
+def strip_images(body):
+    '''
+        Copy of the request body with every image replaced by its sha1 and size
+    '''
+    if isinstance(body, dict):
+        return {key: image_digest(value) if key in IMAGE_KEYS else strip_images(value) for key, value in body.items()}
+    if isinstance(body, list):
+        return [strip_images(value) for value in body]
+    return body
+
+
+def image_digest(image):
+    if isinstance(image, list):
+        return [image_digest(value) for value in image]
+    if isinstance(image, str):
+        image = image.encode('utf-8', 'replace')
+    if isinstance(image, (bytes, bytearray)):
+        return {'sha1': hashlib.sha1(image).hexdigest(), 'size': len(image)}
+    return image
+
+
+def json_default(value):
+    '''
+        Images decoded by the asyncio server are logged as base64 again
+    '''
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return base64.b64encode(value).decode('ascii')
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+class LogWriter:
+    '''
+        Request log written to vface_log by a background thread.
+        write() only puts the row into a bounded queue, the thread inserts
+        queued rows with one multi-row INSERT when batch_size rows are collected
+        or flush_interval seconds passed.
+        When the queue is full or the database fails, rows are appended to spill_path
+        as json lines and inserted on the next start.
+    '''
+
+    def __init__(self, db, queue_size=10000, batch_size=200, flush_interval=1.0, store_images=False, spill_path='LogSpill.jsonl'):
+        self.db = db
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # False - only sha1 and size of images are logged
+        self.store_images = store_images
+        self.spill_path = spill_path
+        self.spill_lock = threading.Lock()
+        self.thread = None
+        self.stopped = threading.Event()
+
+
+    def start(self):
+        self.replay_spill()
+        self.thread = threading.Thread(target=self._run, name='LogWriter', daemon=True)
+        self.thread.start()
+
+
+    def write(self, merid, api: str, status: int, requestdata, responsedata):
+        '''
+            requestdata - request body, serialized in the writer thread.
+            Images are replaced by their digests here, so the queue does not keep image data.
+            A body which was not parsed (raw bytes) is always logged as its digest
+        '''
+        if isinstance(requestdata, (bytes, bytearray)):
+            requestdata = image_digest(requestdata)
+        elif not self.store_images:
+            requestdata = strip_images(requestdata)
+        row = (merid, api, status, requestdata, responsedata, datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        try:
+            self.queue.put_nowait(row)
+        except queue.Full:
+            logging.warning('Log queue is full, the log row is spilled to file')
+            self._spill([self._serialize(row)])
+
+
+    def close(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+
+    def _run(self):
+        while not (self.stopped.is_set() and self.queue.empty()):
+            rows = []
+            deadline = datetime.datetime.now() + datetime.timedelta(seconds=self.flush_interval)
+            while len(rows) < self.batch_size:
+                timeout = (deadline - datetime.datetime.now()).total_seconds()
+                if timeout <= 0:
+                    break
+                try:
+                    rows.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            if rows:
+                self._flush([self._serialize(row) for row in rows])
+
+
+    def _serialize(self, row) -> tuple:
+        merid, api, status, requestdata, responsedata, time = row
+        if isinstance(requestdata, (bytes, bytearray)):
+            requestdata = requestdata.decode('utf-8', 'replace')
+        if not isinstance(requestdata, str):
+            requestdata = json.dumps(requestdata, default=json_default)
+        return merid, api, status, requestdata, responsedata, time
+
+
+    def _flush(self, rows):
+        try:
+            with metrics.stage('log_write'):
+                self.db.insert_logs(rows)
+        except Exception as e:
+            logging.error(f'Insert log {str(e)}, {len(rows)} log rows are spilled to file')
+            self._spill(rows)
+
+
+    def _spill(self, rows):
+        with self.spill_lock:
+            with open(self.spill_path, 'a', encoding='utf-8') as f:
+                for row in rows:
+                    f.write(json.dumps(row) + '\n')
+
+
+    def replay_spill(self):
+        '''
+            Insert log rows spilled by the previous run
+        '''
+        if not os.path.exists(self.spill_path):
+            return
+        replay_path = f'{self.spill_path}.replay'
+        with self.spill_lock:
+            os.replace(self.spill_path, replay_path)
+
+        with open(replay_path, encoding='utf-8') as f:
+            rows = [tuple(json.loads(line)) for line in f if line.strip()]
+        for start in range(0, len(rows), self.batch_size):
+            self._flush(rows[start:start + self.batch_size])
+        os.remove(replay_path)
+        logging.info(f'{len(rows)} spilled log rows replayed')
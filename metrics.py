@@ -0,0 +1,141 @@
+import bisect
+import contextlib
+import threading
+import time
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+FACES_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50)
+GROUP_BUCKETS = (10, 100, 1000, 10000, 100000, 1000000)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def format_labels(names, values, extra='') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        # a counter without labels is exported as 0 before the first inc()
+        self.values = {} if self.labels else {(): 0}
+        self.lock = threading.Lock()
+
+
+    def inc(self, amount=1, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f'{self.name}{format_labels(self.labels, key)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # labels -> [counts per bucket, sum, count]
+        self.values = {}
+        self.lock = threading.Lock()
+
+
+    def observe(self, value, **labels) -> None:
+        key = tuple(str(labels[name]) for name in self.labels)
+        with self.lock:
+            series = self.values.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            position = bisect.bisect_left(self.buckets, value)
+            if position < len(self.buckets):
+                series[0][position] += 1
+            series[1] += value
+            series[2] += 1
+
+
+    def render(self) -> list:
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(self.name + '_bucket' + format_labels(self.labels, key, 'le="%s"' % bound) + f' {cumulative}')
+                lines.append(self.name + '_bucket' + format_labels(self.labels, key, 'le="+Inf"') + f' {count}')
+                lines.append(f'{self.name}_sum{format_labels(self.labels, key)} {total}')
+                lines.append(f'{self.name}_count{format_labels(self.labels, key)} {count}')
+        return lines
+
+
+REQUEST_SECONDS = Histogram('face_request_seconds', 'Latency of handled post requests', ('path',))
+REQUESTS = Counter('face_requests_total', 'Handled post requests by result status code', ('path', 'status'))
+STAGE_SECONDS = Histogram('face_stage_seconds', 'Latency of request stages', ('stage',))
+GALLERY_CACHE = Counter('face_gallery_cache_total', 'Gallery lookups by result: hit, refresh or miss', ('result',))
+FACES_PER_IMAGE = Histogram('face_faces_per_image', 'Faces detected on a recognized image', buckets=FACES_BUCKETS)
+GROUP_SIZE = Histogram('face_group_size', 'Faces in the gallery a request is matched against', buckets=GROUP_BUCKETS)
+POOL_REJECTED = Counter('face_pool_rejected_total', 'Jobs rejected because the recognition queue was full')
+STREAM_FRAMES = Counter('face_stream_frames_total', 'Stream frames by kind: keyframe or tracked', ('kind',))
+PROBE_CACHE = Counter('face_probe_cache_total', 'Probe image lookups in the encoding cache by result: hit or miss', ('result',))
+ALL_METRICS = [REQUEST_SECONDS, REQUESTS, STAGE_SECONDS, GALLERY_CACHE, FACES_PER_IMAGE, GROUP_SIZE, POOL_REJECTED,
+               STREAM_FRAMES, PROBE_CACHE]
+
+
+# stage timings of the job running in this thread of a worker process
+_collected = threading.local()
+
+
+def observe_stage(name: str, seconds: float) -> None:
+    timings = getattr(_collected, 'timings', None)
+    if timings is not None:
+        timings.append((name, seconds))
+    else:
+        STAGE_SECONDS.observe(seconds, stage=name)
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    '''
+        with stage('decode'): ... - time the block as the request stage
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(name, time.perf_counter() - start)
+
+
+def collect(fn, *args):
+    '''
+        Run fn(*args) in a worker process, return (result, stage timings).
+        Metrics live in the server process, it records the timings with record()
+    '''
+    _collected.timings = []
+    try:
+        return fn(*args), _collected.timings
+    finally:
+        _collected.timings = None
+
+
+def record(timings) -> None:
+    for name, seconds in timings:
+        STAGE_SECONDS.observe(seconds, stage=name)
+
+
+def render() -> bytes:
+    '''
+        All metrics in Prometheus text format
+    '''
+    lines = []
+    for metric in ALL_METRICS:
+        lines.extend(metric.render())
+    return ('\n'.join(lines) + '\n').encode('utf-8')
@@ -0,0 +1,19 @@
+import argparse
+import configparser
+from db_requests import DataBaseRequests
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert pickled face encodings in vface_user to the binary format')
+    parser.add_argument('--dtype', choices=['float32', 'float16'], default=None,
+                        help='precision of converted encodings, encoding_dtype from config.ini by default')
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    config = configparser.ConfigParser()
+    config.read("config.ini", encoding='utf-8')
+    bd_config = config['MYSQL']
+
+    database = DataBaseRequests(host=bd_config['host'], user=bd_config['user'], pwd=bd_config['pwd'], database=bd_config['database'],
+                                encoding_dtype=args.dtype or bd_config.get('encoding_dtype', 'float32'))
+    print(f'{database.migrate_encodings(chunk_size=args.chunk_size)} encodings converted')
@@ -0,0 +1,87 @@
+import base64
+import collections
+import datetime
+import hashlib
+import json
+import threading
+import metrics
+
+
+def image_bytes(image) -> bytes:
+    '''
+        Image file bytes of a base64 string or of already decoded bytes
+    '''
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return bytes(image)
+    return base64.b64decode(image)
+
+
+def probe_key(data: bytes, options=None) -> bytes:
+    '''
+        Fast hash of the image file bytes and of the settings it was processed with
+    '''
+    key = hashlib.blake2b(data, digest_size=16)
+    key.update(json.dumps(options, sort_keys=True).encode('utf-8'))
+    return key.digest()
+
+
+class ProbeCache:
+    '''
+        Face locations and encodings of recently processed images, so a resent image
+        goes straight to matching. Least recently used entries are evicted over max_entries,
+        entries older than time_delta are not used.
+        The server looks up the cache before a job is sent to the worker pool,
+        so one cache serves all worker processes.
+    '''
+
+    def __init__(self, max_entries: int, time_delta: datetime.timedelta):
+        self.max_entries = max_entries
+        self.time_delta = time_delta
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+    def get(self, key: bytes):
+        '''
+            return cached value, None when there is no fresh value
+        '''
+        now = datetime.datetime.now()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] + self.time_delta < now:
+                del self.entries[key]
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+        metrics.PROBE_CACHE.inc(result='miss' if entry is None else 'hit')
+        return None if entry is None else entry[1]
+
+
+    def put(self, key: bytes, value) -> None:
+        if self.max_entries <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (datetime.datetime.now(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+    def clear(self) -> None:
+        with self.lock:
+            self.entries.clear()
@@ -1,11 +1,26 @@
-from http.server import HTTPServer, BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 from http import HTTPStatus
 import json
 from db_requests import DataBaseRequests
-from face_recognition_code import FaceRecognition
+from face_recognition_code import FaceRecognition, detection_options
+from gallery import FaceGallery, CombinedGallery, PRECISIONS
+from gallery_cache import GalleryCache
+from cache_scheduler import CacheScheduler, parse_groups
+from snapshot_store import SnapshotStore
+from log_writer import LogWriter
+from probe_cache import ProbeCache, image_bytes, probe_key
+from body_parser import content_length
+from face_tracking import StreamRecognizer
+from dedupe import DuplicateFace, enrolled_duplicates
+from workers import RecognitionPool, PoolBusy, encode_image, detect_faces, read_stream_frame
+import metrics
+import numpy as np
 import logging
 import configparser
 import datetime
+import threading
+import time
+import os
 
 config = configparser.ConfigParser()
 config.read("config.ini", encoding='utf-8')
@@ -19,173 +34,219 @@ logging.basicConfig(filename='LogFile',
 
 
 
-class HTTPRecognitionServer(BaseHTTPRequestHandler):
+class RecognitionService:
+    """
+        Request handling and shared state of the recognition server.
+        The state is kept in class attributes, so all front ends and threads share it.
+    """
 
-    fr = FaceRecognition()
-    data_cache = {}
+    fr = FaceRecognition(decode_max_size=config.getint('RECOGNITION', 'decode_max_size', fallback=0) or None)
     access_cache = {}
+    # Requests are handled in threads, access cache is changed under the lock
+    cache_lock = threading.Lock()
+    # Pool for face detection and encoding, created in start_server
+    pool = None
     # access_cache = {'admin': {'key': 123, 'merid': 1,'ex_time': now()}}
     # Lifetime of storing passwords in cache for fast connection
     pwd_time_delta = datetime.timedelta(days=1)
     # Lifetime of storing fase info in cache for fast connection
     time_delta = datetime.timedelta(hours=2)
+    data_cache = GalleryCache(max_bytes=config.getint('CACHE', 'max_mb', fallback=2048) * 1024 * 1024, time_delta=time_delta)
+    # Cached galleries are checked for changed users not more often than refresh_interval
+    refresh_interval = datetime.timedelta(seconds=config.getint('CACHE', 'refresh_interval', fallback=60))
+    # The check compares max f_etime and the number of faces, it misses users updated in the same second.
+    # Galleries read from database more than max_age ago are reloaded whole, 0 turns it off
+    max_age = datetime.timedelta(seconds=config.getint('CACHE', 'max_age', fallback=7200))
+    # Galleries are saved to snapshot_dir and memory-mapped from there on the next start
+    snapshots = SnapshotStore(config['CACHE']['snapshot_dir']) if config.get('CACHE', 'snapshot_dir', fallback='') else None
+    # Groups with at least ann_threshold faces are searched through an approximate index
+    ann_threshold = config.getint('RECOGNITION', 'ann_threshold', fallback=50000)
+    ann_nprobe = config.getint('RECOGNITION', 'ann_nprobe', fallback=8)
+    # Exact search scans a float32 or int8 copy of the gallery, candidates are checked in float32.
+    # int8 needs snapshot_dir: the float32 matrix is memory-mapped from the snapshot, not kept in memory
+    precision = config.get('RECOGNITION', 'precision', fallback='float32')
+    max_body_size = config.getint('SERVER', 'max_body_mb', fallback=32) * 1024 * 1024
+    # Locations and encodings of recently processed images by their content, shared by all workers
+    probe_cache = ProbeCache(max_entries=config.getint('PROBE_CACHE', 'size', fallback=4096),
+                             time_delta=datetime.timedelta(seconds=config.getint('PROBE_CACHE', 'ttl', fallback=300)))
+    # Groups of merchant-wide requests: merid -> {'gids': [...], 'ex_time'}, reloaded every refresh_interval
+    merchant_groups = {}
+    # Camera streams: '{merid}_{gid}_{stream}' -> {'recognizer': StreamRecognizer, 'lock', 'ex_time'}
+    streams = {}
+    stream_time_delta = datetime.timedelta(seconds=config.getint('STREAM', 'timeout', fallback=60))
+    keyframe_interval = config.getint('STREAM', 'keyframe_interval', fallback=5)
+    scene_threshold = config.getfloat('STREAM', 'scene_threshold', fallback=12.0)
     bd_config = config['MYSQL']
-    db = DataBaseRequests(host=bd_config['host'], user=bd_config['user'], pwd=bd_config['pwd'], database=bd_config['database'])
+    db = DataBaseRequests(host=bd_config['host'], user=bd_config['user'], pwd=bd_config['pwd'], database=bd_config['database'],
+                          encoding_dtype=bd_config.get('encoding_dtype', 'float32'), pool_size=bd_config.getint('pool_size', 8))
+    # Request log is written in the background, the writer is started in start_server
+    log_writer = LogWriter(db, queue_size=config.getint('LOG', 'queue_size', fallback=10000),
+                           batch_size=config.getint('LOG', 'batch_size', fallback=200),
+                           flush_interval=config.getfloat('LOG', 'flush_interval', fallback=1.0),
+                           store_images=config.getboolean('LOG', 'store_images', fallback=False),
+                           spill_path=config.get('LOG', 'spill_path', fallback='LogSpill.jsonl'))
+    # Background warm-up, refresh and expiry of cached data, created in start_services.
+    # Without it stale galleries are refreshed in the request path
+    scheduler = None
 
 
 
-    def _set_headers(self):
-        self.send_response(HTTPStatus.OK.value)
-        self.send_header('Content-type', 'application/json')
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.end_headers()
-
-
-    def send_msg(self, status_code, msg, data=None):
-        self._set_headers()
-        result = {'status_code': status_code, 'msg': msg}
-        if data:
-            result['data'] = data
-        self.wfile.write(json.dumps(result).encode('utf-8'))
-
-
-    def do_GET(self):
+    def process_post(self, path, body):
         """
-            Get get request function.
+            Handle post request body, shared by the threaded and the asyncio servers.
+            return (http_status, result), result is None when the path is unknown
         """
-        self._set_headers()
-        self.wfile.write(b'Hello!')
+        start = time.perf_counter()
+        http_status, result = self.route_post(path, body)
+        if result is not None:
+            metrics.REQUEST_SECONDS.observe(time.perf_counter() - start, path=path)
+            metrics.REQUESTS.inc(path=path, status=result['status_code'])
+        return http_status, result
 
 
-    def do_POST(self):
-        """
-            Get post request function.
-        """
-        print('-----START------')
-        print(f'Get post request time = {datetime.datetime.now()}')
+    def route_post(self, path, body):
+        merid = 0
         try:
-            if self.path == '/update':
-                print('I get update data request!')
-                self.check_request_body()
-                
-                merid = self.client_validation(self.body)
-                status = self.update_post(merid, self.body['data'])
+            if path == '/update':
+                merid = self.client_validation(body)
+                status = self.update_post(merid, body['data'])
 
                 if status == 'Failed':
                     raise Exception('Database request failed.')
                 else:
-                    self.db.insert_log(merid, self.path, 1, json.dumps(self.body), status)
-                    self.send_msg(200, status)
-
-            elif self.path == '/recognition':
-                print('I get data request for recognition!')
-                self.check_request_body()
-                print(f'Check time = {datetime.datetime.now()}')
-                merid = self.client_validation(self.body)
-                print(f'Validation time = {datetime.datetime.now()}')
-                result = self.recognition_post(merid, self.body['data'])
-                print(f'Recognition finished time = {datetime.datetime.now()}')
+                    self.log_writer.write(merid, path, 1, body, status)
+                    return HTTPStatus.OK, self.make_result(200, status)
+
+            elif path == '/update/batch':
+                merid = self.client_validation(body)
+                statuses = self.update_batch_post(merid, body['data'])
+                self.log_writer.write(merid, path, 1, body, json.dumps(statuses))
+                return HTTPStatus.OK, self.make_result(200, 'Ok', statuses)
+
+            elif path == '/recognition':
+                merid = self.client_validation(body)
+                result = self.recognition_post(merid, body['data'])
                 logging.info(json.dumps(result))
-                self.send_msg(200, 'Ok', result)
-                print(f'Send time = {datetime.datetime.now()}')
-                self.db.insert_log(merid, self.path, 1, json.dumps(self.body), json.dumps(result))
-
-            elif self.path == '/clear':
-                print('I get request to clean cache data!')
-                self.check_request_body()
-                merid = self.client_validation(self.body)
-                msg = self.clear_cache_post(merid, self.body['data'])
-                self.send_msg(200, 'Ok', msg)
-                self.db.insert_log(merid, self.path, 1, json.dumps(self.body), json.dumps(msg))
+                self.log_writer.write(merid, path, 1, body, json.dumps(result))
+                return HTTPStatus.OK, self.make_result(200, 'Ok', result)
+
+            elif path == '/recognition/batch':
+                merid = self.client_validation(body)
+                result = self.recognition_batch_post(merid, body['data'])
+                self.log_writer.write(merid, path, 1, body, json.dumps(result))
+                return HTTPStatus.OK, self.make_result(200, 'Ok', result)
+
+            elif path == '/recognition/stream':
+                merid = self.client_validation(body)
+                result = self.recognition_stream_post(merid, body['data'])
+                self.log_writer.write(merid, path, 1, body, json.dumps(result))
+                return HTTPStatus.OK, self.make_result(200, 'Ok', result)
+
+            elif path == '/clear':
+                merid = self.client_validation(body)
+                msg = self.clear_cache_post(merid, body['data'])
+                self.log_writer.write(merid, path, 1, body, json.dumps(msg))
+                return HTTPStatus.OK, self.make_result(200, 'Ok', msg)
 
             else:
-                self.send_error(404, 'The request path structure is incorrect.')
-            print(f'End time = {datetime.datetime.now()}')
-            
+                return HTTPStatus.NOT_FOUND, None
+
+        except PoolBusy as e:
+            self.log_writer.write(merid, path, 2, body, str(e))
+            return HTTPStatus.SERVICE_UNAVAILABLE, self.make_result(503, str(e))
+
+        except DuplicateFace as e:
+            self.log_writer.write(merid, path, 2, body, str(e))
+            return HTTPStatus.OK, self.make_result(409, str(e), {'duplicates': e.duplicates})
 
         except Exception as e:
-            if 'merid' not in locals():
-                merid = 0
-            self.db.insert_log(merid, self.path, 2, json.dumps(self.body), str(e))
-            self.send_msg(400, str(e))
+            self.log_writer.write(merid, path, 2, body, str(e))
+            return HTTPStatus.OK, self.make_result(400, str(e))
+
+
+    @staticmethod
+    def make_result(status_code, msg, data=None) -> dict:
+        result = {'status_code': status_code, 'msg': msg}
+        if data:
+            result['data'] = data
+        return result
 
 
 
     def clear_cache_post(self, merid, data):
         gid = data.get('gid')
         dataKey = f'{merid}_{gid}'
-        if gid and dataKey in self.data_cache.keys():
-            del self.data_cache[dataKey]
+        cleared = self.data_cache.pop(dataKey) if gid else None
+        # without its snapshot the group is reloaded from database, not from the snapshot and changes since
+        if gid and self.snapshots and self.snapshots.remove(dataKey):
+            cleared = True
+        if cleared:
             return f'Successfully cleared cache associated with group {gid}.'
         else:
             raise Exception('The request data structure is incorrect or the data cache does not have relevant data.')
 
 
-    def check_request_body(self):
-        accept = self.headers.get('Accept')
-        content_len = int(self.headers['Content-Length'])
-        self.body = self.rfile.read(content_len)
-        if 'application/json' or '*/*' in accept:
-            try:
-                self.body = json.loads(self.body)
-            except:
-                raise Exception('Only accept json request format.')
-        else:    
-            raise Exception('No correction request acceptance format.')
-        
-
-
     def client_validation(self, body):
-        api = body.get('api')
-        data = body.get('data')
+        with metrics.stage('validation'):
+            api = body.get('api')
+            data = body.get('data')
 
-        if api and data:
-            client = api.get('client')
-            key = api.get('key')
+            if api and data:
+                client = api.get('client')
+                key = api.get('key')
 
-            if client and key:
+                if client and key:
 
-                self.check_cache(self.access_cache, self.pwd_time_delta)
-                try:
+                    try:
                     
-                    access_data = self.access_cache.get(client)
-                    access_key = access_data.get('key')
-                    access_merid = access_data.get('merid')
+                        access_data = self.fresh_entry(self.access_cache, client, self.pwd_time_delta)
+                        access_key = access_data.get('key')
+                        access_merid = access_data.get('merid')
                     
-                    if access_key == key:
-                        return access_merid
-                    else:
-                        raise Exception('The key is wrong')
+                        if access_key == key:
+                            return access_merid
+                        else:
+                            raise Exception('The key is wrong')
 
-                except:
-                    # validate client through database
-                    merid = self.db.client_validation(client, key)
+                    except:
+                        # validate client through database
+                        merid = self.db.client_validation(client, key)
 
-                    if merid == -1:
-                        raise Exception('Database connection failed.')
+                        if merid == -1:
+                            raise Exception('Database connection failed.')
                     
-                    elif not merid:
-                        raise Exception('Invalid client id or key. Access denied.')
+                        elif not merid:
+                            raise Exception('Invalid client id or key. Access denied.')
                     
-                    else:
-                        self.access_cache[client] = {'key': key, 'merid': merid,'ex_time': datetime.datetime.now()}
-                        return merid
+                        else:
+                            self.access_cache[client] = {'key': key, 'merid': merid,'ex_time': datetime.datetime.now()}
+                            return merid
                 
-        raise Exception('The request data structure is incorrect. Access denied.')
+            raise Exception('The request data structure is incorrect. Access denied.')
     
 
 
 
     def update_post(self, merid, data): 
         """
-            Update face images in database
+            Update face images in database.
+            With 'dedupe' (face distance) the face is not saved when other users of the group
+            are that close to it, they are returned with status code 409.
         """
         if 'gid' and 'uid' and 'info' and 'img' in data.keys():
 
-            encode = self.fr.encoding_face_img(face_img=data['img'])
+            encode = self.run_probe(encode_image, data['img'])
 
             if encode is not None:
-                return self.db.update_user(merid, data['gid'], data['uid'], encode, data['info'])
+                if data.get('dedupe'):
+                    gallery = self.get_dedupe_gallery(merid, data['gid'])
+                    duplicates = enrolled_duplicates(gallery, encode, float(data['dedupe']), uid=data['uid'])
+                    if duplicates:
+                        raise DuplicateFace(f'The face is already enrolled in group {data["gid"]}.', duplicates)
+                status = self.db.update_user(merid, data['gid'], data['uid'], encode, data['info'])
+                if status != 'Failed':
+                    self.update_cache(merid, data['gid'], [(data['uid'], encode, data['info'])])
+                return status
             
             else:
                 raise Exception('Encoding failed. There are no faces on the image.')
@@ -194,76 +255,625 @@ class HTTPRecognitionServer(BaseHTTPRequestHandler):
             raise Exception('The request data structure is incorrect. Access denied.')
 
 
-    def recognition_post(self, merid, data:dict):
+    def update_batch_post(self, merid, data):
+        """
+            Update face images of many users of one group in database.
+            With 'dedupe' faces close to other users of the group or of the batch are not saved.
+            return {uid: status}, status of such a user is {'status': 'Duplicate', 'duplicates': [...]}
+        """
+        gid = data.get('gid')
+        users = data.get('users')
+
+        if gid and users and isinstance(users, list) and all(isinstance(user, dict) and {'uid', 'info', 'img'} <= user.keys() for user in users):
+
+            encodes = self.run_probes(encode_image, [user['img'] for user in users])
+
+            dedupe = float(data['dedupe']) if data.get('dedupe') else None
+            if dedupe is not None:
+                gallery = self.get_dedupe_gallery(merid, gid)
+                # users of the batch are checked against each other too
+                batch_gallery = FaceGallery()
+
+            statuses = {}
+            new_users = []
+            for user, encode in zip(users, encodes):
+                if isinstance(encode, Exception) or encode is None:
+                    logging.error(f'Encoding of {user["uid"]} failed')
+                    statuses[user['uid']] = 'Failed'
+                    continue
+                if dedupe is not None:
+                    duplicates = enrolled_duplicates(gallery, encode, dedupe, uid=user['uid']) \
+                        + enrolled_duplicates(batch_gallery, encode, dedupe, uid=user['uid'])
+                    if duplicates:
+                        statuses[user['uid']] = {'status': 'Duplicate', 'duplicates': duplicates}
+                        continue
+                    batch_gallery.upsert([user['uid']], [user['info']], [encode])
+                new_users.append((user['uid'], encode, user['info']))
+
+            statuses.update(self.db.bulk_update_users(merid, gid, new_users))
+            self.update_cache(merid, gid, [user for user in new_users if statuses[user[0]] != 'Failed'])
+            return statuses
 
+        else:
+            raise Exception('The request data structure is incorrect. Access denied.')
+
+
+    def get_dedupe_gallery(self, merid, gid) -> FaceGallery:
+        """
+            Gallery of the group for the dedupe check, empty when the group has no faces yet
+        """
+        if self.data_cache.peek(f'{merid}_{gid}') is None:
+            group_version = self.db.get_group_version(group_id=gid, merid=merid)
+            if group_version is None:
+                raise Exception('Unable to connect to the database when obtaining face information.')
+            if group_version[1] == 0:
+                return FaceGallery()
+        return self.get_gallery(merid, gid)
+
+
+    def update_cache(self, merid, gid, users:list):
+        """
+            Put new or updated users into the cached gallery of the group
+            users - list of (uid, encode, userinfo)
+        """
+        if not users:
+            return
+        recognition_cache = self.data_cache.get(f'{merid}_{gid}')
+        if recognition_cache:
+            gallery = recognition_cache['data']
+            uids, encodes, infos = zip(*users)
+            gallery.upsert(uids, infos, encodes)
+            recognition_cache['lenght'] = len(gallery)
+
+
+    def recognition_post(self, merid, data:dict):
+        """
+            Recognize faces on the image in one group ('gid'), in several groups ('gids' list)
+            or in all groups of the merchant ('scope': 'merchant').
+            With several groups the image is encoded once and every match is tagged
+            with 'gid' and 'face' - number of the face on the image.
+        """
         gid = data.get("gid")
+        gids = self.get_request_gids(merid, data)
         threshold = data.get('threshold')
         confidence = data.get('conf')
         image = data.get('img')
-        dataKey = f'{merid}_{gid}'
-
+        top_k = int(data.get('top_k', 1))
+        nprobe = int(data['nprobe']) if data.get('nprobe') else None
 
-        if gid and threshold and image:
 
-            self.check_cache(self.data_cache, self.time_delta)
-            recognition_cache = self.data_cache.get(dataKey)
+        if (gid or gids) and threshold and image and top_k > 0:
 
-            if recognition_cache:
+            if gids:
+                galleries = {group: self.get_gallery(merid, group) for group in gids}
+            else:
+                gallery = self.get_gallery(merid, gid)
+
+            detection = self.get_detection_options(merid, data)
+            face_locations, face_encodings = self.run_probe(detect_faces, image, detection)
+            metrics.FACES_PER_IMAGE.observe(len(face_locations))
+
+            if gids:
+                metrics.GROUP_SIZE.observe(sum(len(group_gallery) for group_gallery in galleries.values()))
+                combined = self.get_combined_gallery(merid, galleries)
+                with metrics.stage('matching'):
+                    msg = self.fr.match_groups(galleries, face_encodings, threshold, top_k, nprobe, combined)
+                info = {'gids': gids, 'merid': merid}
+            else:
+                metrics.GROUP_SIZE.observe(len(gallery))
+                with metrics.stage('matching'):
+                    msg = self.fr.match_faces(gallery, face_encodings, threshold, top_k, nprobe)
+                info = {'gid': gid, 'merid': merid}
+
+            if msg:
+                logging.info(f'Face recognition result = {msg}')
+                return {'info': info, 'data': msg}
+            else:
+                logging.warning('Face recognition is failed. No matched faces.')
+                raise Exception('Face recognition is failed. No matched faces.')
                 
-                recognition_tdata = recognition_cache.get('data')
-                face_ids, face_info, face_encodings = recognition_tdata
-                print(f'Recognizer starttime = {datetime.datetime.now()}')
-                flag, msg = self.fr.face_recognizer(encodings=face_encodings, user_ids=face_ids, user_infos=face_info, img=image, threshold=threshold)
-                print(f'Recognizer finishtime = {datetime.datetime.now()}')
-
-                if flag:
-                    return {'info': {'gid': gid, 'merid': merid}, 'data': msg}
+        else:
+            raise Exception('The request data structure is incorrect. Access denied.') 
+
+
+
+    def get_request_gids(self, merid, data:dict):
+        """
+            Groups of a multi-group request in the order of the request,
+            None for a request of the single 'gid'
+        """
+        if data.get('scope') == 'merchant':
+            gids = self.get_merchant_groups(merid)
+            if not gids:
+                raise Exception('The merchant does not have groups with faces.')
+            return gids
+
+        gids = data.get('gids')
+        if gids is None:
+            return None
+        if not isinstance(gids, list) or not gids:
+            raise Exception('The request data structure is incorrect. gids must be a non-empty list.')
+        return list(dict.fromkeys(gids))
+
+
+    def get_merchant_groups(self, merid) -> list:
+        entry = self.fresh_entry(self.merchant_groups, merid, self.refresh_interval)
+        if entry is None:
+            gids = self.db.get_group_ids(merid)
+            if gids is None:
+                raise Exception('Unable to connect to the database when obtaining groups of the merchant.')
+            entry = {'gids': sorted(gids, key=str), 'ex_time': datetime.datetime.now()}
+            with self.cache_lock:
+                self.merchant_groups[merid] = entry
+        return entry['gids']
+
+
+    def get_combined_gallery(self, merid, galleries:dict):
+        """
+            CombinedGallery of the merchant, one for all requested sets of its groups.
+            It keeps the groups it had while their galleries are cached and is rebuilt
+            when a requested group is missing in it or changed.
+            None when the groups are too big for the exact scan, then every group is searched
+            through its own index.
+        """
+        if sum(len(gallery) for gallery in galleries.values()) >= self.ann_threshold:
+            return None
+
+        # group keys are '{merid}_{gid}', this key can not be one of them
+        dataKey = f'{merid}:groups'
+        recognition_cache = self.data_cache.get(dataKey)
+        if recognition_cache is not None and recognition_cache['data'].is_current(galleries):
+            return recognition_cache['data']
+
+        members = {}
+        if recognition_cache is not None:
+            for gid in recognition_cache['data'].gids:
+                cached = self.data_cache.peek(f'{merid}_{gid}')
+                if cached is not None:
+                    members[gid] = cached['data']
+        members.update(galleries)
+        if sum(len(gallery) for gallery in members.values()) >= self.ann_threshold:
+            members = galleries
+
+        combined = CombinedGallery({gid: members[gid] for gid in sorted(members, key=str)}, self.precision)
+        self.data_cache.put(dataKey, combined, None)
+        return combined
+
+
+    def recognition_batch_post(self, merid, data:dict):
+        """
+            Recognize faces on several images of one group.
+            return list with result for every image in the same shape as recognition_post returns,
+            an image without matched faces gets 'msg' with the reason instead of 'data'
+        """
+        gid = data.get("gid")
+        threshold = data.get('threshold')
+        images = data.get('imgs')
+        top_k = int(data.get('top_k', 1))
+        nprobe = int(data['nprobe']) if data.get('nprobe') else None
+
+        if gid and threshold and images and isinstance(images, list) and top_k > 0:
+
+            gallery = self.get_gallery(merid, gid)
+            detection = self.get_detection_options(merid, data)
+            detected = self.run_probes(detect_faces, images, detection)
+
+            # match faces of all images in one pass
+            face_counts = [0 if isinstance(res, Exception) else len(res[1]) for res in detected]
+            face_encodings = [encoding for res in detected if not isinstance(res, Exception) for encoding in res[1]]
+            for res in detected:
+                if not isinstance(res, Exception):
+                    metrics.FACES_PER_IMAGE.observe(len(res[1]))
+            metrics.GROUP_SIZE.observe(len(gallery))
+
+            with metrics.stage('matching'):
+                matches = self.fr.match_each_face(gallery, face_encodings, threshold, top_k, nprobe)
+            offsets = np.cumsum([0] + face_counts)
+
+            result = []
+            for i, res in enumerate(detected):
+                image_result = {'info': {'gid': gid, 'merid': merid}}
+                image_matches = [match for match in matches[offsets[i]:offsets[i + 1]] if match]
+
+                if isinstance(res, Exception):
+                    logging.error(f'Image #{i} of the batch failed: {res}')
+                    image_result['msg'] = f'Image processing failed. {res}'
+                elif image_matches:
+                    image_result['data'] = image_matches
                 else:
-                    raise Exception(msg)
+                    image_result['msg'] = 'Face recognition is failed. No matched faces.'
+                result.append(image_result)
 
-            else:
-                t_data = self.db.get_users_info(group_id=gid, merid=merid)
-
-                if t_data is not False:
-                    face_ids, face_info, face_encodings = t_data
-                    print(f'Recognizer starttime = {datetime.datetime.now()}')
-                    flag, msg = self.fr.face_recognizer(encodings=face_encodings, user_ids=face_ids, user_infos=face_info, img=image, threshold=threshold)
-                    print(f'Recognizer finishtime = {datetime.datetime.now()}')
-
-                    self.data_cache[dataKey] = {
-                        'data': t_data,
-                        'ex_time': datetime.datetime.now(),
-                        'lenght':len(t_data[0])
-                    }
-
-                    if flag:
-                        return {'info': {'gid': gid, 'merid': merid}, 'data': msg}
+            logging.info(f'Batch face recognition result = {result}')
+            return result
+
+        else:
+            raise Exception('The request data structure is incorrect. Access denied.')
+
+
+
+    def recognition_stream_post(self, merid, data:dict):
+        """
+            Recognize frames of a camera stream in their order.
+            Faces are tracked between requests with the same 'stream' id, detection and encoding
+            run only on keyframes. Settings of the stream are taken from its first request.
+            return result for every frame of 'imgs' (or the single 'img')
+        """
+        gid = data.get("gid")
+        threshold = data.get('threshold')
+        stream_id = data.get('stream')
+        frames = data.get('imgs') or ([data['img']] if data.get('img') else None)
+
+        if gid and threshold and stream_id and frames and isinstance(frames, list):
+            entry = self.get_stream(merid, gid, stream_id, data)
+
+            result = []
+            with entry['lock']:
+                for frame in frames:
+                    try:
+                        frame_result = entry['recognizer'].process(frame)
+                    except PoolBusy:
+                        raise
+                    except Exception as e:
+                        logging.error(f'Frame of stream {stream_id} failed: {e}')
+                        frame_result = {'msg': f'Frame processing failed. {e}'}
                     else:
-                        raise Exception(msg)
-                else:
-                    raise Exception('Unable to connect to the database when obtaining face information.')
-                
+                        metrics.STREAM_FRAMES.inc(kind='keyframe' if frame_result['keyframe'] else 'tracked')
+                    result.append(frame_result)
+                entry['ex_time'] = datetime.datetime.now()
+            return {'info': {'gid': gid, 'merid': merid, 'stream': stream_id}, 'data': result}
+
         else:
-            raise Exception('The request data structure is incorrect. Access denied.') 
+            raise Exception('The request data structure is incorrect. Access denied.')
+
 
+    def get_stream(self, merid, gid, stream_id, data:dict) -> dict:
+        """
+            Stream state by '{merid}_{gid}_{stream}', streams without frames for stream_time_delta are dropped
+        """
+        streamKey = f'{merid}_{gid}_{stream_id}'
+        now = datetime.datetime.now()
+        with self.cache_lock:
+            entry = self.streams.get(streamKey)
+            if entry is None or entry['ex_time'] + self.stream_time_delta < now:
+                entry = {'recognizer': self.create_stream(merid, gid, data), 'lock': threading.Lock(),
+                         'ex_time': datetime.datetime.now()}
+                self.streams[streamKey] = entry
+        return entry
+
+
+    def create_stream(self, merid, gid, data:dict) -> StreamRecognizer:
+        threshold = data.get('threshold')
+        top_k = int(data.get('top_k', 1))
+        nprobe = int(data['nprobe']) if data.get('nprobe') else None
+        detection = self.get_detection_options(merid, data)
+        if top_k < 1:
+            raise Exception('The request data structure is incorrect. Access denied.')
+
+        def read(frame, previous, force, scene_threshold):
+            # decoding and detection run in the pool, only the thumbnail and a small copy for the trackers come back
+            view = self.pool.run(read_stream_frame, frame, previous, force, scene_threshold, detection)
+            if view[1] is not None:
+                metrics.FACES_PER_IMAGE.observe(len(view[1][0]))
+            return view
+
+        def match(face_encodings):
+            # the gallery is taken on every keyframe, so the stream sees group updates
+            gallery = self.get_gallery(merid, gid)
+            metrics.GROUP_SIZE.observe(len(gallery))
+            with metrics.stage('matching'):
+                return self.fr.match_each_face(gallery, face_encodings, threshold, top_k, nprobe)
+
+        # trackers run in the request thread, they take a pool slot like the decoding
+        return StreamRecognizer(read, match,
+                                keyframe_interval=int(data.get('keyframe_interval', self.keyframe_interval)),
+                                scene_threshold=float(data.get('scene_threshold', self.scene_threshold)),
+                                guard=self.pool.slot)
+
+
+    def run_probe(self, fn, image, *args):
+        """
+            fn(image, *args) in the worker pool, see run_probes
+        """
+        result = self.run_probes(fn, [image], *args)[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+    def run_probes(self, fn, images:list, *args) -> list:
+        """
+            fn(image, *args) for every image in the worker pool, results for images
+            processed recently with the same fn and args are taken from probe_cache.
+            Images are base64 decoded here and sent to workers as bytes.
+            return list of results, a failed image has its exception instead of the result
+        """
+        results = [None] * len(images)
+        keys = [None] * len(images)
+        # key -> image bytes of the images to process, the same image is processed once
+        todo = {}
+        for i, image in enumerate(images):
+            try:
+                data = image_bytes(image)
+            except Exception as e:
+                results[i] = e
+                continue
+            keys[i] = probe_key(data, [fn.__name__, *args])
+            cached = self.probe_cache.get(keys[i]) if keys[i] not in todo else None
+            if cached is None:
+                todo[keys[i]] = data
+            else:
+                results[i] = cached[0]
+
+        if todo:
+            done = dict(zip(todo, self.pool.run_many(fn, list(todo.values()), *args)))
+            for key, result in done.items():
+                if not isinstance(result, Exception):
+                    self.probe_cache.put(key, (result,))
+            for i, key in enumerate(keys):
+                if key in done:
+                    results[i] = done[key]
+        return results
+
+
+    def get_detection_options(self, merid, data:dict) -> dict:
+        """
+            Detection settings: [DETECTION] section of config.ini,
+            updated by [DETECTION_<merid>] section and by 'detection' dict of the request.
+            The sections also set the limits of the request settings (max_upsample, max_detect_size, allow_cnn)
+        """
+        sections = [dict(config[section]) for section in ('DETECTION', f'DETECTION_{merid}') if config.has_section(section)]
+        try:
+            return detection_options(*sections, request=data.get('detection'))
+        except ValueError as e:
+            raise Exception(f'The request data structure is incorrect. {e}')
+
+
+    def get_gallery(self, merid, gid) -> FaceGallery:
+        """
+            Gallery of the group from cache, loaded from database when it is not cached.
+            A cached gallery is checked against the database every refresh_interval
+            and only the changed users are loaded. With the scheduler running a stale gallery
+            is returned at once and refreshed in the background.
+        """
+        dataKey = f'{merid}_{gid}'
+        with metrics.stage('gallery_load'):
+            recognition_cache = self.data_cache.get(dataKey)
+
+            if recognition_cache is None:
+                metrics.GALLERY_CACHE.inc(result='miss')
+                return self.load_gallery(merid, gid)
+
+            if recognition_cache['checked_time'] + self.refresh_interval < datetime.datetime.now():
+                metrics.GALLERY_CACHE.inc(result='refresh')
+                if self.scheduler is None:
+                    return self.refresh_gallery(merid, gid, recognition_cache)
+                self.scheduler.refresh_soon(merid, gid)
+                return recognition_cache['data']
+            metrics.GALLERY_CACHE.inc(result='hit')
+            return recognition_cache['data']
+
+
+    def load_gallery(self, merid, gid, use_snapshot=True) -> FaceGallery:
+        """
+            Load the whole group into cache.
+            The group is taken from its snapshot when there is one,
+            then only users changed after the snapshot are loaded from database.
+        """
+        dataKey = f'{merid}_{gid}'
+        snapshot = self.snapshots.load(dataKey) if self.snapshots and use_snapshot else None
+
+        if snapshot:
+            gallery, version, loaded_time = snapshot
+            # a snapshot without its load time is reloaded from database by the refresh
+            self.cache_gallery(merid, gid, gallery, version, loaded_time or datetime.datetime.min)
+            return self.refresh_gallery(merid, gid, self.data_cache.get(dataKey))
+
+        # the version is taken before the rows, rows changed while loading are loaded again on refresh
+        loaded_time = datetime.datetime.now()
+        group_version = self.db.get_group_version(group_id=gid, merid=merid)
+        t_data = self.db.get_users_info(group_id=gid, merid=merid)
+
+        if t_data is False or group_version is None:
+            raise Exception('Unable to connect to the database when obtaining face information.')
+
+        face_ids, face_info, face_encodings = t_data
+        gallery = FaceGallery(face_ids, face_info, face_encodings)
+        self.save_snapshot(dataKey, gallery, group_version[0], loaded_time)
+        self.cache_gallery(merid, gid, gallery, group_version[0], loaded_time)
+        return gallery
+
+
+    def cache_gallery(self, merid, gid, gallery:FaceGallery, version, loaded_time=None) -> None:
+        gallery.set_precision(self.precision)
+        if len(gallery) >= self.ann_threshold:
+            logging.info(f'Building ANN index for group #{gid} with {len(gallery)} faces')
+            gallery.build_index(nprobe=self.ann_nprobe)
+        self.data_cache.put(f'{merid}_{gid}', gallery, version, loaded_time)
+        if self.scheduler is not None:
+            self.scheduler.track(merid, gid)
+
+
+    def save_snapshot(self, dataKey, gallery:FaceGallery, version, loaded_time) -> None:
+        """
+            With a reduced precision the gallery then uses the memory-mapped matrix of the snapshot,
+            the full precision matrix is read only for candidates of the search
+        """
+        if self.snapshots:
+            revision = gallery.revision
+            try:
+                self.snapshots.save(dataKey, gallery, version, loaded_time)
+            except Exception as e:
+                logging.error(f'Snapshot of gallery {dataKey} was not saved: {e}')
+                return
+            if self.precision != 'float32':
+                matrix = self.snapshots.load_matrix(dataKey)
+                if matrix is not None:
+                    gallery.map_matrix(matrix, revision)
+
+
+    def refresh_gallery(self, merid, gid, recognition_cache) -> FaceGallery:
+        """
+            Load users changed since the cached version into the cached gallery
+        """
+        gallery = recognition_cache['data']
+        recognition_cache['checked_time'] = datetime.datetime.now()
+        group_version = self.db.get_group_version(group_id=gid, merid=merid)
+
+        if group_version is None:
+            # the database is not available, the cached gallery is still usable
+            return gallery
+
+        version, count = group_version
+        if self.max_age and recognition_cache['loaded_time'] + self.max_age < datetime.datetime.now():
+            logging.info(f'Group #{gid} was read from database more than {self.max_age} ago, reloading')
+            return self.load_gallery(merid, gid, use_snapshot=False)
+
+        if version != recognition_cache['version']:
+            if recognition_cache['version'] is None:
+                return self.load_gallery(merid, gid, use_snapshot=False)
+            t_data = self.db.get_users_info(group_id=gid, merid=merid, since=recognition_cache['version'])
+            if t_data is not False:
+                face_ids, face_info, face_encodings = t_data
+                gallery.upsert(face_ids, face_info, face_encodings)
+                logging.info(f'{len(face_ids)} changed faces loaded into group #{gid}')
+            recognition_cache['version'] = version
+            recognition_cache['lenght'] = len(gallery)
+
+            if count == len(gallery):
+                self.save_snapshot(f'{merid}_{gid}', gallery, version, recognition_cache['loaded_time'])
+
+        if count != len(gallery):
+            # users were deleted, only the full reload removes them
+            logging.info(f'Group #{gid} has {count} faces in database and {len(gallery)} in cache, reloading')
+            return self.load_gallery(merid, gid, use_snapshot=False)
+        return gallery
+
+
+
+    def fresh_entry(self, cache:dict, key, time_delta:datetime):
+        """
+            Entry of the cache, None when there is none or it expired
+        """
+        entry = cache.get(key)
+        if entry is not None and entry['ex_time'] + time_delta < datetime.datetime.now():
+            with self.cache_lock:
+                cache.pop(key, None)
+            return None
+        return entry
 
 
     def check_cache(self, cache:dict, time_delta:datetime) -> None:
         """
-            clean expaired cache data function
+            clean expaired cache data function, run by the scheduler
         """
         now = datetime.datetime.now()
-        data = cache.copy()
-        for key, info in data.items():
-            if info['ex_time'] + time_delta < now:
-                del cache[key]
+        with self.cache_lock:
+            data = cache.copy()
+            for key, info in data.items():
+                if info['ex_time'] + time_delta < now:
+                    del cache[key]
+
+
+class HTTPRecognitionServer(RecognitionService, BaseHTTPRequestHandler):
+    """
+        Threaded HTTP front end
+    """
+
+    def _set_headers(self, http_status=HTTPStatus.OK, content_type='application/json'):
+        self.send_response(http_status.value)
+        self.send_header('Content-type', content_type)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        self.end_headers()
+
+
+    def send_msg(self, status_code, msg, data=None, http_status=HTTPStatus.OK):
+        self._set_headers(http_status)
+        self.wfile.write(json.dumps(self.make_result(status_code, msg, data)).encode('utf-8'))
+
+
+    def do_GET(self):
+        """
+            Get get request function.
+        """
+        if self.path == '/metrics':
+            self._set_headers(content_type=metrics.CONTENT_TYPE)
+            self.wfile.write(metrics.render())
+            return
+        self._set_headers()
+        self.wfile.write(b'Hello!')
+
+
+    def do_POST(self):
+        """
+            Get post request function.
+        """
+        try:
+            self.check_request_body()
+        except Exception as e:
+            self.log_writer.write(0, self.path, 2, getattr(self, 'body', None), str(e))
+            self.send_msg(400, str(e))
+            return
+
+        http_status, result = self.process_post(self.path, self.body)
+        if result is None:
+            self.send_error(404, 'The request path structure is incorrect.')
+        else:
+            self._set_headers(http_status)
+            self.wfile.write(json.dumps(result).encode('utf-8'))
+
+
+    def check_request_body(self):
+        accept = self.headers.get('Accept')
+        content_len = content_length(self.headers['Content-Length'])
+        if content_len > self.max_body_size:
+            raise Exception('Request body is too large.')
+        self.body = self.rfile.read(content_len)
+        if 'application/json' or '*/*' in accept:
+            try:
+                self.body = json.loads(self.body)
+            except:
+                raise Exception('Only accept json request format.')
+        else:    
+            raise Exception('No correction request acceptance format.')
+        
+
+
+
+
+def start_services():
+    """
+        Start the recognition pool, the log writer and the cache scheduler before a front end starts serving
+    """
+    if RecognitionService.precision not in PRECISIONS:
+        raise ValueError(f'Unknown [RECOGNITION] precision {RecognitionService.precision}, use one of {PRECISIONS}')
+    if RecognitionService.precision != 'float32' and not RecognitionService.snapshots:
+        raise ValueError('[RECOGNITION] precision int8 needs [CACHE] snapshot_dir, the float32 matrix is mapped from it')
+    processes = config.getint('WORKERS', 'processes', fallback=os.cpu_count() or 1)
+    queue_depth = config.getint('WORKERS', 'queue_depth', fallback=2 * max(processes, 1))
+    RecognitionService.pool = RecognitionPool(processes, queue_depth, decode_max_size=RecognitionService.fr.decode_max_size)
+    RecognitionService.pool.start()
+    RecognitionService.log_writer.start()
+    RecognitionService.scheduler = CacheScheduler(RecognitionService(),
+                                                  warm_groups=parse_groups(config.get('CACHE', 'warm_groups', fallback='')),
+                                                  hot_path=config.get('CACHE', 'hot_path', fallback='HotGroups.json'),
+                                                  hot_groups=config.getint('CACHE', 'hot_groups', fallback=20))
+    RecognitionService.scheduler.start()
 
 
+def stop_services():
+    RecognitionService.scheduler.close()
+    RecognitionService.pool.shutdown()
+    RecognitionService.log_writer.close()
 
 
 def start_server(host, port):
-    http_server = HTTPServer((host, int(port)), HTTPRecognitionServer)
-    http_server.serve_forever()
+    start_services()
+    http_server = ThreadingHTTPServer((host, int(port)), HTTPRecognitionServer)
+    try:
+        http_server.serve_forever()
+    finally:
+        stop_services()
 
 
 
@@ -0,0 +1,132 @@
+import datetime
+import hashlib
+import json
+import logging
+import os
+import re
+import uuid
+import numpy as np
+from gallery import FaceGallery, ENCODING_SIZE
+
+
+class SnapshotStore:
+    '''
+        Group galleries saved on disk for fast start.
+        Every '{merid}_{gid}' gallery is a .npy float32 matrix and a .json sidecar
+        with ids, infos, version (max f_etime), loaded_time (when the group was read
+        from database) and the name of the matrix file.
+        Matrices are memory-mapped copy-on-write, so all processes which load
+        the same snapshot share one copy of it in memory, and rows replaced
+        in a gallery take memory only for their own pages.
+        The gid part of the key comes from requests, file names are built by file_name.
+    '''
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+
+    @staticmethod
+    def file_name(key) -> str:
+        '''
+            Name of the snapshot files of the key: the key itself when it has only letters, digits, '_' and '-',
+            otherwise '@' and the sha1 of the key, so no key can leave the directory or name a device
+        '''
+        key = str(key)
+        if re.fullmatch(r'[A-Za-z0-9_-]{1,64}', key) and not re.fullmatch(r'(?i)(con|prn|aux|nul|com\d|lpt\d)', key):
+            return key
+        return '@' + hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+    def _sidecar_path(self, key) -> str:
+        return os.path.join(self.directory, f'{self.file_name(key)}.json')
+
+
+    def save(self, key, gallery: FaceGallery, version, loaded_time=None) -> None:
+        '''
+            Write the snapshot. Readers see either the old or the new snapshot,
+            a new matrix file is written every time and the sidecar is replaced last.
+        '''
+        with gallery.lock:
+            matrix = np.array(gallery.matrix, dtype=np.float32)
+            ids = list(gallery.ids)
+            infos = list(gallery.infos)
+
+        matrix_name = f'{self.file_name(key)}-{uuid.uuid4().hex}.npy'
+        np.save(os.path.join(self.directory, matrix_name), matrix)
+
+        sidecar_path = self._sidecar_path(key)
+        old_matrix_name = self._read_sidecar(sidecar_path, missing_ok=True).get('matrix')
+        tmp_path = f'{sidecar_path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': version, 'loaded_time': loaded_time and loaded_time.isoformat(),
+                       'matrix': matrix_name, 'ids': ids, 'infos': infos}, f)
+        os.replace(tmp_path, sidecar_path)
+
+        if old_matrix_name:
+            try:
+                # processes which mapped the old file keep it until they unmap it
+                os.remove(os.path.join(self.directory, old_matrix_name))
+            except OSError:
+                logging.warning(f'Old snapshot matrix {old_matrix_name} was not removed')
+        logging.info(f'Snapshot of gallery {key} saved, {len(ids)} faces')
+
+
+    def load(self, key):
+        '''
+            return (gallery, version, loaded_time), None when there is no usable snapshot.
+            loaded_time is None for snapshots saved without it
+        '''
+        try:
+            sidecar, matrix = self._load_matrix(key)
+            gallery = FaceGallery(sidecar['ids'], sidecar['infos'], matrix)
+            loaded_time = sidecar.get('loaded_time')
+            loaded_time = loaded_time and datetime.datetime.fromisoformat(loaded_time)
+        except (OSError, ValueError, KeyError) as e:
+            logging.info(f'No snapshot of gallery {key}: {e}')
+            return None
+        logging.info(f'Gallery {key} loaded from snapshot, {len(gallery)} faces')
+        return gallery, sidecar['version'], loaded_time
+
+
+    def load_matrix(self, key):
+        '''
+            Memory-mapped matrix of the snapshot, None when there is no usable snapshot
+        '''
+        try:
+            return self._load_matrix(key)[1]
+        except (OSError, ValueError, KeyError) as e:
+            logging.info(f'No snapshot matrix of gallery {key}: {e}')
+            return None
+
+
+    def _load_matrix(self, key):
+        sidecar = self._read_sidecar(self._sidecar_path(key))
+        matrix = np.load(os.path.join(self.directory, sidecar['matrix']), mmap_mode='c')
+        if matrix.dtype != np.float32 or matrix.shape != (len(sidecar['ids']), ENCODING_SIZE):
+            raise ValueError('Snapshot matrix does not match the sidecar')
+        return sidecar, matrix
+
+
+    def remove(self, key) -> bool:
+        '''
+            return True when the key had a snapshot
+        '''
+        sidecar_path = self._sidecar_path(key)
+        found = os.path.exists(sidecar_path)
+        matrix_name = self._read_sidecar(sidecar_path, missing_ok=True).get('matrix')
+        for path in (sidecar_path, matrix_name and os.path.join(self.directory, matrix_name)):
+            if path and os.path.exists(path):
+                try:
+                    os.remove(path)
+                except OSError:
+                    logging.warning(f'Snapshot file {path} was not removed')
+        return found
+
+
+    def _read_sidecar(self, path, missing_ok=False) -> dict:
+        if missing_ok and not os.path.exists(path):
+            return {}
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
@@ -0,0 +1,88 @@
+import datetime
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+SERVER_CONFIG = '''[MYSQL]
+host=localhost
+user=test
+pwd=test
+database=test
+'''
+
+
+class FakeDataBase:
+    '''
+        In-memory stand-in of DataBaseRequests: groups[(merid, gid)] = {uid: (info, encoding)}
+    '''
+
+    def __init__(self):
+        self.groups = {}
+        self.logs = []
+
+
+    def client_validation(self, client, key):
+        return 1
+
+
+    def get_group_version(self, group_id, merid):
+        users = self.groups.get((merid, group_id), {})
+        return '2026-01-01 00:00:00', len(users)
+
+
+    def get_users_info(self, group_id, merid, since=None):
+        users = self.groups.get((merid, group_id))
+        if not users:
+            return False
+        return list(users), [info for info, _ in users.values()], [encoding for _, encoding in users.values()]
+
+
+    def update_user(self, merid, group_id, uid, encoding, info):
+        users = self.groups.setdefault((merid, group_id), {})
+        status = 'Updated' if uid in users else 'Created'
+        users[uid] = (info, encoding)
+        return status
+
+
+    def bulk_update_users(self, merid, group_id, users):
+        return {uid: self.update_user(merid, group_id, uid, encoding, info) for uid, encoding, info in users}
+
+
+    def insert_logs(self, rows):
+        self.logs.extend(rows)
+
+
+@pytest.fixture(scope='session')
+def server_module(tmp_path_factory):
+    '''
+        server imported with a minimal config.ini, it needs face_recognition installed
+    '''
+    pytest.importorskip('face_recognition')
+    directory = tmp_path_factory.mktemp('server')
+    (directory / 'config.ini').write_text(SERVER_CONFIG, encoding='utf-8')
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        import server
+    finally:
+        os.chdir(cwd)
+    return server
+
+
+@pytest.fixture
+def service(server_module, monkeypatch):
+    '''
+        RecognitionService with the fake database, jobs run in the test thread
+    '''
+    service_class = server_module.RecognitionService
+    monkeypatch.setattr(service_class, 'db', FakeDataBase())
+    monkeypatch.setattr(service_class, 'pool', server_module.RecognitionPool(0, 4))
+    monkeypatch.setattr(service_class, 'snapshots', None)
+    monkeypatch.setattr(service_class, 'scheduler', None)
+    monkeypatch.setattr(service_class, 'data_cache', server_module.GalleryCache(2 ** 30, datetime.timedelta(hours=1)))
+    monkeypatch.setattr(service_class, 'access_cache', {})
+    monkeypatch.setattr(service_class.log_writer, 'write', lambda *args: None)
+    return service_class()
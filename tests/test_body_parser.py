@@ -0,0 +1,84 @@
+import base64
+import json
+import pytest
+from body_parser import StreamingBodyParser, BodyError, content_length
+
+
+IMAGE = bytes(range(256)) * 3
+
+
+def parse(body: bytes, *splits):
+    '''
+        Feed the body in chunks cut at splits
+    '''
+    parser = StreamingBodyParser(bytearray())
+    start = 0
+    for split in splits + (len(body),):
+        parser.feed(body[start:split])
+        start = split
+    return parser.finish()
+
+
+def every_split(body: bytes):
+    return [parse(body, split) for split in range(len(body) + 1)]
+
+
+def encoded(data=IMAGE, escape_slashes=False):
+    text = base64.b64encode(data).decode('ascii')
+    return text.replace('/', '\\/') if escape_slashes else text
+
+
+def test_image_is_decoded_at_every_split():
+    body = json.dumps({'gid': 5, 'img': encoded()}).encode()
+    for result in every_split(body):
+        assert result == {'gid': 5, 'img': IMAGE}
+
+
+def test_split_escapes():
+    body = ('{"info": "a\\"b\\\\c\\u00e9", "img": "%s"}' % encoded(escape_slashes=True)).encode()
+    assert '\\/' in body.decode()
+    for result in every_split(body):
+        assert result == {'info': 'a"b\\cé', 'img': IMAGE}
+
+
+def test_line_breaks_escaped_in_image():
+    text = encoded()
+    body = ('{"img": "%s\\r\\n%s"}' % (text[:76], text[76:])).encode()
+    for result in every_split(body):
+        assert result == {'img': IMAGE}
+
+
+def test_null_image():
+    body = b'{"img": null, "info": "aGVsbG8="}'
+    for result in every_split(body):
+        assert result == {'img': None, 'info': 'aGVsbG8='}
+
+
+def test_string_value_equal_to_image_key():
+    body = b'{"info": "img", "name": "aGVsbG8=", "tags": ["imgs", "aGVsbG8="]}'
+    for result in every_split(body):
+        assert result == {'info': 'img', 'name': 'aGVsbG8=', 'tags': ['imgs', 'aGVsbG8=']}
+
+
+def test_chunk_boundary_inside_key():
+    body = ('{"imgs" : ["%s", "%s"], "image": "aGVsbG8="}' % (encoded(), encoded(b'face'))).encode()
+    for result in every_split(body):
+        assert result == {'imgs': [IMAGE, b'face'], 'image': 'aGVsbG8='}
+
+
+def test_images_of_nested_users():
+    body = json.dumps({'gid': 1, 'users': [{'uid': 1, 'img': encoded()}, {'uid': 2, 'img': encoded(b'two')}]}).encode()
+    assert parse(body, 10, 11, 40, 41, 42) == {'gid': 1, 'users': [{'uid': 1, 'img': IMAGE}, {'uid': 2, 'img': b'two'}]}
+
+
+@pytest.mark.parametrize('body', [b'{"img": "abc', b'{"info": "a\\', b'{"img": "abcde"}', b'not json'])
+def test_broken_body(body):
+    with pytest.raises(BodyError):
+        parse(body)
+
+
+@pytest.mark.parametrize('value', ['-1', '+5', '1.0', '0x10', '', ' ', '\u0661', None])
+def test_content_length_is_plain_digits(value):
+    with pytest.raises(BodyError):
+        content_length(value)
+    assert content_length(' 1000 ') == 1000
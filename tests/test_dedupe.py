@@ -0,0 +1,68 @@
+import numpy as np
+from gallery import FaceGallery
+from dedupe import duplicate_clusters, enrolled_duplicates
+
+
+def request(data):
+    return {'api': {'client': 'test', 'key': 'test'}, 'data': data}
+
+
+def test_enrolled_duplicates_skips_the_same_user():
+    gallery = FaceGallery(['a', 'b'], ['ia', 'ib'], [np.zeros(128), np.full(128, 0.5)])
+    assert enrolled_duplicates(gallery, np.zeros(128), 0.4, uid='a') == []
+    assert [face['id'] for face in enrolled_duplicates(gallery, np.full(128, 0.001), 0.4, uid='c')] == ['a']
+    assert enrolled_duplicates(FaceGallery(), np.zeros(128), 0.4) == []
+
+
+def test_duplicate_clusters_join_chains():
+    rng = np.random.default_rng(0)
+    encodings = rng.normal(0, 0.1, size=(300, 128))
+    encodings[1] = encodings[0] + 0.005
+    encodings[2] = encodings[1] + 0.005
+    encodings[11] = encodings[10] + 0.005
+    gallery = FaceGallery(list(range(300)), [''] * 300, encodings)
+    assert duplicate_clusters(gallery, 0.1, nprobe=4) == [[0, 1, 2], [10, 11]]
+
+
+def test_near_pairs_match_brute_force():
+    rng = np.random.default_rng(1)
+    encodings = rng.normal(0, 0.05, size=(1500, 128))
+    encodings[1000:1100] = encodings[:100] + rng.normal(0, 0.01, size=(100, 128))
+    gallery = FaceGallery(list(range(1500)), [''] * 1500, encodings)
+    matrix = gallery.matrix.astype(np.float64)
+    sq_norms = np.einsum('ij,ij->i', matrix, matrix)
+    brute = np.sqrt(np.maximum(sq_norms[:, None] + sq_norms[None, :] - 2.0 * matrix @ matrix.T, 0))
+    expected = np.argwhere(np.triu(brute <= 0.2, k=1))
+
+    # all lists probed, the join is exact
+    pairs, distances = gallery.near_pairs(0.2, nprobe=len(gallery))
+    assert np.array_equal(pairs, expected)
+    assert np.allclose(distances, brute[pairs[:, 0], pairs[:, 1]])
+    assert {(row, row + 1000) for row in range(100)} <= set(map(tuple, pairs.tolist()))
+
+    gallery.build_index(nlist=20)
+    assert np.array_equal(gallery.near_pairs(0.2, nprobe=20)[0], expected)
+    assert len(gallery.near_pairs(0.0)[0]) == 0
+
+
+def test_first_enrollment_with_dedupe(service, monkeypatch):
+    encoding = np.full(128, 0.05)
+    monkeypatch.setattr(service, 'run_probe', lambda fn, img: encoding)
+
+    _, result = service.route_post('/update', request({'gid': 'g1', 'uid': 'u1', 'info': 'i1', 'img': 'x', 'dedupe': 0.4}))
+    assert result == {'status_code': 200, 'msg': 'Created'}
+
+    _, result = service.route_post('/update', request({'gid': 'g1', 'uid': 'u2', 'info': 'i2', 'img': 'x', 'dedupe': 0.4}))
+    assert result['status_code'] == 409
+    assert [face['id'] for face in result['data']['duplicates']] == ['u1']
+
+
+def test_first_batch_enrollment_with_dedupe(service, monkeypatch):
+    encodings = [np.full(128, 0.05), np.full(128, 0.051), np.full(128, -0.05)]
+    monkeypatch.setattr(service, 'run_probes', lambda fn, imgs: encodings)
+    users = [{'uid': uid, 'info': uid, 'img': 'x'} for uid in ('u1', 'u2', 'u3')]
+
+    _, result = service.route_post('/update/batch', request({'gid': 'g2', 'users': users, 'dedupe': 0.4}))
+    assert result['status_code'] == 200
+    assert result['data']['u1'] == 'Created' and result['data']['u3'] == 'Created'
+    assert result['data']['u2']['status'] == 'Duplicate'
@@ -0,0 +1,35 @@
+import pytest
+
+face_recognition_code = pytest.importorskip('face_recognition_code', exc_type=ImportError)
+detection_options = face_recognition_code.detection_options
+
+
+def test_request_settings_are_limited():
+    options = detection_options(request={'upsample': 6, 'detect_size': 0})
+    assert options['upsample'] == 2
+    assert options['detect_size'] == 2048
+    assert detection_options(request={'detect_size': 10000})['detect_size'] == 2048
+    assert detection_options(request={'detect_size': 800})['detect_size'] == 800
+
+
+def test_config_settings_are_not_limited():
+    options = detection_options({'upsample': '3', 'detect_size': '0', 'model': 'cnn'})
+    assert (options['upsample'], options['detect_size'], options['model']) == (3, 0, 'cnn')
+
+
+def test_cnn_only_when_config_allows_it():
+    with pytest.raises(ValueError):
+        detection_options(request={'model': 'cnn'})
+    assert detection_options({'allow_cnn': 'yes'}, request={'model': 'cnn'})['model'] == 'cnn'
+
+
+def test_config_raises_the_limits():
+    options = detection_options({'max_upsample': '4', 'max_detect_size': '0'}, request={'upsample': 4, 'detect_size': 0})
+    assert (options['upsample'], options['detect_size']) == (4, 0)
+
+
+def test_limits_can_not_be_set_by_request():
+    with pytest.raises(ValueError):
+        detection_options(request={'max_upsample': 10})
+    with pytest.raises(ValueError):
+        detection_options(request=['upsample'])
@@ -0,0 +1,122 @@
+import contextlib
+import pickle
+import numpy as np
+import pytest
+from encoding_format import EncodingFormatError, is_packed, pack_encoding, unpack_encoding, unpack_encodings
+
+
+def encodings(count=3, seed=0):
+    return np.random.default_rng(seed).normal(0, 0.1, size=(count, 128)).astype(np.float32)
+
+
+@pytest.mark.parametrize('dtype, size, tolerance', [('float32', 516, 0), ('float16', 260, 1e-3)])
+def test_pack_round_trip(dtype, size, tolerance):
+    packed = [pack_encoding(encoding, dtype) for encoding in encodings()]
+    assert all(len(blob) == size and is_packed(blob) for blob in packed)
+    matrix = unpack_encodings(packed)
+    assert matrix.dtype == np.float32
+    assert np.allclose(matrix, encodings(), atol=tolerance, rtol=0)
+    assert np.allclose(unpack_encoding(packed[1]), encodings()[1], atol=tolerance, rtol=0)
+
+
+def test_pickled_and_packed_rows_together():
+    values = encodings(5)
+    blobs = [pickle.dumps(values[0].astype(np.float64)), pack_encoding(values[1]), pack_encoding(values[2], 'float16'),
+             pickle.dumps(values[3]), pack_encoding(values[4])]
+    matrix = unpack_encodings(blobs)
+    assert np.array_equal(matrix[[0, 1, 3, 4]], values[[0, 1, 3, 4]])
+    assert np.allclose(matrix[2], values[2], atol=1e-3)
+
+
+class Payload:
+    def __reduce__(self):
+        return (print, ('unpickled',))
+
+
+def test_pickle_with_forbidden_class(capsys):
+    with pytest.raises(EncodingFormatError):
+        unpack_encodings([pickle.dumps(Payload())])
+    assert 'unpickled' not in capsys.readouterr().out
+
+
+def test_broken_packed_rows():
+    with pytest.raises(EncodingFormatError):
+        unpack_encodings([pack_encoding(encodings(1)[0])[:-4]])
+    with pytest.raises(EncodingFormatError):
+        unpack_encodings([b'FE\x07\x01' + bytes(512)])
+    with pytest.raises(EncodingFormatError):
+        pack_encoding(encodings(1)[0], 'int8')
+
+
+class MigrationCursor:
+    '''
+        vface_user rows for migrate_encodings: [merid, groupid, uid, f_encode], ordered by the key
+    '''
+
+    def __init__(self, rows, updates):
+        self.rows = rows
+        self.updates = updates
+        self.fetched = []
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, *args):
+        pass
+
+
+    def execute(self, sql, args):
+        *last_key, limit = args
+        # the first key is ('', '', ''), keys are compared as strings
+        self.fetched = [tuple(row) for row in self.rows if tuple(map(str, row[:3])) > tuple(map(str, last_key))][:limit]
+
+
+    def fetchall(self):
+        return self.fetched
+
+
+    def executemany(self, sql, args):
+        assert 'f_etime = f_etime' in sql
+        for encode, *key in args:
+            self.updates.append(tuple(key))
+            next(row for row in self.rows if row[:3] == key)[3] = encode
+
+
+class MigrationPool:
+    def __init__(self, rows):
+        self.rows = rows
+        self.updates = []
+
+
+    @contextlib.contextmanager
+    def connection(self):
+        pool = self
+
+        class Connection:
+            def cursor(self):
+                return MigrationCursor(pool.rows, pool.updates)
+
+            def commit(self):
+                pass
+
+        yield Connection()
+
+
+def test_migration_skips_packed_rows():
+    db_requests = pytest.importorskip('db_requests', exc_type=ImportError)
+    values = encodings(5)
+    rows = [[1, 'g', f'u{row}', pack_encoding(values[row]) if row % 2 else pickle.dumps(values[row])] for row in range(5)]
+    packed_before = [row[3] for row in rows if is_packed(row[3])]
+    database = db_requests.DataBaseRequests(encoding_dtype='float32')
+    database.pool = MigrationPool(rows)
+
+    assert database.migrate_encodings(chunk_size=2) == 3
+    assert database.pool.updates == [(1, 'g', 'u0'), (1, 'g', 'u2'), (1, 'g', 'u4')]
+    assert [row[3] for row in rows if row[2] in ('u1', 'u3')] == packed_before
+    assert np.array_equal(unpack_encodings([row[3] for row in rows]), values)
+    # nothing is left to convert
+    database.pool.updates.clear()
+    assert database.migrate_encodings(chunk_size=2) == 0
+    assert database.pool.updates == []
@@ -0,0 +1,141 @@
+import datetime
+import numpy as np
+import pytest
+from gallery import CombinedGallery, FaceGallery, IVFIndex, QuantizedMatrix, is_mapped
+from snapshot_store import SnapshotStore
+
+
+def make_gallery(size=500, seed=0):
+    rng = np.random.default_rng(seed)
+    encodings = rng.normal(0, 0.1, size=(size, 128)).astype(np.float32)
+    return FaceGallery([f'u{row}' for row in range(size)], [''] * size, encodings), rng
+
+
+def test_int8_search_matches_float32():
+    gallery, rng = make_gallery()
+    probes = gallery.matrix[:20] + rng.normal(0, 0.01, size=(20, 128))
+    expected = gallery.search(probes, k=3)
+    gallery.set_precision('int8')
+    indices, distances = gallery.search(probes, k=3)
+    assert np.array_equal(indices, expected[0])
+    assert np.array_equal(distances, expected[1])
+
+
+def test_int8_follows_upsert():
+    gallery, _ = make_gallery()
+    gallery.set_precision('int8')
+    gallery.upsert(['u3', 'new'], ['', ''], [np.full(128, 0.3), np.full(128, -0.3)])
+    assert gallery.ids[gallery.search(np.full(128, 0.3))[0][0, 0]] == 'u3'
+    assert gallery.ids[gallery.search(np.full(128, -0.3))[0][0, 0]] == 'new'
+    assert len(gallery.quantized.codes) == len(gallery)
+
+
+def test_unknown_precision():
+    gallery, _ = make_gallery(10)
+    with pytest.raises(ValueError):
+        gallery.set_precision('float16')
+    with pytest.raises(ValueError):
+        QuantizedMatrix(gallery.matrix, 'float16')
+
+
+def test_mapped_matrix_is_not_counted(tmp_path):
+    gallery, _ = make_gallery()
+    store = SnapshotStore(str(tmp_path))
+    store.save('1_1', gallery, None)
+    mapped, _, _ = store.load('1_1')
+    assert is_mapped(mapped.buffer)
+    mapped.set_precision('int8')
+    assert mapped.nbytes < gallery.nbytes / 3
+
+    # rows are replaced in the copy-on-write mapping, the snapshot file does not change
+    mapped.upsert(['u0'], [''], [np.zeros(128)])
+    assert is_mapped(mapped.buffer)
+    assert not np.array_equal(store.load_matrix('1_1')[0], np.zeros(128))
+
+
+def test_map_matrix_skips_outdated_snapshot(tmp_path):
+    gallery, _ = make_gallery()
+    store = SnapshotStore(str(tmp_path))
+    revision = gallery.revision
+    store.save('1_1', gallery, None)
+    gallery.upsert(['u1'], [''], [np.zeros(128)])
+    assert not gallery.map_matrix(store.load_matrix('1_1'), revision)
+    assert not is_mapped(gallery.buffer)
+
+    store.save('1_1', gallery, None)
+    assert gallery.map_matrix(store.load_matrix('1_1'), gallery.revision)
+    assert is_mapped(gallery.buffer)
+
+
+@pytest.mark.parametrize('gid', ['..\\..\\evil', '../../evil', 'C:\\evil', 'a.b', 'CON'])
+def test_snapshot_key_stays_in_directory(tmp_path, gid):
+    store = SnapshotStore(str(tmp_path / 'snapshots'))
+    gallery, _ = make_gallery(10)
+    key = f'1_{gid}' if gid != 'CON' else gid
+    store.save(key, gallery, 'v1', datetime.datetime(2026, 1, 1))
+    assert sorted(path.suffix for path in (tmp_path / 'snapshots').iterdir()) == ['.json', '.npy']
+    assert all(path.name.startswith('@') for path in (tmp_path / 'snapshots').iterdir())
+    loaded, version, loaded_time = store.load(key)
+    assert (loaded.ids, version, loaded_time) == (gallery.ids, 'v1', datetime.datetime(2026, 1, 1))
+    assert store.load('1_other') is None
+    store.remove(key)
+    assert not list((tmp_path / 'snapshots').iterdir())
+
+
+def test_index_lists_cover_every_row():
+    gallery, _ = make_gallery(1000)
+    index = gallery.build_index(nlist=30)
+    assert sorted(np.concatenate([index.list_rows(c) for c in range(index.nlist)]).tolist()) == list(range(1000))
+    assert all(len(rows) == 1000 for rows in index.candidates(gallery.matrix[:3], nprobe=30))
+
+
+def test_index_search_finds_close_faces():
+    gallery, rng = make_gallery(2000)
+    gallery.build_index(nlist=40, nprobe=8)
+    probes = gallery.matrix[:50] + rng.normal(0, 0.005, size=(50, 128))
+    indices, distances = gallery.search(probes, k=3)
+    exact = gallery.search(probes, k=3, exact=True)
+    assert np.array_equal(indices[:, 0], np.arange(50))
+    assert np.allclose(distances[:, 0], exact[1][:, 0])
+    # all lists probed, the index search is exact
+    assert np.array_equal(gallery.search(probes, k=3, nprobe=40)[0], exact[0])
+
+
+def test_index_follows_upsert():
+    gallery, _ = make_gallery(1000)
+    gallery.build_index(nlist=30)
+    gallery.upsert(['u5', 'new'], ['', ''], [np.full(128, 0.3), np.full(128, -0.3)])
+    assert len(gallery.index.assignments) == len(gallery) == 1001
+    assert gallery.ids[gallery.search(np.full(128, 0.3))[0][0, 0]] == 'u5'
+    assert gallery.ids[gallery.search(np.full(128, -0.3))[0][0, 0]] == 'new'
+
+
+def test_index_of_tiny_gallery():
+    index = IVFIndex(np.zeros((3, 128)), nlist=10)
+    assert index.nlist == 3
+    assert len(index.candidates(np.zeros((1, 128)))[0]) == 3
+
+
+@pytest.mark.parametrize('precision', ['float32', 'int8'])
+def test_combined_search_of_requested_groups(precision):
+    rng = np.random.default_rng(2)
+    galleries = {gid: FaceGallery([f'{gid}{row}' for row in range(size)], [''] * size, rng.normal(0, 0.1, size=(size, 128)))
+                 for gid, size in [('a', 300), ('b', 0), ('c', 200), ('d', 400)]}
+    combined = CombinedGallery(galleries, precision)
+    assert (combined.quantized is not None) == (precision == 'int8')
+    probes = np.vstack([galleries['a'].matrix[5], galleries['d'].matrix[7]]) + 0.001
+    for gids in (['a', 'b', 'c', 'd'], ['d', 'a'], ['c']):
+        for gid, (indices, distances) in zip(gids, combined.search_groups(gids, probes, k=3)):
+            expected = galleries[gid].search(probes, k=3, exact=True)
+            assert np.array_equal(indices, expected[0])
+            assert np.allclose(distances, expected[1])
+
+
+def test_combined_is_current_for_subsets():
+    galleries = {gid: make_gallery(50, seed)[0] for seed, gid in enumerate(['a', 'b', 'c'])}
+    combined = CombinedGallery(galleries)
+    assert combined.is_current({'c': galleries['c'], 'a': galleries['a']})
+    assert not combined.is_current({'a': galleries['a'], 'x': make_gallery(5)[0]})
+    galleries['b'].upsert(['new'], [''], [np.zeros(128)])
+    assert combined.is_current({'a': galleries['a']})
+    assert not combined.is_current({'b': galleries['b']})
@@ -0,0 +1,18 @@
+import numpy as np
+
+
+def test_one_combined_gallery_for_any_groups_of_a_merchant(service, monkeypatch):
+    for gid in ('g1', 'g2', 'g3'):
+        service.db.update_user(1, gid, f'{gid}u', np.full(128, 0.01 * len(gid)), gid)
+    monkeypatch.setattr(service, 'run_probe', lambda fn, img, *args: ([(0, 1, 1, 0)], [np.full(128, 0.02)]))
+    request = lambda gids: service.recognition_post(1, {'gids': gids, 'threshold': 0.5, 'img': 'x'})
+
+    assert [match['gid'] for match in request(['g1', 'g2'])['data']] == ['g1', 'g2']
+    combined = service.data_cache.get('1:groups')['data']
+    assert [match['gid'] for match in request(['g2'])['data']] == ['g2']
+    assert service.data_cache.get('1:groups')['data'] is combined
+
+    # a new group joins the groups which are still cached
+    assert [match['gid'] for match in request(['g3'])['data']] == ['g3']
+    assert service.data_cache.get('1:groups')['data'].gids == ['g1', 'g2', 'g3']
+    assert sorted(service.data_cache.entries) == ['1:groups', '1_g1', '1_g2', '1_g3']
@@ -0,0 +1,40 @@
+import asyncio
+import io
+import pytest
+
+
+BIG_BODY = b'{"img": "' + b'A' * 5000000 + b'"}'
+
+
+def test_threaded_server_rejects_negative_length(service, server_module):
+    handler = server_module.HTTPRecognitionServer.__new__(server_module.HTTPRecognitionServer)
+    handler.headers = {'Accept': '*/*', 'Content-Length': '-1'}
+    handler.rfile = io.BytesIO(BIG_BODY)
+    handler.max_body_size = 1000
+    with pytest.raises(Exception, match='Content-Length'):
+        handler.check_request_body()
+    assert handler.rfile.tell() == 0
+
+
+@pytest.mark.parametrize('length', ['-1', 'abc'])
+def test_async_server_rejects_bad_length(service, monkeypatch, length):
+    async_server = pytest.importorskip('async_server', exc_type=ImportError)
+    front_end = async_server.AsyncRecognitionServer(service, max_body_size=1000)
+    fed = []
+
+    async def run():
+        server = await asyncio.start_server(front_end.handle_connection, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        async with server:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'POST /recognition HTTP/1.1\r\nContent-Length: %s\r\n\r\n' % length.encode() + BIG_BODY[:100000])
+            response = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+            return response
+
+    monkeypatch.setattr(async_server.StreamingBodyParser, 'feed', lambda parser, chunk: fed.append(chunk))
+    response = asyncio.run(run())
+    front_end.executor.shutdown()
+    assert response.startswith(b'HTTP/1.1 400')
+    assert b'Content-Length is not valid.' in response
+    assert fed == []
@@ -0,0 +1,34 @@
+from log_writer import LogWriter
+
+
+class LogDataBase:
+    def __init__(self):
+        self.rows = []
+
+
+    def insert_logs(self, rows):
+        self.rows.extend(rows)
+
+
+def test_queued_row_keeps_only_image_digests(tmp_path):
+    writer = LogWriter(LogDataBase(), spill_path=str(tmp_path / 'spill.jsonl'))
+    body = {'data': {'gid': 1, 'img': 'A' * 1000, 'users': [{'uid': 'u', 'img': b'\x00' * 500}]}}
+    writer.write(1, '/update', 1, body, 'Ok')
+
+    requestdata = writer.queue.get_nowait()[3]
+    assert requestdata['data']['img'] == {'sha1': '3ae3644d6777a1f56a1defeabc74af9c4b313e49', 'size': 1000}
+    assert requestdata['data']['users'][0]['img']['size'] == 500
+    # the body of the request is not changed
+    assert body['data']['img'] == 'A' * 1000
+
+
+def test_images_are_kept_when_configured(tmp_path):
+    writer = LogWriter(LogDataBase(), store_images=True, spill_path=str(tmp_path / 'spill.jsonl'))
+    writer.write(1, '/update', 1, {'data': {'img': 'AAAA'}}, 'Ok')
+    assert writer.queue.get_nowait()[3] == {'data': {'img': 'AAAA'}}
+
+
+def test_unparsed_body_is_logged_as_digest(tmp_path):
+    writer = LogWriter(LogDataBase(), store_images=True, spill_path=str(tmp_path / 'spill.jsonl'))
+    writer.write(0, '/recognition', 2, b'{"img": "' + b'A' * 1000, 'Only accept json request format.')
+    assert writer.queue.get_nowait()[3] == {'sha1': '63460c10b535ba0931d1eefee80b734c8fd9cc10', 'size': 1009}
@@ -0,0 +1,37 @@
+import datetime
+import numpy as np
+from snapshot_store import SnapshotStore
+
+
+def test_same_second_update_is_loaded_after_max_age(service):
+    service.db.update_user(1, 'g1', 'u1', np.zeros(128), 'old')
+    assert service.get_gallery(1, 'g1').infos == ['old']
+
+    # the same f_etime and the same count, the freshness check can not see it
+    service.db.update_user(1, 'g1', 'u1', np.full(128, 0.1), 'new')
+    entry = service.data_cache.get('1_g1')
+    assert service.refresh_gallery(1, 'g1', entry).infos == ['old']
+
+    entry['loaded_time'] -= service.max_age + datetime.timedelta(seconds=1)
+    assert service.refresh_gallery(1, 'g1', entry).infos == ['new']
+    assert service.data_cache.get('1_g1')['loaded_time'] > datetime.datetime.now() - datetime.timedelta(minutes=1)
+
+
+def test_cache_hits_keep_the_load_time(service):
+    service.db.update_user(1, 'g1', 'u1', np.zeros(128), 'old')
+    service.get_gallery(1, 'g1')
+    loaded_time = service.data_cache.get('1_g1')['loaded_time']
+    service.get_gallery(1, 'g1')
+    assert service.data_cache.get('1_g1')['loaded_time'] == loaded_time
+
+
+def test_clear_removes_the_snapshot(service, monkeypatch, tmp_path):
+    snapshots = SnapshotStore(str(tmp_path))
+    monkeypatch.setattr(type(service), 'snapshots', snapshots)
+    service.db.update_user(1, 'g1', 'u1', np.zeros(128), 'old')
+    service.get_gallery(1, 'g1')
+    assert snapshots.load('1_g1') is not None
+
+    assert service.clear_cache_post(1, {'gid': 'g1'}).startswith('Successfully')
+    assert snapshots.load('1_g1') is None
+    assert '1_g1' not in service.data_cache
@@ -0,0 +1,50 @@
+import datetime
+import time
+from cache_scheduler import CacheScheduler
+from gallery import FaceGallery
+from gallery_cache import GalleryCache
+
+
+class FakeService:
+    '''
+        The parts of RecognitionService the scheduler uses, every load and refresh is recorded
+    '''
+    refresh_interval = datetime.timedelta(hours=1)
+    pwd_time_delta = stream_time_delta = datetime.timedelta(hours=1)
+
+    def __init__(self):
+        self.data_cache = GalleryCache(2 ** 30, datetime.timedelta(hours=1))
+        self.access_cache, self.merchant_groups, self.streams = {}, {}, {}
+        self.events = []
+        self.on_load = None
+
+
+    def check_cache(self, cache, time_delta):
+        pass
+
+
+    def load_gallery(self, merid, gid):
+        self.events.append(('load', gid))
+        if self.on_load:
+            self.on_load(gid)
+        self.data_cache.put(f'{merid}_{gid}', FaceGallery(), None)
+
+
+    def refresh_gallery(self, merid, gid, entry):
+        self.events.append(('refresh', gid))
+
+
+def test_requested_refresh_is_not_behind_the_warm_up():
+    service = FakeService()
+    service.data_cache.put('1_hot', FaceGallery(), None)
+    scheduler = CacheScheduler(service, warm_groups=[(1, 'w1'), (1, 'w2'), (1, 'w3'), (1, 'hot')], hot_path=None, tick=0.05)
+    # a request finds the cached group stale while the first group is warmed
+    service.on_load = lambda gid: gid == 'w1' and scheduler.refresh_soon(1, 'hot')
+    scheduler.start()
+    try:
+        deadline = time.monotonic() + 5
+        while len(service.events) < 4 and time.monotonic() < deadline:
+            time.sleep(0.01)
+    finally:
+        scheduler.close()
+    assert service.events[:4] == [('load', 'w1'), ('refresh', 'hot'), ('load', 'w2'), ('load', 'w3')]
@@ -0,0 +1,57 @@
+import base64
+import io
+import contextlib
+import numpy as np
+import pytest
+from PIL import Image
+from face_tracking import StreamRecognizer, view_frame
+
+
+def frame(value, size=(60, 80)):
+    return np.full(size + (3,), value, np.uint8)
+
+
+def test_frames_are_analyzed_on_keyframes_only():
+    analyzed = []
+
+    def read(image, previous, force, scene_threshold):
+        def analyze(image):
+            analyzed.append(int(image[0, 0, 0]))
+            return [(10, 30, 30, 10)], [np.full(128, image[0, 0, 0] / 255)]
+        return view_frame(image, previous, force, scene_threshold, analyze)
+
+    stream = StreamRecognizer(read, lambda encodings: [{'id': 'p'} for _ in encodings], keyframe_interval=3)
+    results = list(stream.recognize([frame(10)] * 4 + [frame(200)]))
+    assert [result['keyframe'] for result in results] == [True, False, False, True, True]
+    assert analyzed == [10, 10, 200]
+    assert results[1]['data'] == [{'track': results[0]['data'][0]['track'], 'location': [10, 30, 30, 10], 'match': {'id': 'p'}}]
+
+
+def test_tracking_takes_the_guard():
+    def read(image, previous, force, scene_threshold):
+        return np.zeros((32, 32), np.float32), ([], []) if force else None, image, 1.0
+
+    @contextlib.contextmanager
+    def busy():
+        raise RuntimeError('busy')
+        yield
+
+    stream = StreamRecognizer(read, lambda encodings: [], keyframe_interval=5, guard=busy)
+    with pytest.raises(RuntimeError):
+        stream.process(frame(10))
+
+
+def test_stream_frame_is_decoded_once(service, server_module, monkeypatch):
+    face_recognition_code = pytest.importorskip('face_recognition_code', exc_type=ImportError)
+    service.db.update_user(1, 'g1', 'u1', np.zeros(128), 'info')
+    decoded = []
+    decode_image = face_recognition_code.decode_image
+    monkeypatch.setattr(face_recognition_code, 'decode_image', lambda *args: decoded.append(1) or decode_image(*args))
+
+    buffer = io.BytesIO()
+    Image.fromarray(frame(100)).save(buffer, 'JPEG')
+    image = base64.b64encode(buffer.getvalue()).decode('ascii')
+    data = {'gid': 'g1', 'threshold': 0.9, 'stream': 'cam', 'imgs': [image] * 3}
+    result = service.recognition_stream_post(1, data)
+    assert [item['keyframe'] for item in result['data']] == [True, False, False]
+    assert len(decoded) == 3
@@ -0,0 +1,38 @@
+import os
+import threading
+import time
+import pytest
+
+workers = pytest.importorskip('workers', exc_type=ImportError)
+
+
+def test_pool_survives_a_dead_worker():
+    pool = workers.RecognitionPool(1, 1)
+    try:
+        pool.start()
+        with pytest.raises(workers.PoolBusy):
+            pool.run(os._exit, 1)
+        assert pool.run(workers.ping) is True
+        with pytest.raises(workers.PoolBusy):
+            pool.run_many(os._exit, [1, 2])
+        assert pool.run_many(workers.ping, [1, 2]) == [True, True]
+    finally:
+        pool.shutdown()
+
+
+def test_batch_takes_a_slot_per_item():
+    pool = workers.RecognitionPool(1, 1)
+    try:
+        pool.start()
+        results = []
+        batch = threading.Thread(target=lambda: results.append(pool.run_many(time.sleep, [0.2] * 4)))
+        batch.start()
+        time.sleep(0.1)
+        # both slots are taken by the batch
+        with pytest.raises(workers.PoolBusy):
+            pool.run(workers.ping)
+        batch.join()
+        assert results == [[None] * 4]
+        assert pool.run(workers.ping) is True
+    finally:
+        pool.shutdown()
@@ -0,0 +1,204 @@
+import concurrent.futures
+import concurrent.futures.process
+import contextlib
+import logging
+import threading
+from face_recognition_code import FaceRecognition
+import metrics
+
+
+# FaceRecognition of the current worker process
+worker_fr = None
+
+
+class PoolBusy(Exception):
+    pass
+
+
+def init_worker(decode_max_size=None):
+    global worker_fr
+    worker_fr = FaceRecognition(decode_max_size=decode_max_size)
+
+
+def image_type(img) -> str:
+    '''
+        Images parsed by the asyncio server come as bytes, others as base64 strings
+    '''
+    return 'BYTES' if isinstance(img, (bytes, bytearray, memoryview)) else 'BASE64'
+
+
+def encode_image(img, img_type=None):
+    '''
+        Encoding of the single face on the image, runs in a worker process
+    '''
+    return worker_fr.encoding_face_img(face_img=img, img_type=img_type or image_type(img))
+
+
+def detect_faces(img, detection=None, img_type=None):
+    '''
+        Locations and encodings of all faces on the image, runs in a worker process
+    '''
+    return worker_fr.detect_and_encode(img, img_type or image_type(img), detection)
+
+
+def read_stream_frame(img, previous, force, scene_threshold, detection=None, img_type=None):
+    '''
+        Thumbnail, keyframe detections and tracking copy of a stream frame decoded once, runs in a worker process
+    '''
+    return worker_fr.read_stream_frame(img, img_type or image_type(img), previous, force, scene_threshold, detection)
+
+
+def ping(_=None):
+    return True
+
+
+class RecognitionPool:
+    '''
+        Process pool for CPU-bound face detection and encoding.
+        At most processes + queue_depth jobs are accepted at the same time,
+        when all of them are taken run() raises PoolBusy instead of waiting.
+        With processes = 0 jobs run in the calling thread.
+        When a worker process dies the executor is replaced and the failed job raises PoolBusy.
+    '''
+
+    def __init__(self, processes: int, queue_depth: int, decode_max_size=None):
+        self.processes = processes
+        self.decode_max_size = decode_max_size
+        self.slots = threading.BoundedSemaphore(max(processes, 1) + queue_depth)
+        self.executor_lock = threading.Lock()
+
+        if processes > 0:
+            self.executor = self.create_executor()
+        else:
+            self.executor = None
+            init_worker(decode_max_size)
+
+
+    def create_executor(self):
+        return concurrent.futures.ProcessPoolExecutor(max_workers=self.processes, initializer=init_worker,
+                                                      initargs=(self.decode_max_size,))
+
+
+    def restart(self, broken) -> None:
+        '''
+            Replace the executor broken by a dead worker, other threads may find it broken too
+        '''
+        with self.executor_lock:
+            if self.executor is broken:
+                logging.error('A recognition worker process died, the pool is restarted')
+                broken.shutdown(wait=False, cancel_futures=True)
+                self.executor = self.create_executor()
+
+
+    def start(self):
+        '''
+            Start worker processes before the server starts its threads
+        '''
+        if self.executor is not None:
+            list(self.executor.map(ping, range(self.processes)))
+            logging.info(f'Recognition pool started with {self.processes} processes')
+
+
+    def run(self, fn, *args):
+        self.acquire()
+        try:
+            executor = self.executor
+            if executor is None:
+                return fn(*args)
+            try:
+                return self.recorded(executor.submit(metrics.collect, fn, *args).result())
+            except concurrent.futures.process.BrokenProcessPool:
+                self.restart(executor)
+                raise PoolBusy('The recognition worker failed. Try again later.')
+        finally:
+            self.slots.release()
+
+
+    def run_many(self, fn, items, *args) -> list:
+        '''
+            Run fn(item, *args) for every item in parallel.
+            Every item in the executor takes a queue slot: the batch takes the free slots,
+            at most one per item, and keeps that many items in flight until all are done.
+            PoolBusy is raised when no slot is free.
+            return list of results in the order of items,
+            a failed item has its exception instead of the result
+        '''
+        if not items:
+            return []
+        slots = self.acquire(len(items))
+        try:
+            executor = self.executor
+            if executor is None:
+                return [self.call(fn, item, *args) for item in items]
+            try:
+                return self.run_window(executor, slots, fn, items, *args)
+            except concurrent.futures.process.BrokenProcessPool:
+                self.restart(executor)
+                raise PoolBusy('The recognition worker failed. Try again later.')
+        finally:
+            for _ in range(slots):
+                self.slots.release()
+
+
+    def run_window(self, executor, size, fn, items, *args) -> list:
+        results = [None] * len(items)
+        futures = {}
+        submitted = 0
+        while submitted < len(items) or futures:
+            while submitted < len(items) and len(futures) < size:
+                futures[executor.submit(metrics.collect, fn, items[submitted], *args)] = submitted
+                submitted += 1
+            done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                position = futures.pop(future)
+                if isinstance(future.exception(), concurrent.futures.process.BrokenProcessPool):
+                    raise future.exception()
+                results[position] = self.call(lambda: self.recorded(future.result()))
+        return results
+
+
+    @staticmethod
+    def call(fn, *args):
+        try:
+            return fn(*args)
+        except Exception as e:
+            return e
+
+
+    @contextlib.contextmanager
+    def slot(self):
+        '''
+            Queue slot for CPU work done in the calling thread, it is limited like the jobs of the pool
+        '''
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.slots.release()
+
+
+    def acquire(self, count=1) -> int:
+        '''
+            Take up to count free queue slots.
+            return number of taken slots, PoolBusy when there is no free slot
+        '''
+        taken = 0
+        while taken < count and self.slots.acquire(blocking=False):
+            taken += 1
+        if not taken:
+            logging.warning('Recognition queue is full')
+            metrics.POOL_REJECTED.inc()
+            raise PoolBusy('The server is busy. Try again later.')
+        return taken
+
+
+    @staticmethod
+    def recorded(collected):
+        result, timings = collected
+        metrics.record(timings)
+        return result
+
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown()